@@ -1,16 +1,14 @@
 import os
 import json
-from collections import defaultdict
 
+from tomt.benchmarks.evaluation import METRICS, RankEvaluator, summarize
 from tomt.benchmarks.gt import GTData, get_documents
 
 import argparse
-import numpy as np
-import pytrec_eval
 
 from tomt.data import utils
 
-metrics_to_compute = {'recip_rank', 'recall_10', "recall_1"}
+metrics_to_compute = METRICS
 parser = argparse.ArgumentParser("create_data_dpr")
 parser.add_argument("--root", required=True)
 parser.add_argument("--dataset", required=True, choices=("Movies", "Books"))
@@ -30,19 +28,9 @@ if __name__ == '__main__':
 
     assert all([qid in predictions for qid in qids])
 
-    evaluator = pytrec_eval.RelevanceEvaluator(qrels, metrics_to_compute)
+    evaluator = RankEvaluator(qrels, metrics_to_compute)
+    eval_qids, metric_vals = evaluator.evaluate(predictions)
+    mean_metrics = summarize(eval_qids, metric_vals)
 
-    acc_metrics = defaultdict(list)
-    for qid, res in evaluator.evaluate(predictions).items():
-        for met in metrics_to_compute:
-            acc_metrics[met].append((qid, res[met]))
-
-    mean_metrics = {}
-
-    for met, all_vals in sorted(acc_metrics.items(), key=lambda _: _[0]):
-        vals = [val for (qid, val) in all_vals]
-        mean_metrics[met] = {
-            "mean": np.mean(vals),
-            "std": np.std(vals)
-        }
-        print(f"{met}: {round(np.mean(vals), 4)}, ({round(np.std(vals), 4)})")
+    for met, vals in mean_metrics.items():
+        print(f"{met}: {round(vals['mean'], 4)}, ({round(vals['std'], 4)})")
@@ -74,6 +74,8 @@ if __name__ == '__main__':
     parser.add_argument("--stop-drop", default=0, type=float)
     parser.add_argument("--gpu", action="store_true")
     parser.add_argument("--save-pred", default="", type=str)
+    parser.add_argument("--save-q-embeds", default="", type=str,
+                        help="if set, query embeddings are saved to this .npz file (for hybrid retrieval)")
     parser.add_argument("--unified", action="store_true", help="test with unified trained model")
     args = parser.parse_args()
 
@@ -116,6 +118,7 @@ if __name__ == '__main__':
     logger.info(f"Corpus size {len(id2doc)}")
 
     retrieved_results = []
+    q_embeds_all = []
     for b_start in tqdm(range(0, len(questions), args.batch_size)):
         with torch.no_grad():
             batch_q = questions[b_start:b_start + args.batch_size]
@@ -128,6 +131,8 @@ if __name__ == '__main__':
             q_embeds = model.encode_q(batch_q_encodes["input_ids"], batch_q_encodes["attention_mask"],
                                       batch_q_encodes.get("token_type_ids", None))
             q_embeds_numpy = q_embeds.cpu().contiguous().numpy()
+            if args.save_q_embeds:
+                q_embeds_all.append(q_embeds_numpy)
             D, I = index.search(q_embeds_numpy, args.topk)
             for b_idx in range(len(batch_q)):
                 topk_docs = []
@@ -139,6 +144,8 @@ if __name__ == '__main__':
     preds = {}
     for qid, ret_res in zip(qids, retrieved_results):
         preds[qid] = {d["title"]: d["score"] for d in ret_res}
+    if args.save_q_embeds:
+        np.savez(args.save_q_embeds, qids=np.array(qids), embeddings=np.concatenate(q_embeds_all))
     assert args.save_pred != ""
     with open(args.save_pred, "w") as writer:
         json.dump(preds, writer)
@@ -0,0 +1,210 @@
+import argparse
+import gc
+import json
+import logging
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from config import configure_logging
+from tomt.data import submissions
+
+log = logging.getLogger(__name__)
+
+WORDS = ("movie", "book", "plot", "remember", "girl", "dog", "space", "ending", "scene", "title", "thanks", "maybe")
+
+
+def synthetic_thread(n_replies, shape="random", seed=42, thread_id="t0"):
+    """
+    A submission (create_solved_cat.py format) with n_replies replies, the last of which is a "solved" reply of the
+    original poster. shape: "deep" (a single chain of replies), "wide" (one top level reply, all the others reply to
+    it) or "random" (every reply answers a uniformly chosen earlier reply, or the submission)
+    """
+    rng = np.random.default_rng(seed)
+    op = f"{thread_id}_op"
+    replies = []
+    top_level = []
+    for i in range(n_replies):
+        if i == n_replies - 1:
+            body, author = "Solved! thanks", op
+        else:
+            body = " ".join(WORDS[j] for j in rng.integers(0, len(WORDS), size=5))
+            author = op if i % 3 == 0 else f"{thread_id}_u{i % 7}"
+        reply = {"id": f"{thread_id}_r{i}", "body": body, "author_name": author, "replies": None}
+
+        if shape == "deep":
+            parent = replies[-1] if replies else None
+        elif shape == "wide":
+            parent = replies[0] if replies else None
+        elif shape == "random":
+            parent_pos = int(rng.integers(-1, len(replies)))
+            parent = replies[parent_pos] if parent_pos >= 0 else None
+        else:
+            raise ValueError(f"unknown thread shape: {shape}")
+
+        if parent is None:
+            top_level.append(reply)
+        else:
+            if parent["replies"] is None:
+                parent["replies"] = []
+            parent["replies"].append(reply)
+        replies.append(reply)
+    return {"id": thread_id, "author": op, "title": "[TOMT] synthetic", "description": "", "replies": top_level}
+
+
+# the previous (quadratic) implementation of tomt.data.submissions, as a reference for timings and outputs
+def _legacy_find_solved_node(submission):
+    reply_stack = submission["replies"][::]
+    author_id = submission["author"]
+    solved_nodes = set()
+    while len(reply_stack) > 0:
+        reply = reply_stack.pop(0)
+        if "solved" in reply["body"].lower() and reply.get("author_name") == author_id:
+            solved_nodes.add(reply["id"])
+        if reply["replies"] is not None:
+            reply_stack.extend(reply["replies"])
+    return solved_nodes
+
+
+def _legacy_gather_desc(reply):
+    if reply["replies"] is None:
+        reply["descendants"] = list()
+        return list()
+    desc = list()
+    for r in reply["replies"]:
+        assert r["id"] not in desc
+        desc.append(r["id"])
+        desc.extend(_legacy_gather_desc(r))
+    reply["descendants"] = desc
+    return desc
+
+
+def _legacy_gather_descendants(submission):
+    for reply in submission["replies"]:
+        desc = _legacy_gather_desc(reply)
+        reply["descendants"] = list(desc)
+
+
+def _legacy_find_path_to_node(submission, match_id):
+    match_reply = None
+    for reply in submission["replies"]:
+        if match_id in reply["descendants"]:
+            match_reply = reply
+    if match_reply is None:
+        return None, None
+    op_id = submission["author"]
+    path = [match_reply["id"]]
+    convo = [submissions.get_formatted_conv_reply(match_reply, op_id)]
+    reply_stack = match_reply["replies"][::]
+    while len(reply_stack) > 0:
+        reply = reply_stack.pop(0)
+        if reply["id"] == match_id:
+            path.append(reply["id"])
+            convo.append(submissions.get_formatted_conv_reply(reply, op_id))
+        if match_id in reply["descendants"]:
+            path.append(reply["id"])
+            convo.append(submissions.get_formatted_conv_reply(reply, op_id))
+        if reply["replies"] is not None:
+            reply_stack.extend(reply["replies"])
+    return path, convo
+
+
+def _legacy_create_conv_dicts(subs):
+    counts = defaultdict(int)
+    convos = {}
+    len_convos = []
+    for submission in subs:
+        solved_nodes = _legacy_find_solved_node(submission)
+        counts[len(solved_nodes)] += 1
+        if len(solved_nodes) == 1:
+            match_id = list(solved_nodes)[0]
+            _legacy_gather_descendants(submission)
+            path, c = _legacy_find_path_to_node(submission, match_id)
+            if path is None:
+                continue
+            convos[submission["id"]] = {"submission": submission, "solved_path": c, "solved_path_ids": path}
+            len_convos.append(len(path))
+    return convos, counts, len_convos
+
+
+IMPLEMENTATIONS = {
+    "legacy": (_legacy_create_conv_dicts, _legacy_gather_descendants, _legacy_find_path_to_node),
+    "current": (submissions.create_conv_dicts, submissions.gather_descendants, submissions.find_path_to_node)
+}
+
+
+def _comparable(output):
+    """
+    create_conv_dicts output, with the (nested) submissions flattened: json.dumps recurses once per level
+    """
+    convos, counts, len_convos = output
+    flat = {}
+    for sid, convo in convos.items():
+        nodes, stack = [], list(convo["submission"]["replies"])
+        while stack:
+            reply = stack.pop()
+            nodes.append({k: v for k, v in reply.items() if k != "replies"})
+            stack.extend(reply["replies"] or [])
+        flat[sid] = {"nodes": nodes, "solved_path": convo["solved_path"], "solved_path_ids": convo["solved_path_ids"]}
+    return flat, dict(counts), len_convos
+
+
+def benchmark_thread(shape, n_replies, repeats):
+    match_id = f"t0_r{n_replies - 1}"
+    row = {"shape": shape, "n_replies": n_replies}
+    outputs = {}
+    for name, (create_conv_dicts, gather_descendants, find_path_to_node) in IMPLEMENTATIONS.items():
+        conv_time, path_time = float("inf"), float("inf")
+        for _ in range(repeats):
+            subs = [synthetic_thread(n_replies, shape)]
+            # as in timeit: the descendants lists of deep threads make every collection expensive
+            gc.collect()
+            gc.disable()
+            start = time.perf_counter()
+            output = create_conv_dicts(subs)
+            conv_time = min(conv_time, time.perf_counter() - start)
+
+            # path extraction only (gather_descendants done beforehand, the legacy version needs it)
+            gather_descendants(subs[0])
+            start = time.perf_counter()
+            find_path_to_node(subs[0], match_id)
+            path_time = min(path_time, time.perf_counter() - start)
+            gc.enable()
+            outputs[name] = _comparable(output)
+        row[f"{name}_create_conv_dicts_s"] = conv_time
+        row[f"{name}_find_path_to_node_s"] = path_time
+
+    row["identical"] = outputs["legacy"] == outputs["current"]
+    row["path_length"] = outputs["current"][2][0] if outputs["current"][2] else None
+    log.info(f"{shape} ({n_replies} replies, path of {row['path_length']}): create_conv_dicts "
+             f"{row['legacy_create_conv_dicts_s']:0.4f}s -> {row['current_create_conv_dicts_s']:0.4f}s, "
+             f"find_path_to_node {row['legacy_find_path_to_node_s']:0.4f}s -> "
+             f"{row['current_find_path_to_node_s']:0.4f}s, identical output: {row['identical']}")
+    return row
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("benchmark_conv_paths",
+                                     description="Compares the previous and the current solved path extraction "
+                                                 "(tomt.data.submissions) on synthetic deep / wide / random threads")
+    parser.add_argument("--shapes", default="deep,wide,random")
+    parser.add_argument("--sizes", default="100,1000,5000",
+                        help="comma separated numbers of replies per thread. The descendants lists of a deep thread "
+                             "take O(n^2) memory (in both versions)")
+    parser.add_argument("--repeats", type=int, default=3, help="the fastest of the repeats is reported")
+    parser.add_argument("--out", help="if set, results are written to this JSON file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    configure_logging("benchmark_conv_paths", args.verbose)
+
+    sizes = [int(n) for n in args.sizes.split(",")]
+    # the legacy version recurses once per level of deep threads
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 2 * max(sizes) + 1000))
+
+    results = [benchmark_thread(shape, n, args.repeats) for shape in args.shapes.split(",") for n in sizes]
+    assert all(r["identical"] for r in results), "outputs differ from the previous implementation"
+    if args.out:
+        with open(args.out, "w") as writer:
+            json.dump(results, writer, indent=2)
@@ -0,0 +1,170 @@
+import argparse
+import logging
+import os
+import platform
+import subprocess
+import time
+
+from haystack.document_store import InMemoryDocumentStore
+from haystack.preprocessor import PreProcessor
+
+from config import configure_logging
+from run_lexical_benchmark import get_data_path, load_test_data
+from tomt.benchmarks.evaluation import METRICS, RankEvaluator, summarize
+from tomt.benchmarks.gt import get_corpus
+from tomt.benchmarks.lexical import initialize_from_config as init_lexical
+from tomt.benchmarks.lexical_utils import get_std_utils
+from tomt.benchmarks.profiling import StageProfiler
+from tomt.benchmarks.query_pipeline import PROCESSOR_KWARGS
+from tomt.benchmarks.runfile import RunFile, RunWriter
+from tomt.benchmarks.sweep import tokenize_queries
+from tomt.benchmarks.synthetic import write_synthetic_dataset
+from tomt.data import utils
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {"wmodel": "BM25", "controls": {}}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_corpus(name, folder_path, args, config_json):
+    """
+    Runs the lexical pipeline on one dataset, stage by stage. Returns the profile of every stage
+    """
+    log.info(f"Benchmarking {name} ({folder_path})")
+    profiler = StageProfiler()
+    hard_negatives = args.negative_set in {"hn", "all"}
+    negatives = args.negative_set in {"neg", "all"}
+
+    with profiler.stage("document_loading") as stage:
+        documents = [{"id": d["id"], "title": d["title"], "text": d["text"], "meta": d["meta"]}
+                     for d in get_corpus(folder_path, hard_negatives=hard_negatives, negatives=negatives)]
+        stage["n_items"] = len(documents)
+
+    with profiler.stage("preprocessing", n_items=len(documents)):
+        processor = PreProcessor(**PROCESSOR_KWARGS)
+        processed_docs = [p for doc in documents for p in processor.process(doc)]
+        document_store = InMemoryDocumentStore()
+        document_store.write_documents(processed_docs)
+
+    with profiler.stage("tokenization", n_items=len(processed_docs)):
+        for _ in get_std_utils().tokenize_many(doc["text"] for doc in processed_docs):
+            pass
+
+    # the index is built from scratch, including another tokenization pass
+    with profiler.stage("index_build", n_items=len(processed_docs)):
+        config = dict(config_json, index_path=os.path.join(args.out, "indexes", name))
+        retriever = init_lexical(args.method, args.top_k, document_store, config)
+
+    queries, qrel, _ = load_test_data(folder_path)
+    with profiler.stage("query_tokenization", n_items=len(queries)):
+        tokenized = tokenize_queries(queries, args.query_type, retriever.query_utils, n_workers=args.query_workers)
+
+    run_path = os.path.join(args.out, "runs", name)
+    with profiler.stage("retrieval", n_items=len(tokenized)):
+        with RunWriter(run_path) as run_writer:
+            for i in range(0, len(tokenized), args.batch_size):
+                for qid, ranked in retriever.batch_retrieve_tokenized(tokenized[i:i + args.batch_size]).items():
+                    run_writer.add(qid, ranked.doc_ids(), ranked.scores)
+
+    with profiler.stage("evaluation", n_items=len(queries)):
+        eval_qids, metric_vals = RankEvaluator(qrel, METRICS).evaluate(RunFile(run_path))
+        metrics = summarize(eval_qids, metric_vals)
+
+    return {
+        "corpus": name,
+        "n_docs": len(documents),
+        "n_queries": len(queries),
+        "stages": profiler.stages,
+        "metrics": {met: vals["mean"] for met, vals in metrics.items()}
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Logs stages whose wall time grew by more than tolerance (a ratio) compared to a previous benchmark file
+    """
+    previous = {(r["corpus"], s["stage"]): s["wall_time"] for r in baseline["results"] for s in r["stages"]}
+    n_regressions = 0
+    for r in results:
+        for s in r["stages"]:
+            before = previous.get((r["corpus"], s["stage"]))
+            if before is None:
+                continue
+            ratio = s["wall_time"] / max(before, 1e-9)
+            s["baseline_ratio"] = ratio
+            if ratio > tolerance:
+                n_regressions += 1
+                log.warning(f"{r['corpus']}:: {s['stage']} regressed: {before:0.2f}s -> {s['wall_time']:0.2f}s "
+                            f"(x{ratio:0.2f})")
+    log.info(f"{n_regressions} stage(s) slower than x{tolerance} of the baseline ({baseline.get('commit')})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("benchmark_lexical",
+                                     description="Wall time, peak RSS and throughput of every stage of the lexical "
+                                                 "pipeline, on TestMovies and synthetic corpora")
+    parser.add_argument("--out", required=True, help="output folder (results.json, indexes and runs)")
+    parser.add_argument("--method", default="native", help="lexical method (terrier / native)")
+    parser.add_argument("--config", help="retriever config (default: BM25 with default parameters)")
+    parser.add_argument("--corpora", default="TestMovies,synthetic",
+                        help="comma separated: any of the datasets of run_lexical_benchmark.py and 'synthetic'")
+    parser.add_argument("--scales", default="1,10,100", help="comma separated scales of the synthetic corpora")
+    parser.add_argument("--base_queries", type=int, default=1000, help="number of queries of the 1x synthetic corpus")
+    parser.add_argument("--base_docs", type=int, default=10000, help="number of documents of the 1x synthetic corpus")
+    parser.add_argument("--synthetic_root", default="./dataset/synthetic",
+                        help="synthetic corpora are generated here once (one folder per size and seed), and reused "
+                             "afterwards")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the synthetic corpora")
+    parser.add_argument("--negative_set", choices={"none", "hn", "neg", "all"}, default="all")
+    parser.add_argument("--query_type", choices={"title_only", "description_only", "all"}, default="all")
+    parser.add_argument("--top_k", type=int, default=1000)
+    parser.add_argument("--batch_size", type=int, default=1000, help="number of queries retrieved at once")
+    parser.add_argument("--query_workers", type=int, default=2)
+    parser.add_argument("--baseline", help="results.json of a previous run, stages that got slower are reported")
+    parser.add_argument("--tolerance", type=float, default=1.2,
+                        help="wall time ratio (vs. the baseline) above which a stage counts as a regression")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    assert not os.path.exists(args.out), f"folder {args.out} already exists"
+    os.makedirs(args.out, exist_ok=False)
+    configure_logging("benchmark_lexical", args.verbose)
+
+    config_json = utils.read_json(args.config) if args.config else DEFAULT_CONFIG
+    corpora = []
+    for corpus in args.corpora.split(","):
+        if corpus != "synthetic":
+            corpora.append((corpus, get_data_path(corpus)))
+            continue
+        for scale in (int(s) for s in args.scales.split(",")):
+            n_queries, n_docs = args.base_queries * scale, args.base_docs * scale
+            # everything the corpus is generated from is in the name, so that a corpus is only reused if it matches
+            folder = os.path.join(args.synthetic_root, f"{n_queries}q_{n_docs}d_seed{args.seed}")
+            # qrels.txt is written last, marks a complete corpus
+            if not os.path.exists(os.path.join(folder, "splits", "test", "qrels.txt")):
+                write_synthetic_dataset(folder, n_queries=n_queries, n_docs=n_docs, seed=args.seed)
+            corpora.append((f"synthetic_{scale}x", folder))
+
+    start_time = time.time()
+    results = [benchmark_corpus(name, folder, args, config_json) for name, folder in corpora]
+    if args.baseline:
+        compare_to_baseline(results, utils.read_json(args.baseline), args.tolerance)
+
+    utils.write_json({
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+        "results": results
+    }, os.path.join(args.out, "results.json"), indent=2)
+    log.info(f"Benchmark took {time.time() - start_time:0.2f}s, results saved to {args.out}")
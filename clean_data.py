@@ -1,12 +1,12 @@
 import os
 import argparse
 
-import spacy
-
+from config import configure_logging
 from tomt.benchmarks.gt import read_qrels
-from tomt.benchmarks.lexical_utils import Utils
+from tomt.benchmarks.lexical_utils import Utils, get_spacy_model
 import shutil
 from tomt.data import utils
+from tomt.data.store import SubmissionStore
 
 import urlextract
 
@@ -61,6 +61,12 @@ def strip_urls(desc):
 
 
 def is_edited(submission_id, sub_folders):
+    """
+    sub_folders: list of submission folders (pickles), or a SubmissionStore
+    """
+    if isinstance(sub_folders, SubmissionStore):
+        return sub_folders.edited(submission_id)
+
     for fold in sub_folders:
         if os.path.exists(os.path.join(fold, submission_id + ".pkl")):
             return utils.load_pickle(os.path.join(fold, submission_id + ".pkl")).edited is not False
@@ -198,11 +204,15 @@ if __name__ == '__main__':
     parser.add_argument("folder", help="(root) location of data to clean up")
     parser.add_argument("--min_len", help="min length of query", type=int, default=2)
     parser.add_argument("--verbose", help="set flag for verbose logging", action="store_true")
-    parser.add_argument("--sub_folders", help="csv of submission folders (which contain pickles of submissions)",
-                        type=str, required=True)
+    sources = parser.add_mutually_exclusive_group(required=True)
+    sources.add_argument("--sub_folders", help="csv of submission folders (which contain pickles of submissions)",
+                         type=str)
+    sources.add_argument("--store", help="SQLite submission store (create_submission_store.py), instead of "
+                                         "--sub_folders", type=str)
     args = parser.parse_args()
+    configure_logging("clean_data", args.verbose)
 
-    sub_folders = args.sub_folders.split(",")
+    sub_folders = SubmissionStore(args.store) if args.store else args.sub_folders.split(",")
     SEP_ = shutil.get_terminal_size((50, 20)).columns
 
     url_extractor = urlextract.URLExtract()
@@ -210,7 +220,8 @@ if __name__ == '__main__':
     folder = args.folder
     min_length = args.min_len
     lex_utils = Utils(remove_square_braces=True, incl_only_alphanumeric=True)
-    sent_nlp = spacy.load("en_core_web_md")
+    # full pipeline (incl. parser), for sentence splitting
+    sent_nlp = get_spacy_model("en_core_web_md")
 
     removed_qids = []
     count = 0
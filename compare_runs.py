@@ -0,0 +1,47 @@
+import argparse
+import logging
+import os
+
+from config import configure_logging
+from tomt.benchmarks.evaluation import METRICS, RankEvaluator
+from tomt.benchmarks.gt import GTData
+from tomt.benchmarks.runfile import load_run
+from tomt.benchmarks.significance import compare_runs
+from tomt.data import utils
+
+log = logging.getLogger(__name__)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("CompareRuns",
+                                     description="Bootstrap confidence intervals and paired randomization tests "
+                                                 "for a set of runs")
+    parser.add_argument("runs", nargs="+",
+                        help="runs to compare, as name=path (run folder, lexical output folder or JSON run)")
+    parser.add_argument("--dataset", choices={"Movies", "Books", "TestMovies"}, required=True)
+    parser.add_argument("--root", default="./dataset", help="location of the datasets")
+    parser.add_argument("--split", default="test", choices={"train", "validation", "test"})
+    parser.add_argument("--n_samples", type=int, default=10000, help="number of bootstrap / randomization samples")
+    parser.add_argument("--alpha", type=float, default=0.05, help="1 - confidence level of the intervals")
+    parser.add_argument("--n_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", required=True, help="path to output JSON file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    configure_logging("compare_runs", args.verbose)
+
+    data = GTData(os.path.join(args.root, args.dataset, "splits", args.split))
+    qrel = data.get_qrels()
+    qids = [q["id"] for q in data.get_queries()]
+
+    runs = {}
+    for r in args.runs:
+        name, path = r.split("=", 1)
+        log.info(f"Loading run {name} from {path}")
+        runs[name] = load_run(path)
+
+    results = compare_runs(RankEvaluator(qrel), runs, qids, METRICS, n_samples=args.n_samples, alpha=args.alpha,
+                           seed=args.seed, n_workers=args.n_workers)
+    results["args"] = vars(args)
+    utils.write_json(results, args.out, indent=2)
@@ -4,7 +4,8 @@ from haystack.document_store import InMemoryDocumentStore
 from haystack.preprocessor import PreProcessor
 from tomt.benchmarks.gt import GTData, get_documents
 from tomt.benchmarks.lexical import initialize_from_config as init_lexical
-from run_lexical_benchmark import make_query, get_data_path, read_config, prepare_documents, process_batch
+from tomt.benchmarks.runfile import RunFile
+from run_lexical_benchmark import make_query, get_data_path, read_config, prepare_documents
 from tqdm import tqdm
 from tomt.data import utils
 
@@ -25,6 +26,30 @@ def process(batch):
         hard_negatives[qid] = hn
 
 
+def hard_negatives_from_run(run, qrels, n_hard_negatives):
+    """
+    Top ranked non-gold documents of every query, read directly from the arrays of a RunFile
+    """
+    hard_negatives = {}
+    for qid in run:
+        gold_index = run.docid_to_index.get(qrels[qid], -1)
+        doc_indices, _ = run.get_arrays(qid)
+        doc_indices = doc_indices[doc_indices != gold_index][:n_hard_negatives]
+        hard_negatives[qid] = [run.docids[i] for i in doc_indices.tolist()]
+    return hard_negatives
+
+
+def check_covers_qrels(hard_negatives, qrels, run_paths):
+    """
+    The hard negatives file covers every query of the dataset, a run of run_lexical_benchmark.py only has the
+    queries of one phase (fit: train + validation, evaluate_test: test)
+    """
+    missing = sorted(set(qrels) - set(hard_negatives))
+    if missing:
+        raise ValueError(f"{', '.join(run_paths)} have no results for {len(missing)} of {len(qrels)} queries (runs of "
+                         f"one phase only?), missing: {', '.join(missing[:20])}{', ...' if len(missing) > 20 else ''}")
+
+
 if __name__ == '__main__':
 
     method = {
@@ -32,7 +57,10 @@ if __name__ == '__main__':
         "config_path": "./config/lexical/terrier_bm25.json",
         "common_index_path": "./common_index",
         "n_hard_negatives": 5,
-        "negative_set": "all"
+        "negative_set": "all",
+        # if set, hard negatives are read from these runs (saved by run_lexical_benchmark.py), instead of retrieving.
+        # Together, they have to cover all queries, e.g. the runs of both phases (fit and evaluate_test)
+        "run_paths": None  # e.g. ["./results/{dataset}/all/bm25_fit/run", "./results/{dataset}/all/bm25_test/run"]
     }
 
     data_root = "./dataset/"
@@ -40,6 +68,16 @@ if __name__ == '__main__':
 
     for dataset in ["Movies", "Books"]:
 
+        if method["run_paths"] is not None:
+            qrels = GTData(os.path.join(data_root, dataset)).get_qrels(False)
+            run_paths = [p.format(dataset=dataset) for p in method["run_paths"]]
+            hard_negatives = {}
+            for run_path in run_paths:
+                hard_negatives.update(hard_negatives_from_run(RunFile(run_path), qrels, method["n_hard_negatives"]))
+            check_covers_qrels(hard_negatives, qrels, run_paths)
+            utils.write_json(hard_negatives, os.path.join(data_root, dataset, f"bm25_hard_negatives_{neg_set}.json"))
+            continue
+
         for split in ["test"]:
             queries = GTData(os.path.join(data_root, dataset, "splits", split)).get_grouped_data(
                 os.path.join(data_root, dataset), "all")
@@ -57,7 +95,7 @@ if __name__ == '__main__':
 
         config_json = read_config(method["config_path"])
         document_store = InMemoryDocumentStore()
-        documents, processed_docs = prepare_documents(Namespace(negative_set=neg_set), folder_path, processor)
+        processed_docs = prepare_documents(Namespace(negative_set=neg_set), folder_path, processor)
         document_store.write_documents(processed_docs)
         config_json[
             "index_path"] = os.path.join(method["common_index_path"], "terrier", f"{dataset}_{neg_set}")
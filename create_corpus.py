@@ -0,0 +1,21 @@
+import argparse
+import logging
+
+from config import configure_logging
+from tomt.data.corpus import convert_corpus
+
+log = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("CreateCorpus",
+                                     description="Converts the JSONL documents (incl. negatives) of a dataset into a "
+                                                 "memory-mappable binary corpus, read by the document loaders of "
+                                                 "tomt.benchmarks.gt")
+    parser.add_argument("folder", help="(root) location of the dataset, e.g. ./dataset/Movies")
+    parser.add_argument("--out", help="output folder (default: {folder}/corpus)")
+    parser.add_argument("--verbose", help="set flag for verbose logging", action="store_true")
+    args = parser.parse_args()
+    configure_logging("create_corpus", args.verbose)
+
+    out = convert_corpus(args.folder, args.out)
+    log.info(f"Corpus saved to {out}")
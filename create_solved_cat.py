@@ -6,8 +6,10 @@ import logging.handlers
 import json
 import re
 from config import configure_logging
-from tomt.data import reddit, utils
+from tomt.data import utils
+from tomt.data.store import SubmissionStore, comment_forest, comment_records, submission_record
 from tomt.data.submissions import *
+from tomt.data.utils import datetime_from_utc
 
 log = logging.getLogger(__name__)
 
@@ -20,66 +22,57 @@ def json_serial(obj):
     raise TypeError("Type %s not serializable" % type(obj))
 
 
-def traverse_and_add(reply):
-    reply_tree = comment_to_json(reply)
-
-    sub_replies = []
-    for child in reply.replies:
-        sub_replies.append(traverse_and_add(child))
-
-    reply_tree["replies"] = None if len(sub_replies) == 0 else sub_replies
-
-    return reply_tree
-
-
 def comment_to_json(comment):
+    """
+    comment: a node of store.comment_forest
+    """
     tree = {
-        "id": comment.id,
-        "body": comment.body,
-        "created_date": reddit.datetime_from_utc(comment.created_utc)
+        "id": comment["id"],
+        "body": comment["body"],
+        "created_date": datetime_from_utc(comment["created_utc"])
     }
 
-    if comment.author:
-        if isinstance(comment.author.name, tuple):
-            author_name = comment.author.name
-        else:
-            author_name = comment.author.name
-        tree["author_name"] = author_name
-
-    return tree
+    if comment["author"]:
+        tree["author_name"] = comment["author"]
 
+    replies = [comment_to_json(reply) for reply in comment["replies"]]
+    tree["replies"] = None if len(replies) == 0 else replies
 
-def get_comment_forest(comments):
-    forest = []
-
-    for comment in comments:
-        tree = comment_to_json(comment)
-
-        replies = []
-        for reply in comment.replies:
-            replies.append(traverse_and_add(reply))
-
-        tree["replies"] = None if len(replies) == 0 else replies
-        forest.append(tree)
-    return forest
+    return tree
 
 
 def submission_to_json(submission, thread_status, raw_category, normalized_category):
     j = {
-        "id": submission.id,
+        "id": submission["id"],
         "category": normalized_category,
-        "author": submission.author.name if submission.author is not None else None,
+        "author": submission["author"],
         "raw_category": raw_category,
         "status": thread_status,
-        "title": submission.title,
-        "description": submission.selftext,
-        "created_utc": reddit.datetime_from_utc(submission.created_utc),
-        "replies": get_comment_forest(submission.comments)
+        "title": submission["title"],
+        "description": submission["selftext"],
+        "created_utc": datetime_from_utc(submission["created_utc"]),
+        "replies": [comment_to_json(c) for c in comment_forest(submission["comments"])]
     }
 
     return j
 
 
+def iterate_submissions(input_folder=None, store_path=None):
+    """
+    Yields (submission record, function returning its flat comment records), from a SubmissionStore or from a folder
+    of pickles. Comments are only loaded for the submissions that need them
+    """
+    if store_path is not None:
+        with SubmissionStore(store_path) as store:
+            for submission in store.iter_submissions():
+                yield submission, lambda submission_id=submission["id"]: store.comments(submission_id)
+    else:
+        # unpickling PRAW objects needs PRAW
+        from tomt.data import reddit
+        for submission in reddit.iterate_raw_submissions([input_folder]):
+            yield submission_record(submission), lambda s=submission: comment_records(s)
+
+
 def get_raw_category(title):
     cat = re.search(r'\[TOMT\](\s*)\[([^]]*)\]',
                     title, re.IGNORECASE)
@@ -96,12 +89,12 @@ def get_raw_category(title):
 
 
 def get_status(submission, status_dict):
-    if submission.selftext == "[removed]":
+    if submission["selftext"] == "[removed]":
         status = "removed"
-    elif submission.link_flair_text is None:
+    elif submission["link_flair_text"] is None:
         status = "unknown"
     else:
-        status = submission.link_flair_text
+        status = submission["link_flair_text"]
 
     return status_dict[status]
 
@@ -109,7 +102,9 @@ def get_status(submission, status_dict):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("CreateSolveCat",
                                      description="Creates JSON file of solved submissions of a particular category")
-    parser.add_argument("--input_folder", help="location of the submission pickles", required=True)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input_folder", help="location of the submission pickles")
+    source.add_argument("--store", help="location of the SQLite submission store (create_submission_store.py)")
     parser.add_argument("--status_cat", help="location of the JSON file containing standardized statuses",
                         required=True)
     parser.add_argument("--norm_cat", help="location of TSV file containing raw text category -> standardized category",
@@ -136,14 +131,14 @@ if __name__ == '__main__':
     status_dict = utils.read_json(args.status_cat)
 
     data = {}
-    for submission in reddit.iterate_raw_submissions([args.input_folder]):
+    for submission, load_comments in iterate_submissions(args.input_folder, args.store):
         # skip posts which have no description
-        if submission.selftext.strip() == "[deleted]":
+        if submission["selftext"].strip() == "[deleted]":
             continue
         thread_status = get_status(submission, status_dict)
         if thread_status != "Solved":
             continue
-        raw_category = get_raw_category(submission.title)
+        raw_category = get_raw_category(submission["title"])
         normalized_category = normalized_categories.get(raw_category)
 
         if not normalized_category:
@@ -151,6 +146,7 @@ if __name__ == '__main__':
         if normalized_category != args.cat:
             continue
 
+        submission["comments"] = load_comments()
         submission_json = submission_to_json(submission, thread_status, raw_category, normalized_category)
 
         solved_nodes = find_solved_node(submission_json)
@@ -0,0 +1,31 @@
+import argparse
+import logging
+import os
+
+from config import configure_logging
+from tomt.data import reddit
+
+log = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("CreateSubmissionIndex",
+                                     description="Builds an index (submission id -> NSFW flag, creation time, flair) "
+                                                 "of folders of submission pickles (download.py), which "
+                                                 "reddit.iterate_raw_submissions_parallel(index=...) uses to skip "
+                                                 "NSFW submissions without unpickling them")
+    parser.add_argument("--input_folders", help="csv of submission folders (which contain pickles of submissions)",
+                        required=True)
+    parser.add_argument("--out", help="path to the index (JSON). If it exists, it is only rebuilt with --overwrite",
+                        required=True)
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--workers", type=int, default=4, help="number of processes unpickling submissions")
+    parser.add_argument("--verbose", help="set flag for verbose logging", action="store_true")
+    args = parser.parse_args()
+    configure_logging("create_submission_index", args.verbose)
+
+    if os.path.exists(args.out) and not args.overwrite:
+        log.info(f"{args.out} already exists, pass --overwrite to rebuild it")
+    else:
+        index = reddit.build_submission_index(args.input_folders.split(","), args.out, n_workers=args.workers)
+        log.info(f"Indexed {len(index)} submissions ({sum(s['over_18'] for s in index.values())} NSFW) "
+                 f"in {args.out}")
@@ -0,0 +1,37 @@
+import argparse
+import logging
+
+from config import configure_logging
+from tomt.data import reddit
+from tomt.data.store import SUBMISSION_FIELDS, SubmissionStore
+
+log = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("CreateSubmissionStore",
+                                     description="Converts folders of submission pickles (download.py) to a SQLite "
+                                                 "submission store, which can be read without PRAW")
+    parser.add_argument("--input_folders", help="csv of submission folders (which contain pickles of submissions)",
+                        required=True)
+    parser.add_argument("--out", help="path to the SQLite file (submissions already in it are skipped)",
+                        required=True)
+    parser.add_argument("--commit_every", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=4, help="number of processes unpickling submissions")
+    parser.add_argument("--verbose", help="set flag for verbose logging", action="store_true")
+    args = parser.parse_args()
+    configure_logging("create_submission_store", args.verbose)
+
+    with SubmissionStore(args.out) as store:
+        existing = store.ids()
+        n_added = 0
+        # NSFW submissions are kept, readers skip them
+        for record in reddit.iterate_raw_submissions_parallel(args.input_folders.split(","),
+                                                              fields=SUBMISSION_FIELDS + ("comments",),
+                                                              exclude_ids=existing, skip_nsfw=False,
+                                                              n_workers=args.workers, ordered=False):
+            store.add_records(record, record.pop("comments"), commit=False)
+            n_added += 1
+            if n_added % args.commit_every == 0:
+                store.commit()
+        store.commit()
+        log.info(f"Added {n_added} submissions, {len(store)} in {args.out}")
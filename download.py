@@ -3,7 +3,7 @@ import logging
 import argparse
 
 import config
-from tomt.data import reddit
+from tomt.data import pushshift, reddit
 
 log = logging.getLogger("reddit.download")
 
@@ -17,9 +17,22 @@ if __name__ == "__main__":
     parser.add_argument("--submissions", help="output location for the submissions dump",
                         default="dataset/submissions.json")
     parser.add_argument("--output", help="output location for the threads", default="dataset/tomt/")
+    parser.add_argument("--store", default=None,
+                        help="if set, the threads are written to this SQLite submission store instead of --output")
     parser.add_argument("--sleep_time", help="sleep time in seconds between each request for Pushshift", type=float,
                         default=1.)
+    parser.add_argument("--window_days", default=None, type=float,
+                        help="if set, Pushshift is crawled concurrently in time windows of this many days, with a "
+                             "resumable checkpoint. --submissions then has to be a .jsonl file")
+    parser.add_argument("--pushshift_concurrency", default=4, type=int,
+                        help="number of time windows crawled at the same time (with --window_days)")
+    parser.add_argument("--pushshift_requests_per_second", default=1.0, type=float,
+                        help="rate limit of the Pushshift requests (with --window_days)")
     parser.add_argument("--timeout", default=None, type=int, help="timeout in seconds (per submission)")
+    parser.add_argument("--workers", default=8, type=int, help="number of threads downloading submissions")
+    parser.add_argument("--requests_per_second", default=reddit.REQUESTS_PER_SECOND, type=float,
+                        help="rate limit of the Reddit API requests (shared by all workers)")
+    parser.add_argument("--retries", default=3, type=int, help="retries (with backoff) of a failed submission")
 
     config.add_common_args(parser)
 
@@ -29,9 +42,17 @@ if __name__ == "__main__":
     config.supress_log("urllib3")
     config.supress_log("prawcore")
 
-    if not os.path.exists(args.submissions):
+    if args.window_days is not None:
+        assert args.submissions.endswith(".jsonl"), "--window_days streams the submissions to a .jsonl file"
+        # resumes an interrupted crawl, finished windows aren't fetched again
+        crawler = pushshift.PushshiftCrawler(args.submissions, requests_per_second=args.pushshift_requests_per_second,
+                                             max_concurrent=args.pushshift_concurrency)
+        crawler.crawl(args.start_time, args.end_time, window_days=args.window_days)
+    elif not os.path.exists(args.submissions):
         # first, download the submissions file
         reddit.get_all_submissions(args.start_time, args.end_time, args.submissions, sleep_time=args.sleep_time)
 
     # use the submission ids to get the threads from reddit
-    reddit.download_submissions(args.conf, args.submissions, args.output, timeout=args.timeout)
+    reddit.download_submissions(args.conf, args.submissions, args.output, timeout=args.timeout,
+                                n_workers=args.workers, requests_per_second=args.requests_per_second,
+                                retries=args.retries, store_path=args.store)
@@ -0,0 +1,118 @@
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import time
+
+from haystack.document_store import InMemoryDocumentStore
+from haystack.preprocessor import PreProcessor
+
+from config import configure_logging
+from run_lexical_benchmark import (add_common_args, get_data_path, load_test_data, load_train_val_data,
+                                   prepare_documents, read_config)
+from tomt.benchmarks.evaluation import METRICS, RankEvaluator, summarize
+from tomt.benchmarks.fusion import FUSION_METHODS, RRF_K, DenseRetriever, HybridRetriever
+from tomt.benchmarks.lexical import initialize_from_config as init_lexical
+from tomt.benchmarks.query_pipeline import PROCESSOR_KWARGS
+from tomt.benchmarks.runfile import RunWriter
+from tomt.benchmarks.sweep import is_grid, tokenize_queries
+from tomt.data import utils
+
+log = logging.getLogger(__name__)
+
+
+def default_candidates_dir(args, config_json):
+    """
+    {common_index_path}/candidates/{dataset}_{negative_set}_{hash}: the hash covers everything that changes the
+    candidate lists, so that runs with other settings don't reuse them
+    """
+    settings = {"config": config_json, **{k: getattr(args, k) for k in (
+        "phase", "method", "query_type", "top_k", "max_query_terms", "dense_index", "dense_id2doc",
+        "query_embeddings")}}
+    digest = hashlib.md5(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(args.common_index_path, "candidates", f"{args.dataset}_{args.negative_set}_{digest}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("run_hybrid_benchmark",
+                                     description="Fuses lexical (terrier/native) and dense (DPR) rankings")
+    parser.add_argument("phase", choices={"fit", "evaluate_test"})
+    parser.add_argument("--method", required=True, help="lexical method (terrier / native)")
+    parser.add_argument("--common_index_path", required=True, help="Location of common_index")
+    parser.add_argument("--dense_index", required=True, help="DPR document embeddings (index.npy)")
+    parser.add_argument("--dense_id2doc", required=True, help="DPR id2doc.json")
+    parser.add_argument("--query_embeddings", required=True,
+                        help="query embeddings (.npz), see --save-q-embeds of DPR/eval_retrieval.py")
+    parser.add_argument("--fusion", choices=FUSION_METHODS, default="rrf")
+    parser.add_argument("--rrf_k", type=int, default=RRF_K)
+    parser.add_argument("--lexical_weights", default="0.5",
+                        help="comma separated weights of the lexical ranking (the dense ranking gets 1 - weight), "
+                             "every weight is evaluated on the cached candidates")
+    parser.add_argument("--candidates_dir",
+                        help="cache of the lexical and dense candidate lists, reused if it exists (default: a folder "
+                             "under {common_index_path}/candidates, per dataset and settings)")
+    parser.add_argument("--out", required=True, help="Location to save results")
+    add_common_args(parser)
+    args = parser.parse_args()
+
+    assert not os.path.exists(args.out), f"folder {args.out} already exists"
+    config_json = read_config(args.config)
+    # one lexical ranking is fused, sweeps are run with run_lexical_benchmark.py
+    assert not is_grid(config_json), f"{args.config} is a grid config, a single config is required"
+    candidates_dir = args.candidates_dir or default_candidates_dir(args, config_json)
+    os.makedirs(args.out, exist_ok=False)
+    configure_logging(f"hybrid-{args.method}", args.verbose)
+
+    start_time = time.time()
+    folder_path = get_data_path(args.dataset)
+    document_store = InMemoryDocumentStore()
+    document_store.write_documents(prepare_documents(args, folder_path, PreProcessor(**PROCESSOR_KWARGS)))
+    config_json["index_path"] = os.path.join(args.common_index_path, args.method.split("_")[0],
+                                             f"{args.dataset}_{args.negative_set}")
+    config_json["index_workers"] = args.index_workers
+    lexical = init_lexical(args.method, args.top_k, document_store, config_json)
+    dense = DenseRetriever(args.dense_index, args.dense_id2doc, args.query_embeddings, args.top_k)
+
+    if args.phase == "fit":
+        queries, qrel, ids_by_subsets = load_train_val_data(folder_path)
+    else:
+        queries, qrel, ids_by_subsets = load_test_data(folder_path)
+    log.info(f"Phase {args.phase}: {len(queries)}")
+
+    tokenized = tokenize_queries(queries, args.query_type, lexical.query_utils, n_workers=args.query_workers)
+    log.info(f"Candidates cache: {candidates_dir}")
+    hybrid = HybridRetriever(lexical, dense, cache_folder=candidates_dir, top_k=args.top_k)
+    aligned = hybrid.candidates(tokenized)
+
+    evaluator = RankEvaluator(qrel, METRICS)
+    rows = []
+    best = None
+    for w in (float(w) for w in args.lexical_weights.split(",")):
+        fuse_start = time.time()
+        fused = aligned.fuse(args.fusion, (w, 1 - w), args.rrf_k)
+        run = aligned.to_run(fused, args.top_k)
+        fuse_time = time.time() - fuse_start
+        eval_qids, metric_vals = evaluator.evaluate(run)
+        mean_metrics = summarize(eval_qids, metric_vals)
+        log.info(f"lexical weight {w} (fusion: {fuse_time:0.3f}s):: "
+                 + ", ".join(f"{met}: {vals['mean']:0.4f}" for met, vals in mean_metrics.items()))
+        rows.append([w, f"{fuse_time:0.3f}"] + [f"{mean_metrics[met]['mean']:0.4f}" for met in sorted(METRICS)])
+        if best is None or mean_metrics[METRICS[0]]["mean"] > best[1][METRICS[0]]["mean"]:
+            best = (w, mean_metrics, run, summarize(eval_qids, metric_vals, ids_by_subsets))
+
+    with open(os.path.join(args.out, "fusion.tsv"), "w", newline="") as writer:
+        tsv = csv.writer(writer, delimiter="\t")
+        tsv.writerow(["lexical_weight", "fusion_time"] + sorted(METRICS))
+        tsv.writerows(rows)
+
+    best_weight, _, best_run, best_subset_metrics = best
+    log.info(f"Best lexical weight ({METRICS[0]}): {best_weight}")
+    with RunWriter(os.path.join(args.out, "run")) as run_writer:
+        for qid, scores in best_run.items():
+            run_writer.add_dict(qid, scores)
+    utils.write_json(vars(args), os.path.join(args.out, "args.json"), indent=2)
+    utils.write_json({"lexical_weight": best_weight, "metrics": best_subset_metrics},
+                     os.path.join(args.out, "metrics.json"), indent=2)
+    log.info(f"Run took {time.time() - start_time:0.4f}s")
@@ -2,18 +2,19 @@ import argparse
 import json
 import logging.handlers
 import os
-from collections import defaultdict
 
 import time
-import numpy as np
-import pytrec_eval
 from haystack.document_store import ElasticsearchDocumentStore
 from haystack.document_store import InMemoryDocumentStore
 from haystack.preprocessor import PreProcessor
 from collections import namedtuple
 from config import configure_logging
-from tomt.benchmarks.gt import GTData, get_documents
+from tomt.benchmarks.evaluation import METRICS, RankEvaluator, summarize
+from tomt.benchmarks.gt import GTData, iter_documents
 from tomt.benchmarks.lexical import initialize_from_config as init_lexical
+from tomt.benchmarks.query_pipeline import PROCESSOR_KWARGS, make_query, run_queries
+from tomt.benchmarks.runfile import RunFile, RunWriter
+from tomt.benchmarks.sweep import Sweep, expand_grid, is_grid, tokenize_queries
 from tomt.data import utils
 
 USE_CACHE = True
@@ -22,31 +23,8 @@ Query = namedtuple("Query", ["text", "id"])
 log = logging.getLogger(__name__)
 
 
-def make_query(query, query_type):
-    if query_type == "title_only":
-        text = query["title"]
-    elif query_type == "description_only":
-        text = query["description"]
-    else:
-        text = query["title"] + "\n" + query["description"]
-
-    return {
-        "text": text,
-        "meta": query
-    }
-
-
-def add_scores(qid, scores, resulting_qrels):
-    resulting_qrels[qid] = {}
-    for doc, score in scores:
-        resulting_qrels[qid][doc.id] = score
-
-
-def process_batch(batch, resulting_qrels):
-    query_batch = [(q["meta"]["id"], q["text"]) for q in batch]
-    res = retriever.batch_retrieve(query_batch)
-    for qid, scores in res.items():
-        add_scores(qid, scores, resulting_qrels)
+def add_scores(qid, scores, run_writer):
+    run_writer.add(qid, scores.doc_ids(), scores.scores)
 
 
 def get_data_path(dataset):
@@ -65,22 +43,24 @@ def read_config(config_path):
     log.info(f"Reading config from {config_path}")
     config_json = utils.read_json(config_path)
 
-    for k, v in config_json.items():
-        log.info(f"\t{k:<10} :: {v}")
+    for grid in (config_json if isinstance(config_json, list) else [config_json]):
+        for k, v in grid.items():
+            log.info(f"\t{k:<10} :: {v}")
     return config_json
 
 
 def prepare_documents(args, folder_path, processor):
-    # get documents
+    # stream documents, only the processed documents are kept in memory
     hard_negatives = args.negative_set in {"hn", "all"}
     negatives = args.negative_set in {"neg", "all"}
-    documents = get_documents(os.path.join(folder_path), negatives=negatives, hard_negatives=hard_negatives)
+    documents = iter_documents(os.path.join(folder_path), negatives=negatives, hard_negatives=hard_negatives,
+                               fields=("id", "text", "title", "meta"))
 
     processed_docs = []
     for doc in documents:
         processed_docs.extend(processor.process(doc))
 
-    return documents, processed_docs
+    return processed_docs
 
 
 def load_train_val_data(folder_path):
@@ -139,7 +119,21 @@ def add_common_args(parser):
     parser.add_argument("--dataset", choices={"Movies", "Books", "TestMovies"}, required=True,
                         help="Dataset to test on")
     parser.add_argument("--verbose", action="store_true")
-    parser.add_argument("--config", required=True, help="path to config file")
+    parser.add_argument("--config", required=True,
+                        help="path to config file. If 'wmodel' or any of the 'controls' is a list (or the config is a "
+                             "list of such configs), all combinations are run with the same index (sweep)")
+    parser.add_argument("--index_workers", type=int, default=1,
+                        help="number of processes used to tokenize documents when building the (terrier) index")
+    parser.add_argument("--query_workers", type=int, default=2,
+                        help="number of processes used to clean/tokenize queries (0: no separate processes)")
+    parser.add_argument("--sweep_workers", type=int, default=1,
+                        help="number of configs run concurrently in a sweep (--method native only, Terrier's "
+                             "retrieval isn't known to be thread-safe)")
+    parser.add_argument("--max_query_terms", type=int,
+                        help="keep only this many query terms (highest IDF first), overrides max_query_terms "
+                             "of the config. A list of values in the config is swept")
+    parser.add_argument("--bucket_size", type=int,
+                        help="if set, queries are retrieved in batches of this many queries of similar length")
 
 
 if __name__ == "__main__":
@@ -160,6 +154,8 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     assert not os.path.exists(args.out), f"folder {args.out} already exists"
+    assert args.sweep_workers <= 1 or args.method.startswith("native"), "--sweep_workers > 1 requires --method native"
+    os.makedirs(args.out, exist_ok=False)
 
     configure_logging(f"benchmark-{args.method}", args.verbose)
 
@@ -168,13 +164,18 @@ if __name__ == "__main__":
     folder_path = get_data_path(args.dataset)
 
     start_time = time.time()
-    processor = PreProcessor(clean_empty_lines=True,
-                             clean_whitespace=True,
-                             clean_header_footer=True,
-                             split_by=None,
-                             split_respect_sentence_boundary=True)
+    processor = PreProcessor(**PROCESSOR_KWARGS)
 
     config_json = read_config(args.config)
+    if args.max_query_terms is not None:
+        for grid in (config_json if isinstance(config_json, list) else [config_json]):
+            grid["max_query_terms"] = args.max_query_terms
+    sweep_configs = None
+    if is_grid(config_json):
+        sweep_configs = expand_grid(config_json)
+        log.info(f"Sweep over {len(sweep_configs)} configs")
+        # the retriever (and the index) is set up with the first config, the others reuse it
+        config_json = dict(sweep_configs[0])
 
     if args.method.startswith("elastic"):
         assert args.es_host is not None and args.es_port is not None, "ES args needed"
@@ -184,13 +185,17 @@ if __name__ == "__main__":
     else:
         document_store = InMemoryDocumentStore()
 
-    documents, processed_docs = prepare_documents(args, folder_path, processor)
+    processed_docs = prepare_documents(args, folder_path, processor)
     document_store.write_documents(processed_docs)
 
-    # terrier requires a path to an index
+    # terrier / native require a path to an index
     if args.method.startswith("terrier"):
         config_json[
             "index_path"] = os.path.join(args.common_index_path, "terrier", f"{args.dataset}_{args.negative_set}")
+        config_json["index_workers"] = args.index_workers
+    elif args.method.startswith("native"):
+        config_json[
+            "index_path"] = os.path.join(args.common_index_path, "native", f"{args.dataset}_{args.negative_set}")
     retriever = init_lexical(args.method, args.top_k, document_store, config_json)
 
     if args.phase == "fit":
@@ -199,57 +204,33 @@ if __name__ == "__main__":
         queries, qrel, ids_by_subsets = load_test_data(folder_path)
 
     log.info(f"Phase {args.phase}: {len(queries)}")
-    subset_metrics = {}
-
-    # process queries
-    processed_queries = []
-    resulting_qrels = {}
-
-    batch = []
-    batch_size = 1000
-    successes = []
-    for i, q_dict in enumerate(queries, 1):
-        if i % 100 == 0:
-            log.info(f"\t{i}/{len(queries)} done.")
-
-        q = processor.process(make_query(q_dict, args.query_type))[0]
-        successes.append(q_dict["id"])
-        batch.append(q)
-        if len(batch) >= batch_size:
-            process_batch(batch, resulting_qrels)
-            batch = []
-
-    if len(batch) > 0:
-        process_batch(batch, resulting_qrels)
-        batch = []
-
-    log.info(f"Run took {time.time() - start_time:0.4f}s")
-    log.info(f"N successes:: {len(successes)} out of {len(queries)}")
-    metrics_to_compute = {'recip_rank', 'recall_10', "recall_1"}
-    evaluator = pytrec_eval.RelevanceEvaluator(
-        qrel, metrics_to_compute)
-
-    acc_metrics = defaultdict(list)
-    for qid, res in evaluator.evaluate(resulting_qrels).items():
-        for met in metrics_to_compute:
-            acc_metrics[met].append((qid, res[met]))
-
-    mean_metrics = {}
-    for subset, subset_ids in ids_by_subsets.items():
-        log.info(f"Metrics: {subset}")
-        mean_metrics[subset] = {}
-        for met, all_vals in sorted(acc_metrics.items(), key=lambda _: _[0]):
-            vals = [val for (qid, val) in all_vals if qid in subset_ids]
-            mean_metrics[subset][met] = {
-                "mean": np.mean(vals),
-                "std": np.std(vals)
-            }
-            log.info(f"\t{subset}:: {met}: {round(np.mean(vals), 4)}, ({round(np.std(vals), 4)})")
-
-    os.makedirs(args.out, exist_ok=False)
-
-    utils.write_json(vars(args), os.path.join(args.out, "args.json"), indent=2)
-    utils.write_json(mean_metrics, os.path.join(args.out, "metrics.json"), indent=2)
-    utils.write_json(resulting_qrels, os.path.join(args.out, "out_qrels.json.gzip"), zipped=True)
 
-    log.info(f"Run took {time.time() - start_time:0.4f}s")
+    if sweep_configs is not None:
+        tokenized = tokenize_queries(queries, args.query_type, retriever.query_utils, n_workers=args.query_workers)
+        Sweep(retriever, sweep_configs, qrel, ids_by_subsets, args.out,
+              bucket_size=args.bucket_size).run(tokenized, args.sweep_workers)
+        utils.write_json(vars(args), os.path.join(args.out, "args.json"), indent=2)
+        log.info(f"Sweep took {time.time() - start_time:0.4f}s")
+    else:
+        # process queries: queries are cleaned/tokenized in worker processes while the retriever scores the
+        # previous batch, results are streamed to the run file
+        run_writer = RunWriter(os.path.join(args.out, "run"))
+        n_done = run_queries(retriever, queries, args.query_type, batch_size=1000, n_workers=args.query_workers,
+                             on_results=lambda qid, scores: add_scores(qid, scores, run_writer),
+                             bucket_size=args.bucket_size)
+        run_writer.close()
+
+        log.info(f"Run took {time.time() - start_time:0.4f}s")
+        log.info(f"N successes:: {n_done} out of {len(queries)}")
+        evaluator = RankEvaluator(qrel, METRICS)
+        eval_qids, metric_vals = evaluator.evaluate(RunFile(run_writer.path))
+        mean_metrics = summarize(eval_qids, metric_vals, ids_by_subsets)
+        for subset, subset_metrics in mean_metrics.items():
+            log.info(f"Metrics: {subset}")
+            for met, vals in subset_metrics.items():
+                log.info(f"\t{subset}:: {met}: {round(vals['mean'], 4)}, ({round(vals['std'], 4)})")
+
+        utils.write_json(vars(args), os.path.join(args.out, "args.json"), indent=2)
+        utils.write_json(mean_metrics, os.path.join(args.out, "metrics.json"), indent=2)
+
+        log.info(f"Run took {time.time() - start_time:0.4f}s")
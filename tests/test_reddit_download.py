@@ -0,0 +1,128 @@
+import json
+import os
+import pickle as pkl
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import praw
+    from prawcore import Requestor
+    from tomt.data import reddit
+except ImportError:
+    praw = None
+
+
+def _comment(comment_id, body, replies=""):
+    return {"kind": "t1", "data": {"id": comment_id, "name": f"t1_{comment_id}", "body": body, "author": "someone",
+                                   "created_utc": 1600000000.0, "parent_id": "t3_ok", "link_id": "t3_ok",
+                                   "replies": replies}}
+
+
+def _listing(children):
+    return {"kind": "Listing", "data": {"children": children, "after": None, "before": None}}
+
+
+def _submission(submission_id):
+    return {"kind": "t3", "data": {"id": submission_id, "name": f"t3_{submission_id}", "title": "TOMT [Movie]",
+                                   "selftext": "", "author": "someone", "created_utc": 1600000000.0,
+                                   "link_flair_text": "Solved", "over_18": False, "edited": False,
+                                   "num_comments": 1}}
+
+
+class StubRedditHandler(BaseHTTPRequestHandler):
+    """
+    Serves the token endpoint (reddit_url) and submissions with their comments (oauth_url): "ok" has one comment,
+    "gone" doesn't exist and "slow" has an endless chain of "load more comments"
+    """
+    requests = Counter()
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/api/v1/access_token"):
+            self._send(200, {"access_token": "token", "token_type": "bearer", "expires_in": 3600, "scope": "*"})
+        elif self.path.startswith("/api/morechildren"):
+            StubRedditHandler.requests["morechildren"] += 1
+            time.sleep(0.2)
+            more = {"kind": "more", "data": {"id": "m2", "name": "t1_m2", "count": 1, "children": ["m3"],
+                                             "parent_id": "t3_slow", "depth": 0}}
+            self._send(200, {"json": {"errors": [], "data": {"things": [more]}}})
+        else:
+            self._send(404, {})
+
+    def do_GET(self):
+        submission_id = self.path.split("/comments/")[-1].split("/")[0].split("?")[0]
+        StubRedditHandler.requests[submission_id] += 1
+        if submission_id == "ok":
+            self._send(200, [_listing([_submission("ok")]), _listing([_comment("c1", "solved!")])])
+        elif submission_id == "slow":
+            more = {"kind": "more", "data": {"id": "m1", "name": "t1_m1", "count": 1, "children": ["m2"],
+                                             "parent_id": "t3_slow", "depth": 0}}
+            self._send(200, [_listing([_submission("slow")]), _listing([more])])
+        else:
+            self._send(404, {"message": "Not Found", "error": 404})
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(praw is None, "praw is not installed")
+class DownloadSubmissionsTest(unittest.TestCase):
+    def setUp(self):
+        StubRedditHandler.requests.clear()
+        # no update check (a request to PyPI) when the praw.Reddit instances are created
+        env = mock.patch.dict(os.environ, {"praw_check_for_updates": "False"})
+        env.start()
+        self.addCleanup(env.stop)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubRedditHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.folder = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.folder, "config.json")
+        with open(self.config_file, "w") as writer:
+            json.dump({"client_id": "id", "client_secret": "secret", "oauth_url": url, "reddit_url": url}, writer)
+        self.submissions_file = os.path.join(self.folder, "submissions.json")
+        with open(self.submissions_file, "w") as writer:
+            json.dump([{"id": "ok"}, {"id": "gone"}, {"id": "slow"}], writer)
+        self.output_folder = os.path.join(self.folder, "pickles")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def test_download(self):
+        failures = reddit.download_submissions(self.config_file, self.submissions_file, self.output_folder,
+                                               timeout=1, n_workers=3, requests_per_second=100, retries=2)
+        self.assertEqual(failures, {"NotFound": ["gone"], "TimeoutException": ["slow"]})
+        self.assertEqual(os.listdir(self.output_folder), ["ok.pkl"])
+        # skipped submissions aren't retried
+        self.assertEqual(StubRedditHandler.requests["gone"], 1)
+        self.assertEqual(StubRedditHandler.requests["slow"], 1)
+        self.assertGreater(StubRedditHandler.requests["morechildren"], 0)
+
+        with open(os.path.join(self.output_folder, "ok.pkl"), "rb") as reader:
+            submission = pkl.load(reader)
+        self.assertEqual(submission.id, "ok")
+        self.assertEqual([c.body for c in submission.comments], ["solved!"])
+        # pickled without the rate limiter
+        requestor = submission._reddit._core._requestor
+        self.assertIs(type(requestor), Requestor)
+        self.assertFalse(hasattr(requestor, "rate_limiter"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import os
+import logging
+from array import array
+
+import numpy as np
+
+from tomt.data import utils
+
+log = logging.getLogger(__name__)
+
+# files making up a columnar (CSR) export of an index
+TERMS_FILE = "terms.json"
+DOCIDS_FILE = "docids.json"
+META_FILE = "meta.json"
+OFFSETS_FILE = "offsets.npy"
+DOCNOS_FILE = "docnos.npy"
+TFS_FILE = "tfs.npy"
+CF_FILE = "cf.npy"
+DOC_LENGTHS_FILE = "doc_lengths.npy"
+DOC_N_UNIQUE_TERMS_FILE = "doc_n_unique_terms.npy"
+
+
+def columnar_exists(folder):
+    return os.path.exists(os.path.join(folder, META_FILE))
+
+
+class ColumnarIndexWriter:
+    """
+    Writes postings term by term into a CSR layout:
+        postings of term t are docnos[offsets[t]:offsets[t + 1]] (and the same slice of tfs)
+    Postings are accumulated in compact typed arrays, not python lists
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.terms = []
+        self.offsets = array("q", [0])
+        self.docnos = array("i")
+        self.tfs = array("i")
+        self.cf = array("q")
+
+    def add_term(self, term, docnos, tfs):
+        self.terms.append(term)
+        self.docnos.extend(docnos)
+        self.tfs.extend(tfs)
+        self.offsets.append(len(self.docnos))
+        self.cf.append(sum(tfs))
+
+    def close(self, docids, doc_lengths, doc_n_unique_terms):
+        assert len(docids) == len(doc_lengths) == len(doc_n_unique_terms)
+        os.makedirs(self.folder, exist_ok=True)
+
+        # terms are stored in sorted order, so that they can be binary searched if required
+        order = sorted(range(len(self.terms)), key=lambda _: self.terms[_])
+        offsets = np.frombuffer(self.offsets, dtype=np.int64)
+        docnos = np.frombuffer(self.docnos, dtype=np.int32)
+        tfs = np.frombuffer(self.tfs, dtype=np.int32)
+        starts, ends = offsets[:-1][order], offsets[1:][order]
+        lengths = ends - starts
+
+        sorted_offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=sorted_offsets[1:])
+        # gather the postings of every term (in sorted term order) in one pass
+        gather = np.repeat(starts - sorted_offsets[:-1], lengths) + np.arange(len(docnos), dtype=np.int64)
+
+        np.save(os.path.join(self.folder, OFFSETS_FILE), sorted_offsets)
+        np.save(os.path.join(self.folder, DOCNOS_FILE), docnos[gather])
+        np.save(os.path.join(self.folder, TFS_FILE), tfs[gather])
+        np.save(os.path.join(self.folder, CF_FILE), np.frombuffer(self.cf, dtype=np.int64)[order])
+        np.save(os.path.join(self.folder, DOC_LENGTHS_FILE), np.asarray(doc_lengths, dtype=np.int32))
+        np.save(os.path.join(self.folder, DOC_N_UNIQUE_TERMS_FILE), np.asarray(doc_n_unique_terms, dtype=np.int32))
+        utils.write_json([self.terms[_] for _ in order], os.path.join(self.folder, TERMS_FILE))
+        utils.write_json(list(docids), os.path.join(self.folder, DOCIDS_FILE))
+
+        # written last: its presence marks a complete export
+        utils.write_json({
+            "n_terms": len(order),
+            "n_docs": len(docids),
+            "n_postings": len(docnos),
+            "total_frequency": int(np.sum(doc_lengths, dtype=np.int64))
+        }, os.path.join(self.folder, META_FILE), indent=2)
+
+        log.info(f"Wrote {len(order)} terms, {len(docnos)} postings for {len(docids)} documents to {self.folder}")
+
+
+class ColumnarIndex:
+    """
+    Read-only, memory-mapped view of an index written by ColumnarIndexWriter.
+    Postings lookups are (zero-copy) slices of the memory-mapped arrays
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        meta = utils.read_json(os.path.join(folder, META_FILE))
+
+        self.terms = utils.read_json(os.path.join(folder, TERMS_FILE))
+        self.term_to_termid = {t: i for i, t in enumerate(self.terms)}
+        self.docids = utils.read_json(os.path.join(folder, DOCIDS_FILE))
+        self.docid_to_docno = {d: i for i, d in enumerate(self.docids)}
+
+        self.offsets = self._load(OFFSETS_FILE)
+        self.docnos = self._load(DOCNOS_FILE)
+        self.tfs = self._load(TFS_FILE)
+        self.cf = self._load(CF_FILE)
+        self.doc_lengths = self._load(DOC_LENGTHS_FILE)
+        self.doc_n_unique_terms = self._load(DOC_N_UNIQUE_TERMS_FILE)
+
+        self.n_terms = meta["n_terms"]
+        self.n_docs = meta["n_docs"]
+        self.total_frequency = meta["total_frequency"]
+        self.mean_doc_length = self.total_frequency / self.n_docs
+
+        assert len(self.terms) == self.n_terms and len(self.docids) == self.n_docs
+
+    def _load(self, fname):
+        return np.load(os.path.join(self.folder, fname), mmap_mode="r")
+
+    def get_termid(self, term):
+        return self.term_to_termid.get(term)
+
+    def get_postings(self, term):
+        """
+        Returns (docnos, tfs) of the term, both are views into the memory-mapped arrays
+        """
+        termid = self.get_termid(term)
+        if termid is None:
+            return self.docnos[:0], self.tfs[:0]
+        start, end = self.offsets[termid], self.offsets[termid + 1]
+        return self.docnos[start:end], self.tfs[start:end]
+
+    def get_df(self, term):
+        termid = self.get_termid(term)
+        if termid is None:
+            return 0
+        return int(self.offsets[termid + 1] - self.offsets[termid])
+
+    def get_collection_tf(self, term):
+        termid = self.get_termid(term)
+        if termid is None:
+            return 0
+        return int(self.cf[termid])
@@ -0,0 +1,108 @@
+import logging
+import re
+
+import numpy as np
+
+from tomt.benchmarks.runfile import RunFile
+
+log = logging.getLogger(__name__)
+
+# names are the same as pytrec_eval's
+METRICS = ("recip_rank", "recall_1", "recall_10")
+CUTOFF_RE = re.compile(r"^(recall|success|P)_(\d+)$")
+
+
+def gold_rank(scores, gold_doc_id):
+    """
+    1-based rank of gold_doc_id in scores (doc_id -> score), 0 if it wasn't retrieved.
+    Ties are broken like trec_eval: by doc_id, in descending order
+    """
+    gold_score = scores.get(gold_doc_id)
+    if gold_score is None:
+        return 0
+    values = np.fromiter(scores.values(), dtype=np.float64, count=len(scores))
+    rank = 1 + int(np.count_nonzero(values > gold_score))
+    ties = np.flatnonzero(values == gold_score)
+    if len(ties) > 1:
+        doc_ids = list(scores.keys())
+        rank += sum(1 for i in ties.tolist() if doc_ids[i] > gold_doc_id)
+    return rank
+
+
+def run_gold_rank(run, qid, gold_doc_id):
+    """
+    gold_rank for a query of a run, which is either a dict (qid -> {doc_id: score}) or a RunFile
+    """
+    if isinstance(run, RunFile):
+        return run.gold_rank(qid, gold_doc_id)
+    return gold_rank(run[qid], gold_doc_id)
+
+
+def metric_values(ranks, metric):
+    """
+    Values of a metric for every query, given the rank of the (single) relevant document of each query
+    """
+    ranks = np.asarray(ranks)
+    retrieved = ranks > 0
+    if metric == "recip_rank":
+        return np.divide(1.0, ranks, out=np.zeros(len(ranks)), where=retrieved)
+    m = CUTOFF_RE.match(metric)
+    if m is None:
+        raise ValueError(f"unsupported metric: {metric}")
+    k = int(m.group(2))
+    hit = (retrieved & (ranks <= k)).astype(np.float64)
+    if m.group(1) == "P":
+        return hit / k
+    # with a single relevant document, recall@k == success@k
+    return hit
+
+
+class RankEvaluator:
+    """
+    Evaluator for qrels with exactly one relevant document per query. The rank of the relevant document is
+    computed once per query, every metric is then derived from these ranks in a single vectorized pass.
+    Drop-in for pytrec_eval.RelevanceEvaluator for the metrics in METRICS
+    """
+
+    def __init__(self, qrel, metrics=METRICS):
+        # qid -> gold doc_id; accepts pytrec_eval style qrels (qid -> {doc_id: relevance})
+        self.gold = {}
+        for qid, rel in qrel.items():
+            if isinstance(rel, dict):
+                relevant = [doc_id for doc_id, r in rel.items() if r > 0]
+                assert len(relevant) == 1, f"{qid} has {len(relevant)} relevant documents"
+                self.gold[qid] = relevant[0]
+            else:
+                self.gold[qid] = rel
+        self.metrics = sorted(metrics)
+
+    def gold_ranks(self, run):
+        """
+        run: qid -> {doc_id: score}, or a RunFile. Returns (qids, ranks) for the queries in the run that have a qrel
+        """
+        qids = [qid for qid in run if qid in self.gold]
+        ranks = np.array([run_gold_rank(run, qid, self.gold[qid]) for qid in qids], dtype=np.int64)
+        return np.array(qids, dtype=object), ranks
+
+    def evaluate(self, run):
+        """
+        Returns (qids, metric -> array of per-query values, aligned with qids)
+        """
+        qids, ranks = self.gold_ranks(run)
+        return qids, {met: metric_values(ranks, met) for met in self.metrics}
+
+
+def summarize(qids, values, ids_by_subsets=None):
+    """
+    subset -> metric -> {"mean", "std"}. Subsets are boolean masks over qids.
+    If ids_by_subsets is None, metric -> {"mean", "std"} over all queries is returned
+    """
+    if ids_by_subsets is None:
+        return {met: {"mean": np.mean(vals), "std": np.std(vals)} for met, vals in sorted(values.items())}
+
+    summary = {}
+    for subset, subset_ids in ids_by_subsets.items():
+        mask = np.fromiter((qid in subset_ids for qid in qids), dtype=bool, count=len(qids))
+        summary[subset] = {met: {"mean": np.mean(vals[mask]), "std": np.std(vals[mask])}
+                           for met, vals in sorted(values.items())}
+    return summary
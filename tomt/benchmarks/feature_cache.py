@@ -0,0 +1,156 @@
+import logging
+import os
+import time
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+from tomt.benchmarks.native import bm25_query_weights, bm25_term_weights, pl2_term_weights
+from tomt.benchmarks.runfile import RunWriter
+from tomt.data import utils
+
+log = logging.getLogger(__name__)
+
+FEATURES_FILE = "features.npz"
+HEADER_FILE = "feature_cache.json"
+
+
+class FeatureCache:
+    """
+    Lexical features of a fixed candidate pool (e.g. the BM25 top-1000 of every query): for every (query, candidate)
+    pair, the tf of each query term, the doc length and the original score, plus df / cf of every query term.
+    Weighting models are applied to these arrays directly (vectorized), without going back to the index.
+
+    Pairs are stored query by query (pair_offsets). The (pair, term) features are stored in COO form:
+    pair_rows, term_ids, tf and the query term frequency qtf, see tf_matrix() for the sparse (pairs x terms) matrix
+    """
+    ARRAYS = ("pair_offsets", "doc_ids", "doc_lengths", "base_scores", "pair_rows", "term_ids", "tf", "qtf",
+              "df", "cf")
+
+    def __init__(self, qids, terms, stats, arrays):
+        self.qids = qids
+        self.terms = terms
+        # collection statistics of the index: n_docs, mean_doc_length, total_frequency
+        self.stats = stats
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @property
+    def n_pairs(self):
+        return len(self.doc_ids)
+
+    @classmethod
+    def build(cls, index, process_term, queries, results):
+        """
+        index: a TerrierIndex (preferably columnar), process_term: token -> lexicon term (None for stopwords),
+        queries: [(qid, tokens)], results: qid -> RankedList (the candidate pool)
+        """
+        start_time = time.time()
+        term_to_id = {}
+        qids, pair_offsets, doc_ids, docnos, base_scores = [], [0], [], [], []
+        pair_rows, term_ids, tfs, qtfs = [], [], [], []
+        for qid, tokens in queries:
+            ranked = results.get(qid)
+            if ranked is None:
+                continue
+            cand_doc_ids = np.array(ranked.doc_ids())
+            cand_docnos = index.get_docnos(cand_doc_ids)
+            pair_start = pair_offsets[-1]
+            terms = Counter(t for t in (process_term(tok) for tok in tokens) if t is not None)
+            for term, qtf in terms.items():
+                p_docnos, p_tfs = index.get_postings(term)
+                if len(p_docnos) == 0:
+                    continue
+                # postings are sorted by docno
+                pos = np.minimum(np.searchsorted(p_docnos, cand_docnos), len(p_docnos) - 1)
+                hit = np.flatnonzero(p_docnos[pos] == cand_docnos)
+                pair_rows.append(pair_start + hit)
+                term_ids.append(np.full(len(hit), term_to_id.setdefault(term, len(term_to_id)), dtype=np.int32))
+                tfs.append(np.asarray(p_tfs[pos[hit]], dtype=np.float32))
+                qtfs.append(np.full(len(hit), qtf, dtype=np.float32))
+
+            qids.append(qid)
+            doc_ids.append(cand_doc_ids)
+            docnos.append(cand_docnos)
+            base_scores.append(np.asarray(ranked.scores, dtype=np.float32))
+            pair_offsets.append(pair_start + len(cand_doc_ids))
+
+        terms = list(term_to_id.keys())
+
+        def concat(arrays, dtype):
+            return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype=dtype)
+
+        arrays = {
+            "pair_offsets": np.array(pair_offsets, dtype=np.int64),
+            "doc_ids": np.concatenate(doc_ids) if doc_ids else np.zeros(0, dtype=str),
+            "doc_lengths": index.doc_lengths[concat(docnos, np.int64)].astype(np.float64),
+            "base_scores": concat(base_scores, np.float32),
+            "pair_rows": concat(pair_rows, np.int64),
+            "term_ids": concat(term_ids, np.int32),
+            "tf": concat(tfs, np.float32),
+            "qtf": concat(qtfs, np.float32),
+            "df": np.array([index.get_df(t) for t in terms], dtype=np.float64),
+            "cf": np.array([index.get_collection_tf(t) for t in terms], dtype=np.float64)
+        }
+        stats = {"n_docs": int(index.n_docs), "mean_doc_length": float(index.mean_doc_length),
+                 "total_frequency": int(index.total_frequency)}
+        cache = cls(qids, terms, stats, arrays)
+        log.info(f"Built feature cache: {len(qids)} queries, {cache.n_pairs} pairs, {len(terms)} terms, "
+                 f"{len(cache.tf)} (pair, term) entries in {time.time() - start_time:0.2f}s")
+        return cache
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        np.savez(os.path.join(folder, FEATURES_FILE), **{name: getattr(self, name) for name in self.ARRAYS})
+        utils.write_json({"qids": self.qids, "terms": self.terms, "stats": self.stats},
+                         os.path.join(folder, HEADER_FILE))
+
+    @classmethod
+    def load(cls, folder):
+        header = utils.read_json(os.path.join(folder, HEADER_FILE))
+        with np.load(os.path.join(folder, FEATURES_FILE)) as arrays:
+            return cls(header["qids"], header["terms"], header["stats"], dict(arrays))
+
+    def tf_matrix(self):
+        """
+        Sparse (pairs x terms) term frequency matrix
+        """
+        return sparse.csr_matrix((self.tf, (self.pair_rows, self.term_ids)), shape=(self.n_pairs, len(self.terms)))
+
+    def score(self, weights):
+        """
+        Sums per (pair, term) weights into one score per pair
+        """
+        return np.bincount(self.pair_rows, weights=weights, minlength=self.n_pairs)
+
+    def bm25(self, k_1=1.2, b=0.75, k_3=8.0):
+        w = bm25_term_weights(self.tf, self.doc_lengths[self.pair_rows], self.df[self.term_ids],
+                              self.stats["n_docs"], self.stats["mean_doc_length"], k_1, b)
+        return self.score(w * bm25_query_weights(self.qtf, k_3))
+
+    def pl2(self, c=1.0):
+        w = pl2_term_weights(self.tf, self.doc_lengths[self.pair_rows], self.cf[self.term_ids],
+                             self.stats["n_docs"], self.stats["mean_doc_length"], c)
+        return self.score(w * self.qtf)
+
+    def rank(self, scores, top_k=None):
+        """
+        Yields (qid, doc_ids, scores) for every query, sorted by decreasing score. Candidates without any matching
+        term keep score 0
+        """
+        for i, qid in enumerate(self.qids):
+            start, end = self.pair_offsets[i], self.pair_offsets[i + 1]
+            order = np.argsort(-scores[start:end], kind="stable")[:top_k]
+            yield qid, self.doc_ids[start:end][order], scores[start:end][order]
+
+    def to_run(self, scores, top_k=None):
+        """
+        qid -> {doc_id: score}, e.g. for RankEvaluator
+        """
+        return {qid: dict(zip(doc_ids.tolist(), s.tolist())) for qid, doc_ids, s in self.rank(scores, top_k)}
+
+    def write_run(self, scores, path, top_k=None):
+        with RunWriter(path) as writer:
+            for qid, doc_ids, s in self.rank(scores, top_k):
+                writer.add(qid, doc_ids.tolist(), s)
@@ -0,0 +1,222 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from tomt.benchmarks.runfile import RunFile, RunWriter, is_run_folder
+from tomt.data import utils
+
+log = logging.getLogger(__name__)
+
+FUSION_METHODS = ("rrf", "linear")
+# constant of reciprocal rank fusion, as in Cormack et al. (2009)
+RRF_K = 60
+
+
+class DenseRetriever:
+    """
+    Inner product search over DPR document embeddings (DPR/README.md: index.npy + id2doc.json), for queries whose
+    embeddings were precomputed (DPR/eval_retrieval.py --save-q-embeds). Uses FAISS if it is installed
+    """
+
+    def __init__(self, index_path, id2doc_path, query_embeddings_path, top_k):
+        self.top_k = top_k
+        doc_embeddings = np.load(index_path).astype(np.float32)
+        id2doc = utils.read_json(id2doc_path)
+        # faiss index -> doc_id (the title of the DPR document)
+        self.doc_ids = np.array([id2doc[str(i)][0] for i in range(len(id2doc))])
+        with np.load(query_embeddings_path) as q:
+            self.qid_to_row = {qid: i for i, qid in enumerate(q["qids"].tolist())}
+            self.query_embeddings = q["embeddings"].astype(np.float32)
+
+        try:
+            import faiss
+            self.index = faiss.IndexFlatIP(doc_embeddings.shape[1])
+            self.index.add(doc_embeddings)
+            self.doc_embeddings = None
+        except ImportError:
+            log.warning("faiss is not installed, using (exact) numpy search")
+            self.index = None
+            self.doc_embeddings = doc_embeddings
+
+    def search(self, embeddings):
+        if self.index is not None:
+            return self.index.search(embeddings, self.top_k)
+        scores = embeddings @ self.doc_embeddings.T
+        k = min(self.top_k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        return np.take_along_axis(top_scores, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+    def batch_retrieve(self, qids):
+        """
+        qid -> (doc_ids, scores), sorted by decreasing score. Queries without an embedding are absent
+        """
+        qids = [qid for qid in qids if qid in self.qid_to_row]
+        if len(qids) == 0:
+            return {}
+        D, I = self.search(self.query_embeddings[[self.qid_to_row[qid] for qid in qids]])
+        results = {}
+        for qid, scores, indices in zip(qids, D, I):
+            # faiss pads with -1 if the index has less than top_k documents
+            valid = indices >= 0
+            results[qid] = (self.doc_ids[indices[valid]], scores[valid])
+        return results
+
+
+class LexicalSide:
+    """
+    Adapts a lexical retriever (TerrierRetriever / NativeRetriever) to qid -> (doc_ids, scores)
+    """
+
+    def __init__(self, retriever, batch_size=1000):
+        self.retriever = retriever
+        self.batch_size = batch_size
+
+    def batch_retrieve(self, queries):
+        results = {}
+        for i in range(0, len(queries), self.batch_size):
+            for qid, ranked in self.retriever.batch_retrieve_tokenized(queries[i:i + self.batch_size]).items():
+                results[qid] = (np.array(ranked.doc_ids()), np.asarray(ranked.scores))
+        return results
+
+
+def _load_candidates(path):
+    run = RunFile(path)
+    docids = np.array(run.docids)
+    results = {}
+    for qid in run:
+        doc_indices, scores = run.get_arrays(qid)
+        results[qid] = (docids[doc_indices], np.asarray(scores))
+    return results
+
+
+def _save_candidates(results, path):
+    with RunWriter(path) as writer:
+        for qid, (doc_ids, scores) in results.items():
+            writer.add(qid, doc_ids.tolist(), scores)
+
+
+class AlignedCandidates:
+    """
+    Candidate lists of several retrievers, aligned on the union of their documents (per query): one row per
+    (query, document), with the rank (0: not retrieved) and the min-max normalized score of every retriever.
+    Fusion is then a few vectorized operations, so fusion parameters can be re-tuned cheaply
+    """
+
+    def __init__(self, candidates):
+        """
+        candidates: one qid -> (doc_ids, scores) dict per retriever, results sorted by decreasing score
+        """
+        n_sides = len(candidates)
+        self.qids = sorted(set().union(*candidates))
+        offsets, doc_ids, ranks, scores = [0], [], [], []
+        for qid in self.qids:
+            lists = [c.get(qid, (np.zeros(0, dtype=str), np.zeros(0))) for c in candidates]
+            union, inverse = np.unique(np.concatenate([d for d, _ in lists]), return_inverse=True)
+            q_ranks = np.zeros((len(union), n_sides), dtype=np.int32)
+            q_scores = np.zeros((len(union), n_sides), dtype=np.float64)
+            start = 0
+            for side, (d, s) in enumerate(lists):
+                rows = inverse[start:start + len(d)]
+                start += len(d)
+                q_ranks[rows, side] = np.arange(1, len(d) + 1)
+                if len(s) > 0:
+                    s = np.asarray(s, dtype=np.float64)
+                    spread = s.max() - s.min()
+                    q_scores[rows, side] = (s - s.min()) / spread if spread > 0 else 1.0
+            offsets.append(offsets[-1] + len(union))
+            doc_ids.append(union)
+            ranks.append(q_ranks)
+            scores.append(q_scores)
+
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.doc_ids = np.concatenate(doc_ids) if doc_ids else np.zeros(0, dtype=str)
+        self.ranks = np.concatenate(ranks) if ranks else np.zeros((0, n_sides), dtype=np.int32)
+        self.scores = np.concatenate(scores) if scores else np.zeros((0, n_sides))
+
+    def fuse(self, method="rrf", weights=None, rrf_k=RRF_K):
+        """
+        Fused score of every (query, document) row. rrf: sum of weight / (rrf_k + rank) over the retrievers that
+        retrieved the document, linear: weighted sum of the normalized scores (0 if not retrieved)
+        """
+        weights = np.ones(self.ranks.shape[1]) if weights is None else np.asarray(weights, dtype=np.float64)
+        if method == "rrf":
+            retrieved = self.ranks > 0
+            return (np.where(retrieved, 1.0 / (rrf_k + self.ranks), 0.0) * weights).sum(axis=1)
+        elif method == "linear":
+            return (self.scores * weights).sum(axis=1)
+        raise ValueError(f"unsupported fusion method: {method}")
+
+    def rank(self, fused, top_k=None):
+        """
+        Yields (qid, doc_ids, scores) for every query, sorted by decreasing fused score
+        """
+        for i, qid in enumerate(self.qids):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            order = np.argsort(-fused[start:end], kind="stable")[:top_k]
+            yield qid, self.doc_ids[start:end][order], fused[start:end][order]
+
+    def to_run(self, fused, top_k=None):
+        return {qid: dict(zip(doc_ids.tolist(), s.tolist())) for qid, doc_ids, s in self.rank(fused, top_k)}
+
+
+class HybridRetriever:
+    """
+    Runs a lexical and a dense retriever concurrently (threads: retrieval happens in the JVM / NumPy / FAISS) and fuses
+    their rankings. Candidate lists are cached as run folders in cache_folder ({cache_folder}/lexical, /dense), so
+    that fusion can be re-tuned without retrieving again
+    """
+
+    def __init__(self, lexical_retriever, dense_retriever, cache_folder=None, top_k=1000):
+        self.sides = {"lexical": LexicalSide(lexical_retriever), "dense": dense_retriever}
+        self.cache_folder = cache_folder
+        self.top_k = top_k
+
+    def _retrieve_side(self, name, queries):
+        path = os.path.join(self.cache_folder, name) if self.cache_folder is not None else None
+        if path is not None and is_run_folder(path):
+            log.info(f"Loading {name} candidates from {path}")
+            return _load_candidates(path), None
+
+        start_time = time.time()
+        side_queries = queries if name == "lexical" else [qid for qid, _ in queries]
+        results = self.sides[name].batch_retrieve(side_queries)
+        elapsed = time.time() - start_time
+        if path is not None:
+            _save_candidates(results, path)
+        return results, elapsed
+
+    def candidates(self, queries):
+        """
+        queries: [(qid, tokens)]. Returns AlignedCandidates of the lexical and dense candidate lists
+        """
+        start_time = time.time()
+        with ThreadPoolExecutor(len(self.sides)) as executor:
+            futures = {name: executor.submit(self._retrieve_side, name, queries) for name in self.sides}
+            results = {name: f.result() for name, f in futures.items()}
+        for name, (res, elapsed) in results.items():
+            if elapsed is None:
+                log.info(f"{name}: {len(res)} queries (cached)")
+            else:
+                log.info(f"{name}: {len(res)} queries in {elapsed:0.2f}s "
+                         f"({1000 * elapsed / max(len(queries), 1):0.2f}ms/query)")
+
+        align_start = time.time()
+        aligned = AlignedCandidates([res for res, _ in results.values()])
+        log.info(f"Aligning candidates took {time.time() - align_start:0.2f}s, "
+                 f"total (wall) {time.time() - start_time:0.2f}s")
+        return aligned
+
+    def batch_retrieve(self, queries, method="rrf", weights=None, rrf_k=RRF_K):
+        """
+        qid -> {doc_id: fused score} (top_k per query)
+        """
+        aligned = self.candidates(queries)
+        start_time = time.time()
+        run = aligned.to_run(aligned.fuse(method, weights, rrf_k), self.top_k)
+        log.info(f"Fusion ({method}) took {time.time() - start_time:0.2f}s")
+        return run
@@ -1,28 +1,72 @@
 import os
 
-from tomt.data.utils import read_jsonl, read_qrels, read_json
+from tomt.data.corpus import CORPUS_FOLDER, Corpus, corpus_up_to_date
+from tomt.data.utils import iter_jsonl, read_jsonl, read_qrels, read_json
 
 
-def get_documents(folder_path, hard_negatives=False, negatives=False, return_type_dict=False):
-    fpath = os.path.join(folder_path, "documents.json")
-    documents = read_jsonl(fpath)
-    type_dict = {d["id"]: "pos" for d in documents}
-
+def _doc_types(hard_negatives, negatives):
+    doc_types = ["pos"]
     if negatives:
-        neg_docs = read_jsonl(os.path.join(folder_path, "negative_documents.json"))
-        documents.extend(neg_docs)
-        type_dict.update({d["id"]: "neg" for d in neg_docs})
-
+        doc_types.append("neg")
     if hard_negatives:
-        hard_neg = read_jsonl(os.path.join(folder_path, "hard_negative_documents.json"))
-        documents.extend(hard_neg)
-        type_dict.update({d["id"]: "hard_neg" for d in hard_neg})
+        doc_types.append("hard_neg")
+    return doc_types
+
+
+def iter_documents(folder_path, hard_negatives=False, negatives=False, fields=None, with_type=False):
+    """
+    Streams documents (positives, then negatives, then hard negatives), without loading the collection into memory.
+    fields: keys to keep, e.g. ("id", "text"); with_type: yield (document, type) pairs.
+    Documents are read from the binary corpus (see create_corpus.py) if it is up to date, from the JSONL files
+    otherwise
+    """
+    if corpus_up_to_date(folder_path):
+        corpus = Corpus(os.path.join(folder_path, CORPUS_FOLDER))
+        for index in corpus.select(_doc_types(hard_negatives, negatives)).indices.tolist():
+            view = corpus[index]
+            doc = dict(view) if fields is None else {k: view[k] for k in fields if k in view}
+            yield (doc, corpus.type_of(index)) if with_type else doc
+        return
+
+    files = [("documents.json", "pos")]
+    if negatives:
+        files.append(("negative_documents.json", "neg"))
+    if hard_negatives:
+        files.append(("hard_negative_documents.json", "hard_neg"))
+
+    for fname, doc_type in files:
+        for doc in iter_jsonl(os.path.join(folder_path, fname), fields, fast=True):
+            yield (doc, doc_type) if with_type else doc
+
+
+def get_documents(folder_path, hard_negatives=False, negatives=False, return_type_dict=False):
+    documents = []
+    type_dict = {}
+    for doc, doc_type in iter_documents(folder_path, hard_negatives=hard_negatives, negatives=negatives,
+                                        with_type=True):
+        documents.append(doc)
+        type_dict[doc["id"]] = doc_type
 
     if return_type_dict:
         return documents, type_dict
     return documents
 
 
+def get_corpus(folder_path, hard_negatives=False, negatives=False, return_type_dict=False):
+    """
+    Same as get_documents, but if the binary corpus is up to date (see create_corpus.py), documents are read-only
+    mappings into it, decoded on access, instead of dicts. Falls back to get_documents otherwise
+    """
+    if not corpus_up_to_date(folder_path):
+        return get_documents(folder_path, hard_negatives=hard_negatives, negatives=negatives,
+                             return_type_dict=return_type_dict)
+
+    documents = Corpus(os.path.join(folder_path, CORPUS_FOLDER)).select(_doc_types(hard_negatives, negatives))
+    if return_type_dict:
+        return documents, documents.type_dict()
+    return documents
+
+
 class GTData:
     def __init__(self, folder_path):
         self.folder_path = folder_path
@@ -1,11 +1,15 @@
 import logging
-from tomt.benchmarks.terrier import TerrierRetriever
 
 log = logging.getLogger(__name__)
 
 
 def initialize_from_config(method, top_k, document_store, config_json):
+    # imports are local: importing the terrier module starts the JVM
     if method.startswith("terrier"):
+        from tomt.benchmarks.terrier import TerrierRetriever
         return TerrierRetriever(document_store, config_json, top_k=top_k)
+    elif method.startswith("native"):
+        from tomt.benchmarks.native import NativeRetriever
+        return NativeRetriever(document_store, config_json, top_k=top_k)
     else:
         raise ValueError(method)
@@ -1,14 +1,66 @@
 import re
 import os
-from tomt.data import utils as data_utils
+import time
+import logging
+import resource
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from tomt.benchmarks.token_cache import TokenCache, cache_key
 import spacy
 
 DISABLE = ["tok2vec", "parser", "ner"]
 SPACY_MODEL = "en_core_web_md"
 
+log = logging.getLogger(__name__)
+
 SQ_RE = re.compile(r"\[.*\]")
 CACHE_FOLDER = "./dataset/tokenized_data/"
-os.makedirs(CACHE_FOLDER, exist_ok=True)
+CACHE_PATH = os.path.join(CACHE_FOLDER, "tokens.sqlite")
+# number of tokenized texts kept in memory, in front of the on-disk cache
+CACHE_LRU_SIZE = 50000
+
+_token_cache = None
+
+
+def get_token_cache():
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = TokenCache(CACHE_PATH, lru_size=CACHE_LRU_SIZE)
+    return _token_cache
+
+
+# (model, excluded components) -> loaded spacy pipeline, shared by everything in this process
+_spacy_models = {}
+_spacy_models_lock = threading.Lock()
+
+
+def _rss_mb():
+    # current RSS if available (linux), peak RSS otherwise
+    try:
+        with open("/proc/self/status") as reader:
+            for line in reader:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_spacy_model(model=SPACY_MODEL, exclude=()):
+    """
+    Loads a spacy pipeline on first use, later calls (with the same config) return the same instance
+    """
+    key = (model, tuple(sorted(exclude)))
+    with _spacy_models_lock:
+        if key not in _spacy_models:
+            rss_before = _rss_mb()
+            start_time = time.time()
+            _spacy_models[key] = spacy.load(model, exclude=list(exclude))
+            log.info(f"Loaded spacy model {model} (exclude={list(exclude)}) in {time.time() - start_time:0.2f}s, "
+                     f"RSS: {rss_before:0.1f}MB -> {_rss_mb():0.1f}MB")
+        return _spacy_models[key]
 
 
 def get_std_utils():
@@ -19,26 +71,52 @@ class Utils:
     def __init__(self, remove_square_braces=False, incl_only_alphanumeric=False):
         self.remove_square_braces = remove_square_braces
         self.incl_only_alphanumeric = incl_only_alphanumeric
-        self.nlp = spacy.load(SPACY_MODEL, exclude=DISABLE)
 
-    def tokenize_with_cache(self, text, id_, lemmatize=True):
-        ppath = os.path.join(CACHE_FOLDER,
-                             f"{self.remove_square_braces}_{self.incl_only_alphanumeric}_{lemmatize}_{id_}.pkl")
+    @property
+    def nlp(self):
+        return get_spacy_model(SPACY_MODEL, DISABLE)
 
-        if os.path.exists(ppath):
-            return data_utils.load_pickle(ppath)
+    def settings(self):
+        # everything that affects the tokens (lemmatization is always on for indexing)
+        return {"spacy_model": SPACY_MODEL, "remove_square_braces": self.remove_square_braces,
+                "incl_only_alphanumeric": self.incl_only_alphanumeric}
 
-        tokens = self.tokenize(text, lemmatize)
-        data_utils.write_pickle(tokens, ppath)
+    def _cache_key(self, text, lemmatize):
+        return cache_key(text, SPACY_MODEL, self.remove_square_braces, self.incl_only_alphanumeric, lemmatize)
 
-        return tokens
+    def tokenize_with_cache(self, text, id_=None, lemmatize=True):
+        # id_ is kept for backwards compatibility, entries are keyed on the text itself
+        return self.tokenize_many_with_cache([text], lemmatize=lemmatize)[0]
 
-    def tokenize(self, text, lemmatize=True):
+    def tokenize_many_with_cache(self, texts, lemmatize=True, batch_size=256):
+        """
+        Tokenizes texts, using (and updating) the token cache. Returns a list of token lists
+        """
+        texts = list(texts)
+        cache = get_token_cache()
+        keys = [self._cache_key(text, lemmatize) for text in texts]
+        cached = cache.get_many(set(keys))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing[key] = text
+        if len(missing) > 0:
+            tokenized = self.tokenize_many(missing.values(), batch_size=batch_size, lemmatize=lemmatize)
+            new_entries = list(zip(missing.keys(), tokenized))
+            cache.put_many(new_entries)
+            cached.update(new_entries)
+
+        return [cached[key] for key in keys]
+
+    def clean_text(self, text):
         if self.remove_square_braces:
             text = SQ_RE.sub("", text)
-        text = self.nlp(text)
+        return text
+
+    def filter_tokens(self, doc, lemmatize=True):
         toks = []
-        for t in text:
+        for t in doc:
             if t.is_stop or t.is_punct:
                 continue
 
@@ -47,3 +125,64 @@ class Utils:
 
             toks.append(t.lemma_.lower() if lemmatize else t.text.lower())
         return toks
+
+    def tokenize(self, text, lemmatize=True):
+        return self.filter_tokens(self.nlp(self.clean_text(text)), lemmatize)
+
+    def tokenize_many(self, texts, batch_size=256, n_process=1, lemmatize=True):
+        """
+        Batched version of tokenize (using nlp.pipe), yields token lists in the same order as texts
+        """
+        docs = self.nlp.pipe(map(self.clean_text, texts), batch_size=batch_size, n_process=n_process)
+        for doc in docs:
+            yield self.filter_tokens(doc, lemmatize)
+
+
+# Utils instance of a worker process, see tokenize_keyed
+_worker_utils = None
+
+
+def _init_worker(remove_square_braces, incl_only_alphanumeric):
+    global _worker_utils
+    _worker_utils = Utils(remove_square_braces, incl_only_alphanumeric)
+
+
+def _tokenize_keyed_chunk(pairs, lemmatize):
+    tokens = _worker_utils.tokenize_many([text for _, text in pairs], batch_size=len(pairs), lemmatize=lemmatize)
+    return [(key, toks) for (key, _), toks in zip(pairs, tokens)]
+
+
+def _chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def tokenize_keyed(utils_inst, pairs, n_workers=1, chunk_size=256, lemmatize=True, max_pending=None):
+    """
+    Tokenizes (key, text) pairs with the settings of utils_inst, yields (key, tokens) in the same order. The pairs
+    are consumed once and lazily: with n_workers > 1, chunks of chunk_size texts are tokenized in a pool of worker
+    processes, at most max_pending chunks ahead of the consumer
+    """
+    if n_workers <= 1:
+        for chunk in _chunks(pairs, chunk_size):
+            tokens = utils_inst.tokenize_many([text for _, text in chunk], batch_size=len(chunk), lemmatize=lemmatize)
+            yield from ((key, toks) for (key, _), toks in zip(chunk, tokens))
+        return
+
+    max_pending = max_pending or 2 * n_workers
+    # spawn: the parent may be running a JVM (terrier), which doesn't survive a fork
+    with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker,
+                             initargs=(utils_inst.remove_square_braces, utils_inst.incl_only_alphanumeric)) as executor:
+        pending = deque()
+        for chunk in _chunks(pairs, chunk_size):
+            pending.append(executor.submit(_tokenize_keyed_chunk, chunk, lemmatize))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
@@ -0,0 +1,94 @@
+import hashlib
+import logging
+import os
+
+from tomt.data import utils
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+
+
+class IndexMismatchError(Exception): pass
+
+
+def content_hash(text):
+    return hashlib.blake2b((text or "").encode("utf-8"), digest_size=8).hexdigest()
+
+
+class IndexManifest:
+    """
+    Content hashes of the documents in an index (doc_id -> hash of the indexed text) and the tokenizer settings
+    used to build it. Saved alongside the index, used to detect stale indexes and documents added since
+    """
+
+    def __init__(self, hashes, tokenizer):
+        self.hashes = hashes
+        self.tokenizer = tokenizer
+
+    @classmethod
+    def from_documents(cls, documents, tokenizer):
+        return cls({doc.id: content_hash(doc.text) for doc in documents}, tokenizer)
+
+    @classmethod
+    def load(cls, folder):
+        """
+        Returns None if the index has no manifest (built before manifests were introduced)
+        """
+        path = os.path.join(folder, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return None
+        j = utils.read_json(path)
+        return cls(dict(zip(j["doc_ids"], j["hashes"])), j["tokenizer"])
+
+    def save(self, folder):
+        utils.write_json({
+            "collection_hash": self.collection_hash(),
+            "n_docs": len(self.hashes),
+            "tokenizer": self.tokenizer,
+            "doc_ids": list(self.hashes.keys()),
+            "hashes": list(self.hashes.values())
+        }, os.path.join(folder, MANIFEST_FILE))
+
+    def collection_hash(self):
+        h = hashlib.sha1()
+        for doc_id in sorted(self.hashes):
+            h.update(f"{doc_id}\t{self.hashes[doc_id]}\n".encode("utf-8"))
+        return h.hexdigest()
+
+    def diff(self, other):
+        """
+        Changes from this (indexed) collection to other: (added, removed, changed) doc_ids
+        """
+        added = [doc_id for doc_id in other.hashes if doc_id not in self.hashes]
+        removed = [doc_id for doc_id in self.hashes if doc_id not in other.hashes]
+        changed = [doc_id for doc_id, h in other.hashes.items() if doc_id in self.hashes and self.hashes[doc_id] != h]
+        return added, removed, changed
+
+    def check_appendable(self, other, index_path):
+        """
+        Returns the doc_ids added in other. Raises an IndexMismatchError if the index at index_path can't be updated
+        to other by adding documents (different tokenizer, documents removed or changed)
+        """
+        if self.tokenizer != other.tokenizer:
+            raise IndexMismatchError(f"{index_path} was built with tokenizer {self.tokenizer}, "
+                                     f"expected {other.tokenizer}. Delete it or set OVERWRITE_INDEX")
+        added, removed, changed = self.diff(other)
+        if removed or changed:
+            raise IndexMismatchError(f"{index_path} doesn't match the documents: {len(removed)} removed "
+                                     f"(e.g. {removed[:3]}), {len(changed)} changed (e.g. {changed[:3]}). "
+                                     f"Delete it or set OVERWRITE_INDEX")
+        return added
+
+
+def check_legacy_index(index_path, indexed_doc_ids, manifest):
+    """
+    For indexes without a manifest: only the doc_ids can be compared. If they match, the manifest is written
+    (the contents are assumed to be unchanged), otherwise an IndexMismatchError is raised
+    """
+    indexed_doc_ids = set(indexed_doc_ids)
+    if indexed_doc_ids != set(manifest.hashes):
+        raise IndexMismatchError(f"{index_path} has no manifest and its {len(indexed_doc_ids)} documents don't match "
+                                 f"the {len(manifest.hashes)} documents to index. Delete it or set OVERWRITE_INDEX")
+    log.warning(f"{index_path} has no manifest, the document ids match: assuming it is up to date")
+    manifest.save(index_path)
@@ -0,0 +1,283 @@
+import copy
+import logging
+import math
+import os
+import shutil
+from collections import Counter
+from typing import List, Optional, Tuple
+
+import numpy as np
+from haystack.retriever.base import BaseRetriever
+from scipy import sparse
+
+from tomt.benchmarks.lexical_utils import get_std_utils, Utils
+from tomt.benchmarks.manifest import IndexManifest, IndexMismatchError, check_legacy_index
+from tomt.benchmarks.query_pipeline import prune_queries
+from tomt.benchmarks.results import RankedList
+from tomt.data import utils as data_utils
+
+log = logging.getLogger(__name__)
+
+TF_FILE = "tf.npz"
+TERMS_FILE = "terms.json"
+DOCIDS_FILE = "docids.json"
+
+# 1 / ln(2), as in Terrier's Idf.REC_LOG_2_OF_E
+REC_LOG_2_OF_E = 1.0 / math.log(2)
+
+
+class NativeIndex:
+    """
+    Sparse (n_docs x n_terms) term frequency matrix, built from the same tokenization used for the Terrier index
+    """
+
+    def __init__(self, index_path, documents, utils_inst, overwrite_index=False):
+        self.index_path = index_path
+
+        if overwrite_index and os.path.exists(self.index_path):
+            log.warning("Overwriting index")
+            shutil.rmtree(self.index_path)
+
+        manifest = IndexManifest.from_documents(documents, utils_inst.settings())
+        if not os.path.exists(os.path.join(self.index_path, TF_FILE)):
+            log.info("Building index")
+            self.build(documents, utils_inst)
+            manifest.save(self.index_path)
+            log.info("Building index complete!")
+        else:
+            log.info("Using prebuilt index")
+            self.tf = sparse.load_npz(os.path.join(self.index_path, TF_FILE)).tocsr()
+            self.terms = data_utils.read_json(os.path.join(self.index_path, TERMS_FILE))
+            self.docids = data_utils.read_json(os.path.join(self.index_path, DOCIDS_FILE))
+            indexed = IndexManifest.load(self.index_path)
+            if indexed is None:
+                check_legacy_index(self.index_path, self.docids, manifest)
+            elif indexed.check_appendable(manifest, self.index_path):
+                # the native index has no delta indexes
+                raise IndexMismatchError(f"{self.index_path} is missing documents. Delete it or set OVERWRITE_INDEX")
+
+        self.term_to_termid = {t: i for i, t in enumerate(self.terms)}
+        self.n_docs, self.n_terms = self.tf.shape
+        self.doc_lengths = np.asarray(self.tf.sum(axis=1)).ravel().astype(np.float64)
+        self.mean_doc_length = self.doc_lengths.mean()
+        # document frequency and collection frequency of each term
+        self.df = np.bincount(self.tf.indices, minlength=self.n_terms).astype(np.float64)
+        self.cf = np.asarray(self.tf.sum(axis=0)).ravel().astype(np.float64)
+
+        log.info(f"Index stats: {self.n_docs} documents, {self.n_terms} terms, {self.tf.nnz} postings")
+
+    def build(self, documents, utils_inst):
+        N = len(documents)
+        log.info(f"Iterating over {N} documents")
+        print_every = max(N // 25, 5)
+        term_to_termid = {}
+        indptr, indices, data = [0], [], []
+        self.docids = []
+        tokenized = utils_inst.tokenize_many(doc.text for doc in documents)
+        for i, (doc, tokens) in enumerate(zip(documents, tokenized), 1):
+            if i % print_every == 0:
+                log.info(f"\t{i} of {N} done")
+            for term, count in Counter(tokens).items():
+                indices.append(term_to_termid.setdefault(term, len(term_to_termid)))
+                data.append(count)
+            indptr.append(len(indices))
+            self.docids.append(doc.id)
+
+        self.terms = list(term_to_termid.keys())
+        self.tf = sparse.csr_matrix((np.array(data, dtype=np.float32),
+                                     np.array(indices, dtype=np.int32),
+                                     np.array(indptr, dtype=np.int64)),
+                                    shape=(len(self.docids), len(self.terms)))
+        self.tf.sort_indices()
+
+        os.makedirs(self.index_path, exist_ok=True)
+        sparse.save_npz(os.path.join(self.index_path, TF_FILE), self.tf)
+        data_utils.write_json(self.terms, os.path.join(self.index_path, TERMS_FILE))
+        data_utils.write_json(self.docids, os.path.join(self.index_path, DOCIDS_FILE))
+
+    def query_tf(self, tokenized_queries):
+        """
+        Sparse (n_queries x n_terms) query term frequency matrix, OOV terms are dropped
+        """
+        indptr, indices, data = [0], [], []
+        for tokens in tokenized_queries:
+            for term, count in Counter(tokens).items():
+                termid = self.term_to_termid.get(term)
+                if termid is None:
+                    continue
+                indices.append(termid)
+                data.append(count)
+            indptr.append(len(indices))
+        return sparse.csr_matrix((np.array(data, dtype=np.float32),
+                                  np.array(indices, dtype=np.int32),
+                                  np.array(indptr, dtype=np.int64)),
+                                 shape=(len(tokenized_queries), self.n_terms))
+
+
+def bm25_term_weights(tf, doc_lengths, df, n_docs, mean_doc_length, k_1, b):
+    """
+    Document side of Terrier's BM25: idf * (k_1 + 1) * tf / (K + tf). All arrays are aligned (one entry per posting)
+    """
+    K = k_1 * ((1 - b) + b * doc_lengths / mean_doc_length)
+    idf = np.log2((n_docs - df + 0.5) / (df + 0.5))
+    return idf * ((k_1 + 1) * tf / (K + tf))
+
+
+def bm25_query_weights(qtf, k_3):
+    return (k_3 + 1) * qtf / (k_3 + qtf)
+
+
+def pl2_term_weights(tf, doc_lengths, cf, n_docs, mean_doc_length, c):
+    """
+    Document side of Terrier's PL2 (the query term frequency is a multiplicative factor)
+    """
+    TF = tf * np.log2(1.0 + (c * mean_doc_length) / doc_lengths)
+    NORM = 1.0 / (TF + 1.0)
+    f = cf / n_docs
+    return NORM * (TF * np.log2(1.0 / f)
+                   + f * REC_LOG_2_OF_E
+                   + 0.5 * np.log2(2 * math.pi * TF)
+                   + TF * (np.log2(TF) - REC_LOG_2_OF_E))
+
+
+def bm25_weights(index, k_1, b):
+    tf = index.tf.tocoo()
+    w = bm25_term_weights(tf.data, index.doc_lengths[tf.row], index.df[tf.col], index.n_docs, index.mean_doc_length,
+                          k_1, b)
+    return sparse.csr_matrix((w.astype(np.float32), (tf.row, tf.col)), shape=tf.shape)
+
+
+def pl2_weights(index, c):
+    tf = index.tf.tocoo()
+    w = pl2_term_weights(tf.data, index.doc_lengths[tf.row], index.cf[tf.col], index.n_docs, index.mean_doc_length,
+                         c)
+    return sparse.csr_matrix((w.astype(np.float32), (tf.row, tf.col)), shape=tf.shape)
+
+
+class NativeRetriever(BaseRetriever):
+    """
+    Pure NumPy/SciPy alternative to TerrierRetriever (no JVM). Supports BM25 and PL2 with the
+    same config keys as the Terrier configs. Whole query batches are scored with one sparse matrix product.
+
+    Note: Terrier additionally applies its own stemming/stopword pipeline, so scores are close to, but not
+    identical to, TerrierRetriever
+    """
+    OVERWRITE_INDEX = False
+    # number of queries scored at once, bounds the size of the (sparse) score matrix
+    SCORE_BATCH_SIZE = 128
+    # the copies of with_config only read the (shared) index, so a sweep can score several configs concurrently
+    CONCURRENT_CONFIGS = True
+
+    def __init__(self, document_store, config_json, top_k):
+        super().__init__()
+        self.top_k = top_k
+        self.document_store = document_store
+        self.documents = {}
+        for doc in document_store.get_all_documents():
+            self.documents[doc.id] = doc
+        self.config = config_json
+        self.controls = self.config.get("controls", {})
+        self.wmodel = self.config["wmodel"]
+        # query term pruning: only the max_query_terms terms with the highest IDF are kept (None: no pruning)
+        self.max_query_terms = self.config.get("max_query_terms")
+        log.info(f"WModel: {self.wmodel}")
+        self.index_path = self.config["index_path"]
+
+        self.utils = get_std_utils()
+        self.query_utils = Utils(remove_square_braces=True, incl_only_alphanumeric=True)
+        self.index = NativeIndex(self.index_path, list(self.documents.values()), self.utils,
+                                 self.OVERWRITE_INDEX)
+        # docno (row of the index) -> document
+        self.doc_list = [self.documents[doc_id] for doc_id in self.index.docids]
+
+        self._set_weights()
+
+    def _set_weights(self):
+        # defaults are the same as Terrier's
+        if self.wmodel == "BM25":
+            self.k_3 = float(self.controls.get("bm25.k_3", 8.0))
+            weights = bm25_weights(self.index,
+                                   k_1=float(self.controls.get("bm25.k_1", 1.2)),
+                                   b=float(self.controls.get("c", 0.75)))
+        elif self.wmodel == "PL2":
+            weights = pl2_weights(self.index, c=float(self.controls.get("c", 1.0)))
+        else:
+            raise ValueError(f"unsupported wmodel: {self.wmodel}")
+        # (n_terms x n_docs), so that Q @ W gives (n_queries x n_docs) scores
+        self.weights = weights.T.tocsr()
+
+    def with_config(self, config_json):
+        """
+        Copy of this retriever with a different wmodel / controls, sharing the documents and the index
+        """
+        other = copy.copy(self)
+        other.config = {**self.config, **config_json}
+        other.controls = other.config.get("controls", {})
+        other.wmodel = other.config["wmodel"]
+        other.max_query_terms = other.config.get("max_query_terms")
+        other._set_weights()
+        return other
+
+    def document_frequencies(self, tokens):
+        termids = (self.index.term_to_termid.get(t) for t in tokens)
+        return [self.index.df[termid] if termid is not None else 0 for termid in termids]
+
+    def query_weights(self, tokenized_queries):
+        q = self.index.query_tf(tokenized_queries)
+        if self.wmodel == "BM25":
+            q.data = bm25_query_weights(q.data, self.k_3).astype(np.float32)
+        return q
+
+    def score(self, tokenized_queries):
+        """
+        Yields (docnos, scores) of the top_k documents of each query, sorted by score
+        """
+        for b_start in range(0, len(tokenized_queries), self.SCORE_BATCH_SIZE):
+            batch = tokenized_queries[b_start:b_start + self.SCORE_BATCH_SIZE]
+            scores = (self.query_weights(batch) @ self.weights).tocsr()
+            for row in range(scores.shape[0]):
+                start, end = scores.indptr[row], scores.indptr[row + 1]
+                docnos, row_scores = scores.indices[start:end], scores.data[start:end]
+                if len(row_scores) > self.top_k:
+                    top = np.argpartition(-row_scores, self.top_k - 1)[:self.top_k]
+                    docnos, row_scores = docnos[top], row_scores[top]
+                order = np.argsort(-row_scores, kind="stable")
+                yield docnos[order], row_scores[order]
+
+    def batch_retrieve(self, queries: List[Tuple[str, str]], filters: dict = None,
+                       index: str = None):
+        """
+        Returns qid -> RankedList. Queries without results are absent
+        """
+        if filters or index:
+            raise NotImplementedError("filters/index not supported")
+
+        tokenized = zip((qid for (qid, _) in queries), self.query_utils.tokenize_many(q for (_, q) in queries))
+        return self.batch_retrieve_tokenized(list(tokenized))
+
+    def batch_retrieve_tokenized(self, queries: List[Tuple[str, List[str]]]):
+        """
+        Same as batch_retrieve, for queries that are already tokenized (with self.query_utils)
+        """
+        if self.max_query_terms:
+            queries = prune_queries(queries, self.document_frequencies, self.max_query_terms)
+        results = {}
+        for (qid, _), (docnos, scores) in zip(queries, self.score([tokens for (_, tokens) in queries])):
+            # like Terrier, queries without any matching document are absent from the results
+            if len(docnos) > 0:
+                results[qid] = RankedList(docnos, scores, self.doc_list)
+
+        return results
+
+    def retrieve(self, query, filters: dict = None, top_k: Optional[int] = None, index: str = None):
+        if filters or index:
+            raise NotImplementedError("filters/index not supported")
+
+        if top_k:
+            raise ValueError("Provide top_k arg only in constructor")
+
+        queries = [(None, self.query_utils.tokenize(query.text))]
+        if self.max_query_terms:
+            queries = prune_queries(queries, self.document_frequencies, self.max_query_terms)
+        docnos, scores = next(self.score([tokens for (_, tokens) in queries]))
+        return RankedList(docnos, scores, self.doc_list)
@@ -0,0 +1,83 @@
+import logging
+import resource
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+def _peak_rss_mb():
+    """
+    Peak RSS of this process
+    """
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _children_peak_rss_mb():
+    """
+    Peak RSS of the largest (finished) child process so far, e.g. a tokenization worker. It can't be reset, so it is
+    cumulative over stages
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak RSS of this process (linux >= 4.0), so that the peak of every stage is measured separately.
+    Returns False if not supported, peaks are then cumulative
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as writer:
+            writer.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _current_peak_rss_mb():
+    # VmHWM is reset by _reset_peak_rss, ru_maxrss is not
+    try:
+        with open("/proc/self/status") as reader:
+            for line in reader:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return _peak_rss_mb()
+
+
+class StageProfiler:
+    """
+    Records wall time, peak RSS and throughput of named stages. peak_rss_mb is the peak of this process only, the
+    peak of worker processes (e.g. --query_workers, index_workers) is recorded separately in children_peak_rss_mb:
+
+        with profiler.stage("tokenization") as stage:
+            tokens = ...
+            stage["n_items"] = len(tokens)
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, n_items=None):
+        record = {"stage": name, "n_items": n_items}
+        per_stage_peak = _reset_peak_rss()
+        children_peak_before = _children_peak_rss_mb()
+        start_time = time.perf_counter()
+        yield record
+        wall_time = time.perf_counter() - start_time
+        record["wall_time"] = wall_time
+        record["peak_rss_mb"] = _current_peak_rss_mb() if per_stage_peak else _peak_rss_mb()
+        record["peak_rss_is_cumulative"] = not per_stage_peak
+        children_peak = _children_peak_rss_mb()
+        # None if no child process finished during this stage with a higher peak than the ones before
+        record["children_peak_rss_mb"] = children_peak if children_peak > children_peak_before else None
+        if record["n_items"] is not None:
+            record["items_per_s"] = record["n_items"] / max(wall_time, 1e-9)
+        self.stages.append(record)
+        log.info(f"{name}: {wall_time:0.2f}s, peak RSS {record['peak_rss_mb']:0.1f}MB"
+                 + (f" (workers: {record['children_peak_rss_mb']:0.1f}MB)"
+                    if record["children_peak_rss_mb"] is not None else "")
+                 + (f", {record['items_per_s']:0.1f} items/s" if "items_per_s" in record else ""))
@@ -0,0 +1,205 @@
+import time
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from haystack.preprocessor import PreProcessor
+
+from tomt.benchmarks.lexical_utils import Utils
+
+log = logging.getLogger(__name__)
+
+# same settings as used for the documents
+PROCESSOR_KWARGS = dict(clean_empty_lines=True,
+                        clean_whitespace=True,
+                        clean_header_footer=True,
+                        split_by=None,
+                        split_respect_sentence_boundary=True)
+
+
+def make_query(query, query_type):
+    if query_type == "title_only":
+        text = query["title"]
+    elif query_type == "description_only":
+        text = query["description"]
+    else:
+        text = query["title"] + "\n" + query["description"]
+
+    return {
+        "text": text,
+        "meta": query
+    }
+
+
+class QueryPreprocessor:
+    """
+    Cleans (haystack PreProcessor) and tokenizes a batch of queries
+    """
+
+    def __init__(self, query_type, remove_square_braces, incl_only_alphanumeric):
+        self.query_type = query_type
+        self.processor = PreProcessor(**PROCESSOR_KWARGS)
+        self.utils = Utils(remove_square_braces=remove_square_braces, incl_only_alphanumeric=incl_only_alphanumeric)
+
+    def __call__(self, batch):
+        """
+        Returns ([(qid, tokens)], time taken)
+        """
+        start_time = time.time()
+        processed = [self.processor.process(make_query(q_dict, self.query_type))[0] for q_dict in batch]
+        tokens = self.utils.tokenize_many(q["text"] for q in processed)
+        return [(q["meta"]["id"], toks) for q, toks in zip(processed, tokens)], time.time() - start_time
+
+
+# QueryPreprocessor of a worker process
+_worker_preprocessor = None
+
+
+def _init_worker(query_type, remove_square_braces, incl_only_alphanumeric):
+    global _worker_preprocessor
+    _worker_preprocessor = QueryPreprocessor(query_type, remove_square_braces, incl_only_alphanumeric)
+
+
+def _preprocess(batch):
+    return _worker_preprocessor(batch)
+
+
+def prune_queries(queries, document_frequencies, max_terms):
+    """
+    Query term pruning: keeps the max_terms unique terms with the highest IDF (i.e. the lowest document frequency)
+    of every query, in their original order and with their original frequencies. Terms that aren't in the index
+    (df 0) are dropped, they don't match any document. document_frequencies: list of terms -> list of dfs
+    """
+    pruned = []
+    for qid, tokens in queries:
+        unique = list(dict.fromkeys(tokens))
+        if len(unique) > max_terms:
+            df = np.asarray(document_frequencies(unique), dtype=np.float64)
+            df[df == 0] = np.inf
+            keep = {unique[i] for i in np.argsort(df, kind="stable")[:max_terms].tolist() if np.isfinite(df[i])}
+            tokens = [t for t in tokens if t in keep]
+        pruned.append((qid, tokens))
+    return pruned
+
+
+def length_buckets(queries, bucket_size, length=lambda q: len(set(q[1]))):
+    """
+    Splits queries into batches of bucket_size queries of similar length (by default: number of unique terms of a
+    tokenized (qid, tokens) query), so that a few long queries don't slow down a whole batch
+    """
+    order = sorted(range(len(queries)), key=lambda i: length(queries[i]))
+    for i in range(0, len(order), bucket_size):
+        yield [queries[j] for j in order[i:i + bucket_size]]
+
+
+class LatencyReport:
+    """
+    Retrieval time by query length (number of unique terms). Time of a batch is spread evenly over its queries,
+    which is accurate with length_buckets
+    """
+    LENGTH_BINS = (8, 16, 32, 64, 128)
+
+    def __init__(self):
+        self.lengths = []
+        self.times = []
+
+    def add(self, queries, elapsed):
+        for _, tokens in queries:
+            self.lengths.append(len(set(tokens)))
+            self.times.append(elapsed / len(queries))
+
+    def summary(self):
+        lengths, times = np.array(self.lengths), np.array(self.times)
+        bins = np.digitize(lengths, self.LENGTH_BINS)
+        summary = []
+        for b in np.unique(bins).tolist():
+            lower = ([0] + list(self.LENGTH_BINS))[b]
+            upper = self.LENGTH_BINS[b] if b < len(self.LENGTH_BINS) else None
+            mask = bins == b
+            summary.append({"terms": f"[{lower}, {upper if upper is not None else 'inf'})",
+                            "n_queries": int(mask.sum()),
+                            "ms_per_query": 1000 * float(times[mask].mean()),
+                            "share_of_time": float(times[mask].sum() / max(times.sum(), 1e-9))})
+        return summary
+
+    def log(self):
+        for row in self.summary():
+            log.info(f"\tquery terms {row['terms']}: {row['n_queries']} queries, {row['ms_per_query']:0.2f}ms/query, "
+                     f"{100 * row['share_of_time']:0.1f}% of retrieval time")
+
+
+def _batches(queries, batch_size):
+    for i in range(0, len(queries), batch_size):
+        yield queries[i:i + batch_size]
+
+
+def iter_tokenized_batches(queries, query_type, query_utils, batch_size=1000, n_workers=2, max_pending=None):
+    """
+    Yields batches of (qid, tokens), in order. With n_workers > 0, batches are cleaned and tokenized in a pool of
+    worker processes, at most max_pending batches ahead of the consumer (e.g. while the previous batch is being
+    scored). query_utils provides the tokenizer settings
+    """
+    flags = (query_type, query_utils.remove_square_braces, query_utils.incl_only_alphanumeric)
+    batches = _batches(queries, batch_size)
+    if n_workers <= 0:
+        preprocessor = QueryPreprocessor(*flags)
+        for batch in batches:
+            yield preprocessor(batch)
+        return
+
+    max_pending = max_pending or 2 * n_workers
+    # spawn: the parent may be running a JVM (terrier), which doesn't survive a fork
+    with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker,
+                             initargs=flags) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append(executor.submit(_preprocess, batch))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def run_queries(retriever, queries, query_type, batch_size=1000, n_workers=2, on_results=None, bucket_size=None):
+    """
+    Retrieves results for all queries: preprocessing (in worker processes) overlaps with retrieval.
+    on_results(qid, ranked_list) is called for every query with results. With bucket_size, every batch is retrieved
+    in length buckets (see length_buckets). Logs per-stage timing and retrieval time by query length
+    """
+    start_time = time.time()
+    preprocess_time, wait_time, retrieval_time = 0.0, 0.0, 0.0
+    n_done = 0
+    report = LatencyReport()
+    batches = iter_tokenized_batches(queries, query_type, retriever.query_utils, batch_size, n_workers)
+    while True:
+        wait_start = time.time()
+        tokenized = next(batches, None)
+        if tokenized is None:
+            break
+        tokenized, batch_preprocess_time = tokenized
+        wait_time += time.time() - wait_start
+        preprocess_time += batch_preprocess_time
+
+        for bucket in (length_buckets(tokenized, bucket_size) if bucket_size else [tokenized]):
+            retrieval_start = time.time()
+            res = retriever.batch_retrieve_tokenized(bucket)
+            elapsed = time.time() - retrieval_start
+            retrieval_time += elapsed
+            report.add(bucket, elapsed)
+            if on_results is not None:
+                for qid, scores in res.items():
+                    on_results(qid, scores)
+
+        n_done += len(tokenized)
+        log.info(f"\t{n_done}/{len(queries)} done. preprocess: {preprocess_time:0.2f}s (worker time), "
+                 f"waiting on preprocessing: {wait_time:0.2f}s, retrieval: {retrieval_time:0.2f}s")
+
+    elapsed = time.time() - start_time
+    log.info(f"Processed {n_done} queries in {elapsed:0.2f}s ({n_done / max(elapsed, 1e-9):0.1f} queries/s). "
+             f"preprocess: {preprocess_time:0.2f}s (worker time), waiting on preprocessing: {wait_time:0.2f}s, "
+             f"retrieval: {retrieval_time:0.2f}s")
+    log.info("Retrieval time by query length:")
+    report.log()
+    return n_done
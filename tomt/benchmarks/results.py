@@ -0,0 +1,52 @@
+from collections.abc import Sequence
+
+import numpy as np
+
+
+class RankedList(Sequence):
+    """
+    Ranked results of a single query, stored as compact arrays of document indices and scores.
+    (Document, score) tuples are only materialized when they are accessed
+    """
+
+    def __init__(self, doc_indices, scores, documents):
+        assert len(doc_indices) == len(scores)
+        self.doc_indices = doc_indices
+        self.scores = scores
+        # document index -> haystack Document
+        self.documents = documents
+
+    def __len__(self):
+        return len(self.doc_indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.documents[self.doc_indices[i]], float(self.scores[i])
+
+    def doc_ids(self):
+        return [self.documents[i].id for i in self.doc_indices.tolist()]
+
+    def to_dict(self):
+        """
+        doc_id -> score, e.g. for pytrec_eval
+        """
+        return dict(zip(self.doc_ids(), self.scores.tolist()))
+
+
+def group_by_qid(qids, doc_indices, scores, documents):
+    """
+    Splits flat (qid, doc index, score) arrays, grouped by qid in rank order, into a RankedList per qid
+    """
+    qids = np.asarray(qids)
+    if len(qids) == 0:
+        return {}
+    # start of each run of equal qids
+    starts = np.flatnonzero(np.r_[True, qids[1:] != qids[:-1]])
+    ends = np.r_[starts[1:], len(qids)]
+    results = {}
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        qid = qids[start]
+        assert qid not in results, "results have to be grouped by qid"
+        results[qid] = RankedList(doc_indices[start:end], scores[start:end], documents)
+    return results
@@ -0,0 +1,193 @@
+import os
+import logging
+from collections.abc import Mapping
+
+import numpy as np
+
+from tomt.data import utils
+
+log = logging.getLogger(__name__)
+
+HEADER_FILE = "run.json"
+QIDS_FILE = "qids.json"
+DOCIDS_FILE = "docids.json"
+OFFSETS_FILE = "offsets.npy"
+DOC_INDICES_FILE = "doc_indices.bin"
+SCORES_FILE = "scores.bin"
+
+
+def is_run_folder(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, HEADER_FILE))
+
+
+class RunWriter:
+    """
+    Streams a run into a folder: a qid table, a docid dictionary, and per-query int32 doc indices
+    + float32 scores (sorted by decreasing score), appended to two flat binary files
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=False)
+        self.qids = []
+        self.offsets = [0]
+        self.docid_to_index = {}
+        self._doc_indices = open(os.path.join(path, DOC_INDICES_FILE), "wb")
+        self._scores = open(os.path.join(path, SCORES_FILE), "wb")
+
+    def add(self, qid, doc_ids, scores):
+        assert len(doc_ids) == len(scores)
+        scores = np.asarray(scores, dtype=np.float32)
+        doc_indices = np.fromiter((self.docid_to_index.setdefault(d, len(self.docid_to_index)) for d in doc_ids),
+                                  dtype=np.int32, count=len(doc_ids))
+        # stable sort, so that already sorted results keep their order
+        order = np.argsort(-scores, kind="stable")
+        self._doc_indices.write(doc_indices[order].tobytes())
+        self._scores.write(scores[order].tobytes())
+        self.qids.append(qid)
+        self.offsets.append(self.offsets[-1] + len(doc_ids))
+
+    def add_dict(self, qid, scores):
+        self.add(qid, list(scores.keys()), list(scores.values()))
+
+    def close(self):
+        self._doc_indices.close()
+        self._scores.close()
+        assert len(set(self.qids)) == len(self.qids), "duplicate qids in run"
+        np.save(os.path.join(self.path, OFFSETS_FILE), np.array(self.offsets, dtype=np.int64))
+        utils.write_json(self.qids, os.path.join(self.path, QIDS_FILE))
+        utils.write_json(list(self.docid_to_index.keys()), os.path.join(self.path, DOCIDS_FILE))
+        # written last: marks a complete run
+        utils.write_json({"n_queries": len(self.qids), "n_docs": len(self.docid_to_index),
+                          "n_results": self.offsets[-1]}, os.path.join(self.path, HEADER_FILE), indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class RunFile(Mapping):
+    """
+    Memory-mapped reader for a run written by RunWriter.
+    Behaves like the usual run dict (qid -> {doc_id: score}), but the arrays can be accessed directly with get_arrays
+    """
+
+    def __init__(self, path):
+        self.path = path
+        header = utils.read_json(os.path.join(path, HEADER_FILE))
+        self.qids = utils.read_json(os.path.join(path, QIDS_FILE))
+        self.qid_to_index = {qid: i for i, qid in enumerate(self.qids)}
+        self.docids = utils.read_json(os.path.join(path, DOCIDS_FILE))
+        self._docid_to_index = None
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+        if header["n_results"] > 0:
+            self.doc_indices = np.memmap(os.path.join(path, DOC_INDICES_FILE), dtype=np.int32, mode="r")
+            self.scores = np.memmap(os.path.join(path, SCORES_FILE), dtype=np.float32, mode="r")
+        else:
+            # empty files can't be memory-mapped
+            self.doc_indices = np.zeros(0, dtype=np.int32)
+            self.scores = np.zeros(0, dtype=np.float32)
+        assert len(self.doc_indices) == len(self.scores) == header["n_results"]
+
+    @property
+    def docid_to_index(self):
+        if self._docid_to_index is None:
+            self._docid_to_index = {d: i for i, d in enumerate(self.docids)}
+        return self._docid_to_index
+
+    def get_arrays(self, qid):
+        """
+        (doc indices, scores) of a query, sorted by decreasing score
+        """
+        i = self.qid_to_index[qid]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.doc_indices[start:end], self.scores[start:end]
+
+    def get_doc_ids(self, qid):
+        doc_indices, _ = self.get_arrays(qid)
+        return [self.docids[i] for i in doc_indices.tolist()]
+
+    def gold_rank(self, qid, gold_doc_id):
+        """
+        Same as tomt.benchmarks.evaluation.gold_rank, computed on the arrays
+        """
+        gold_index = self.docid_to_index.get(gold_doc_id)
+        if gold_index is None:
+            return 0
+        doc_indices, scores = self.get_arrays(qid)
+        pos = np.flatnonzero(doc_indices == gold_index)
+        if len(pos) == 0:
+            return 0
+        gold_score = scores[pos[0]]
+        rank = 1 + int(np.count_nonzero(scores > gold_score))
+        ties = doc_indices[scores == gold_score]
+        if len(ties) > 1:
+            rank += sum(1 for i in ties.tolist() if self.docids[i] > gold_doc_id)
+        return rank
+
+    def __getitem__(self, qid):
+        doc_indices, scores = self.get_arrays(qid)
+        return dict(zip((self.docids[i] for i in doc_indices.tolist()), scores.tolist()))
+
+    def __contains__(self, qid):
+        return qid in self.qid_to_index
+
+    def __iter__(self):
+        return iter(self.qids)
+
+    def __len__(self):
+        return len(self.qids)
+
+
+def json_to_run(run_dict, path):
+    with RunWriter(path) as writer:
+        for qid, scores in run_dict.items():
+            writer.add_dict(qid, scores)
+
+
+def run_to_json(run, path, zipped=False):
+    utils.write_json({qid: run[qid] for qid in run}, path, zipped=zipped)
+
+
+def trec_to_run(trec_path, path):
+    """
+    Converts a TREC run (qid Q0 docid rank score tag), with the results of a query on consecutive lines
+    """
+    with open(trec_path) as reader, RunWriter(path) as writer:
+        cur_qid, doc_ids, scores = None, [], []
+        for line in reader:
+            if not line.strip():
+                continue
+            qid, _, doc_id, _, score, _ = line.split()
+            if qid != cur_qid:
+                if cur_qid is not None:
+                    writer.add(cur_qid, doc_ids, scores)
+                cur_qid, doc_ids, scores = qid, [], []
+            doc_ids.append(doc_id)
+            scores.append(float(score))
+        if cur_qid is not None:
+            writer.add(cur_qid, doc_ids, scores)
+
+
+def run_to_trec(run, trec_path, tag="tomt"):
+    with open(trec_path, "w") as writer:
+        for qid in run.qids:
+            doc_indices, scores = run.get_arrays(qid)
+            for rank, (doc_index, score) in enumerate(zip(doc_indices.tolist(), scores.tolist()), 1):
+                writer.write(f"{qid} Q0 {run.docids[doc_index]} {rank} {score} {tag}\n")
+
+
+def load_run(path):
+    """
+    Loads a run: a run folder (RunWriter), a folder containing one ('run' or 'out_qrels.json.gzip', as saved by
+    run_lexical_benchmark.py) or a JSON run (qid -> {doc_id: score}, optionally gzipped)
+    """
+    if is_run_folder(path):
+        return RunFile(path)
+    if os.path.isdir(path):
+        if is_run_folder(os.path.join(path, "run")):
+            return RunFile(os.path.join(path, "run"))
+        path = os.path.join(path, "out_qrels.json.gzip")
+    return utils.read_json(path, zipped=path.endswith(".gzip") or path.endswith(".gz"))
@@ -0,0 +1,104 @@
+import logging
+import multiprocessing
+from contextlib import nullcontext
+
+import numpy as np
+
+from tomt.benchmarks.evaluation import metric_values, run_gold_rank
+
+log = logging.getLogger(__name__)
+
+# number of resamples drawn at once (bounds memory: CHUNK_SIZE x n_queries values)
+CHUNK_SIZE = 500
+
+
+def per_query_ranks(evaluator, run, qids):
+    """
+    Gold ranks for qids (in that order). Queries missing from the run count as 'not retrieved' (rank 0),
+    so that different runs are always paired on the same queries
+    """
+    return np.array([run_gold_rank(run, qid, evaluator.gold[qid]) if qid in run else 0 for qid in qids],
+                    dtype=np.int64)
+
+
+def _chunks(n_samples, seed):
+    # independent random streams for every chunk, so results don't depend on the number of workers
+    n_chunks = (n_samples + CHUNK_SIZE - 1) // CHUNK_SIZE
+    seeds = np.random.SeedSequence(seed).spawn(n_chunks)
+    for i, s in enumerate(seeds):
+        yield min(CHUNK_SIZE, n_samples - i * CHUNK_SIZE), s
+
+
+def _bootstrap_chunk(args):
+    values, n, seed = args
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, len(values), size=(n, len(values)))
+    return values[idx].mean(axis=1)
+
+
+def _randomization_chunk(args):
+    diffs, n, seed = args
+    rng = np.random.default_rng(seed)
+    signs = rng.integers(0, 2, size=(n, len(diffs)), dtype=np.int8) * 2 - 1
+    return np.abs((signs * diffs).mean(axis=1))
+
+
+def _map(fn, tasks, pool):
+    if pool is None:
+        return [fn(t) for t in tasks]
+    return pool.map(fn, tasks)
+
+
+def bootstrap_ci(values, n_samples=10000, alpha=0.05, seed=42, pool=None):
+    """
+    Percentile bootstrap confidence interval of the mean of values. Returns (mean, lower, upper).
+    Resamples are drawn in chunks, spread over pool (a multiprocessing.Pool) if provided
+    """
+    values = np.asarray(values, dtype=np.float64)
+    tasks = [(values, n, s) for n, s in _chunks(n_samples, seed)]
+    means = np.concatenate(_map(_bootstrap_chunk, tasks, pool))
+    lower, upper = np.quantile(means, [alpha / 2, 1 - alpha / 2])
+    return float(values.mean()), float(lower), float(upper)
+
+
+def randomization_test(values_a, values_b, n_samples=10000, seed=42, pool=None):
+    """
+    Two-sided paired randomization (sign-flip) test of mean(values_a) == mean(values_b). Returns (diff, p-value)
+    """
+    diffs = np.asarray(values_a, dtype=np.float64) - np.asarray(values_b, dtype=np.float64)
+    observed = abs(diffs.mean())
+    tasks = [(diffs, n, s) for n, s in _chunks(n_samples, seed)]
+    permuted = np.concatenate(_map(_randomization_chunk, tasks, pool))
+    # small tolerance: sign flips that reproduce the observed difference count as extreme
+    n_extreme = int(np.count_nonzero(permuted >= observed - 1e-12))
+    return float(diffs.mean()), (n_extreme + 1) / (n_samples + 1)
+
+
+def compare_runs(evaluator, runs, qids, metrics, n_samples=10000, alpha=0.05, seed=42, n_workers=1):
+    """
+    runs: name -> run (qid -> {doc_id: score}, or a RunFile).
+    Returns bootstrap CIs for every run / metric, and paired randomization tests for every pair of runs / metric
+    """
+    values = {}
+    for name, run in runs.items():
+        ranks = per_query_ranks(evaluator, run, qids)
+        values[name] = {met: metric_values(ranks, met) for met in metrics}
+
+    results = {"n_queries": len(qids), "n_samples": n_samples, "alpha": alpha, "runs": {}, "tests": []}
+    with multiprocessing.Pool(n_workers) if n_workers > 1 else nullcontext() as pool:
+        for name in values:
+            results["runs"][name] = {}
+            for met in metrics:
+                mean, lower, upper = bootstrap_ci(values[name][met], n_samples, alpha, seed, pool)
+                results["runs"][name][met] = {"mean": mean, "ci_lower": lower, "ci_upper": upper}
+                log.info(f"{name}:: {met}: {mean:0.4f} [{lower:0.4f}, {upper:0.4f}]")
+
+        names = list(values)
+        for i, name_a in enumerate(names):
+            for name_b in names[i + 1:]:
+                for met in metrics:
+                    diff, p = randomization_test(values[name_a][met], values[name_b][met], n_samples, seed, pool)
+                    results["tests"].append({"a": name_a, "b": name_b, "metric": met, "diff": diff, "p_value": p})
+                    log.info(f"{name_a} vs {name_b}:: {met}: diff={diff:0.4f}, p={p:0.4f}")
+
+    return results
@@ -0,0 +1,134 @@
+import csv
+import itertools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tomt.benchmarks.evaluation import METRICS, RankEvaluator, summarize
+from tomt.benchmarks.query_pipeline import LatencyReport, iter_tokenized_batches, length_buckets
+from tomt.benchmarks.runfile import RunFile, RunWriter
+from tomt.data import utils
+
+log = logging.getLogger(__name__)
+
+ALL_QUERIES = "all_queries"
+
+
+def expand_grid(config_json):
+    """
+    Expands a grid config into a list of configs. A grid config is a regular config in which any top-level setting
+    (e.g. "wmodel", "max_query_terms") and any of the "controls" can be a list of values (every combination is used),
+    or a list of such configs (e.g. one per wmodel)
+    """
+    if isinstance(config_json, list):
+        return [c for grid in config_json for c in expand_grid(grid)]
+
+    top_keys = sorted(k for k, v in config_json.items() if isinstance(v, list))
+    controls = config_json.get("controls", {})
+    keys = sorted(controls)
+    values = [controls[k] if isinstance(controls[k], list) else [controls[k]] for k in keys]
+    configs = []
+    for top_combination in itertools.product(*(config_json[k] for k in top_keys)):
+        for combination in itertools.product(*values):
+            configs.append({**config_json, **dict(zip(top_keys, top_combination)),
+                            "controls": dict(zip(keys, combination))})
+    return configs
+
+
+def is_grid(config_json):
+    return isinstance(config_json, list) or len(expand_grid(config_json)) > 1
+
+
+def tokenize_queries(queries, query_type, query_utils, batch_size=1000, n_workers=2):
+    """
+    [(qid, tokens)] for all queries, tokenized once and shared by every config of the sweep
+    """
+    start_time = time.time()
+    tokenized = []
+    for batch, _ in iter_tokenized_batches(queries, query_type, query_utils, batch_size, n_workers):
+        tokenized.extend(batch)
+    log.info(f"Tokenized {len(tokenized)} queries in {time.time() - start_time:0.2f}s")
+    return tokenized
+
+
+class Sweep:
+    """
+    Runs a list of configs with one retriever (i.e. one open index) on the same tokenized queries.
+    Every config gets its own run folder ({out}/runs/{name}), metrics of all configs are written to one table
+    """
+
+    def __init__(self, retriever, configs, qrel, ids_by_subsets, out_folder, batch_size=1000, bucket_size=None):
+        self.retriever = retriever
+        self.configs = configs
+        self.evaluator = RankEvaluator(qrel, METRICS)
+        self.ids_by_subsets = ids_by_subsets
+        self.out_folder = out_folder
+        self.batch_size = batch_size
+        # see query_pipeline.length_buckets
+        self.bucket_size = bucket_size
+
+    def run_config(self, name, config, tokenized):
+        start_time = time.time()
+        retriever = self.retriever.with_config(config)
+        run_path = os.path.join(self.out_folder, "runs", name)
+        report = LatencyReport()
+        batches = length_buckets(tokenized, self.bucket_size) if self.bucket_size else \
+            (tokenized[i:i + self.batch_size] for i in range(0, len(tokenized), self.batch_size))
+        with RunWriter(run_path) as run_writer:
+            for batch in batches:
+                batch_start = time.time()
+                res = retriever.batch_retrieve_tokenized(batch)
+                report.add(batch, time.time() - batch_start)
+                for qid, scores in res.items():
+                    run_writer.add(qid, scores.doc_ids(), scores.scores)
+        retrieval_time = sum(report.times)
+
+        qids, metric_vals = self.evaluator.evaluate(RunFile(run_path))
+        metrics = {ALL_QUERIES: summarize(qids, metric_vals)}
+        metrics.update(summarize(qids, metric_vals, self.ids_by_subsets))
+        elapsed = time.time() - start_time
+        log.info(f"{name} ({config['wmodel']}, {config.get('controls', {})}, "
+                 f"max_query_terms: {config.get('max_query_terms')}) took {elapsed:0.2f}s "
+                 f"({1000 * retrieval_time / max(len(tokenized), 1):0.2f}ms/query):: "
+                 + ", ".join(f"{met}: {vals['mean']:0.4f}" for met, vals in metrics[ALL_QUERIES].items()))
+        return {"name": name, "config": config, "time": elapsed,
+                "ms_per_query": 1000 * retrieval_time / max(len(tokenized), 1),
+                "latency_by_length": report.summary(), "metrics": metrics}
+
+    def run(self, tokenized, n_workers=1):
+        """
+        Runs every config, n_workers at a time (threads: the index and the queries are shared, scoring happens in
+        NumPy). n_workers > 1 requires a retriever whose copies can be used concurrently (CONCURRENT_CONFIGS), i.e.
+        the native retriever: concurrent Terrier BatchRetrieve calls on one index aren't known to be safe.
+        Returns the results of all configs, in the order of the configs
+        """
+        if n_workers > 1 and not getattr(self.retriever, "CONCURRENT_CONFIGS", False):
+            raise ValueError(f"{type(self.retriever).__name__} doesn't support concurrent configs, use n_workers=1")
+        names = [f"{i:03d}" for i in range(len(self.configs))]
+        log.info(f"Running {len(self.configs)} configs with {n_workers} worker(s)")
+        with ThreadPoolExecutor(max(n_workers, 1)) as executor:
+            results = list(executor.map(lambda args: self.run_config(*args, tokenized), zip(names, self.configs)))
+
+        best = max(results, key=lambda r: r["metrics"][ALL_QUERIES][METRICS[0]]["mean"])
+        log.info(f"Best config ({METRICS[0]}): {best['name']} {best['config']}")
+        self.write(results)
+        return results
+
+    def write(self, results):
+        utils.write_json(results, os.path.join(self.out_folder, "sweep.json"), indent=2)
+
+        control_keys = sorted({k for r in results for k in r["config"].get("controls", {})})
+        subsets = [ALL_QUERIES] + sorted(s for s in results[0]["metrics"] if s != ALL_QUERIES)
+        metric_cols = [(subset, met) for subset in subsets for met in sorted(METRICS)]
+        with open(os.path.join(self.out_folder, "sweep.tsv"), "w", newline="") as writer:
+            tsv = csv.writer(writer, delimiter="\t")
+            tsv.writerow(["name", "wmodel"] + control_keys + ["max_query_terms", "time", "ms_per_query"]
+                         + [f"{s}/{m}" for s, m in metric_cols])
+            for r in results:
+                controls = r["config"].get("controls", {})
+                tsv.writerow([r["name"], r["config"]["wmodel"]]
+                             + [controls.get(k, "") for k in control_keys]
+                             + [r["config"].get("max_query_terms") or "", f"{r['time']:0.2f}",
+                                f"{r['ms_per_query']:0.2f}"]
+                             + [f"{r['metrics'][s][m]['mean']:0.4f}" for s, m in metric_cols])
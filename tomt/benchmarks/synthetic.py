@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+from tomt.data import utils
+
+log = logging.getLogger(__name__)
+
+SYLLABLES = ("ka", "to", "ri", "mu", "sen", "lo", "va", "dri", "nel", "po", "gar", "te", "shi", "bo", "lin", "qua")
+
+
+def _word(i):
+    # unique pseudo-word for every i (its base-16 digits as syllables), so that the tokenizer does roughly the same
+    # work as on real text
+    syllables = []
+    i += 1
+    while i > 0:
+        i, digit = divmod(i, len(SYLLABLES))
+        syllables.append(SYLLABLES[digit])
+    return "".join(syllables)
+
+
+class _ZipfSampler:
+    def __init__(self, vocabulary, rng, exponent=1.1):
+        self.vocabulary = np.array(vocabulary)
+        self.rng = rng
+        p = 1.0 / np.arange(1, len(vocabulary) + 1) ** exponent
+        # inverse transform sampling, rng.choice(p=...) rebuilds the CDF on every call
+        self.cdf = np.cumsum(p / p.sum())
+
+    def words(self, n):
+        indices = np.minimum(np.searchsorted(self.cdf, self.rng.random(n)), len(self.cdf) - 1)
+        return self.vocabulary[indices].tolist()
+
+
+def write_synthetic_dataset(folder, n_queries, n_docs, doc_length=200, query_length=60, vocab_size=50000,
+                            neg_fraction=0.7, seed=42):
+    """
+    Writes a dataset in the layout of dataset/{Movies, Books}: documents.json (one gold document per query),
+    negative_documents.json and hard_negative_documents.json (the remaining n_docs - n_queries documents,
+    neg_fraction of them negatives), and splits/test (queries.json, qrels.txt). Words are drawn from a Zipfian
+    distribution, half of the words of a query are taken from its gold document
+    """
+    assert n_docs >= n_queries, "every query needs a gold document"
+    rng = np.random.default_rng(seed)
+    sampler = _ZipfSampler([_word(i) for i in range(vocab_size)], rng)
+    os.makedirs(os.path.join(folder, "splits", "test"), exist_ok=True)
+
+    def make_doc(doc_id):
+        length = max(int(rng.normal(doc_length, doc_length / 4)), 10)
+        return {"id": doc_id, "title": " ".join(sampler.words(3)), "text": " ".join(sampler.words(length)),
+                "meta": {}}
+
+    queries, qrels = [], []
+    with open(os.path.join(folder, "documents.json"), "w") as writer:
+        for i in range(n_queries):
+            doc = make_doc(f"syn_pos_{i}")
+            writer.write(json.dumps(doc) + "\n")
+            doc_words = doc["text"].split()
+            from_doc = [doc_words[j] for j in rng.integers(0, len(doc_words), size=query_length // 2)]
+            description = from_doc + sampler.words(query_length - len(from_doc))
+            rng.shuffle(description)
+            queries.append({"id": f"syn_q_{i}", "title": " ".join(sampler.words(8)),
+                            "description": " ".join(description)})
+            qrels.append(f"syn_q_{i} 0 {doc['id']} 1\n")
+
+    n_rest = n_docs - n_queries
+    n_neg = int(n_rest * neg_fraction)
+    for fname, prefix, n in (("negative_documents.json", "syn_neg", n_neg),
+                             ("hard_negative_documents.json", "syn_hn", n_rest - n_neg)):
+        with open(os.path.join(folder, fname), "w") as writer:
+            for i in range(n):
+                writer.write(json.dumps(make_doc(f"{prefix}_{i}")) + "\n")
+
+    utils.write_jsonl(queries, os.path.join(folder, "splits", "test", "queries.json"))
+    with open(os.path.join(folder, "splits", "test", "qrels.txt"), "w") as writer:
+        writer.writelines(qrels)
+    log.info(f"Wrote a synthetic dataset with {n_queries} queries and {n_docs} documents to {folder}")
+    return folder
@@ -1,12 +1,21 @@
+import copy
+import hashlib
 import logging
-from collections import defaultdict
 from typing import List, Optional, Tuple
 import shutil
+import threading
+import numpy as np
 import pandas as pd
 import pyterrier as pt
 from haystack.retriever.base import BaseRetriever
 import os
-from tomt.benchmarks.lexical_utils import get_std_utils, Utils
+import time
+from tomt.benchmarks.columnar import ColumnarIndex, ColumnarIndexWriter, columnar_exists
+from tomt.benchmarks.feature_cache import FeatureCache
+from tomt.benchmarks.lexical_utils import get_std_utils, Utils, tokenize_keyed
+from tomt.benchmarks.manifest import IndexManifest, check_legacy_index
+from tomt.benchmarks.query_pipeline import prune_queries
+from tomt.benchmarks.results import group_by_qid
 
 if not pt.started():
     pt.init()
@@ -14,8 +23,40 @@ if not pt.started():
 log = logging.getLogger(__name__)
 
 
+def index_fingerprint(properties_path):
+    """
+    Fingerprint of a terrier index: hash of its data.properties, which changes whenever the index is rebuilt
+    """
+    with open(properties_path, "rb") as reader:
+        return hashlib.md5(reader.read()).hexdigest()
+
+
+def merge_indexes(index_path_a, index_path_b, out_path):
+    """
+    Merges two terrier indexes into a new one, the documents of b come after the documents of a
+    """
+    index_on_disk = pt.autoclass("org.terrier.structures.IndexOnDisk")
+    structure_merger = pt.autoclass("org.terrier.structures.merging.StructureMerger")
+    os.makedirs(out_path)
+    src_a = index_on_disk.createIndex(index_path_a, "data")
+    src_b = index_on_disk.createIndex(index_path_b, "data")
+    dest = index_on_disk.createNewIndex(out_path, "data")
+    log.info(f"Merging {index_path_a} and {index_path_b} into {out_path}")
+    structure_merger(src_a, src_b, dest).mergeStructures()
+    for index in (src_a, src_b, dest):
+        index.close()
+
+
 class TerrierIndex:
-    def __init__(self, index):
+    DOC_STATS_PREFIX = "doc_stats_"
+
+    def __init__(self, index, columnar_folder=None):
+        # memory-mapped mode: all lookups are served from a columnar export, no JVM round-trips
+        self.columnar = None
+        if columnar_folder is not None:
+            self._init_columnar(columnar_folder)
+            return
+
         self.i = pt.IndexFactory.of(index)
         self.lex = self.i.getLexicon()
 
@@ -23,87 +64,301 @@ class TerrierIndex:
         self.inv = self.i.getInvertedIndex()
         self.di = self.i.getDirectIndex()
         self.doi = self.i.getDocumentIndex()
-        self.doc_lengths = {}
-        self.doc_n_unique_terms = {}
 
-        # docno is used internally by terrier
-        self.docno_to_docid = {}
-        # doc_id is what we use
-        self.docid_to_docno = {}
+        # document statistics are typed arrays indexed by docno (used internally by terrier),
+        # doc_id (what we use) is mapped to docno with a binary search on a sorted docid table
+        properties_path = index if index.endswith(".properties") else os.path.join(index, "data.properties")
+        self._set_doc_stats(self._load_doc_stats(properties_path))
+        self.total_frequency = self.i.getCollectionStatistics().numberOfTokens
 
+    def _load_doc_stats(self, properties_path):
+        index_folder = os.path.dirname(properties_path)
+        cache_name = f"{self.DOC_STATS_PREFIX}{index_fingerprint(properties_path)}.npz"
+        cache_path = os.path.join(index_folder, cache_name)
+        if os.path.exists(cache_path):
+            log.info(f"Loading document statistics from {cache_path}")
+            with np.load(cache_path) as stats:
+                return dict(stats)
+
+        stats = self._gather_doc_stats()
+        # stale statistics of a previous version of the index
+        for f in os.listdir(index_folder):
+            if f.startswith(self.DOC_STATS_PREFIX) and f != cache_name:
+                os.remove(os.path.join(index_folder, f))
+        np.savez(cache_path, **stats)
+        return stats
+
+    def _gather_doc_stats(self):
         log.info("Gathering document statistics")
-        sum_doc_length = 0
-        for docno in range(self.doi.getNumberOfDocuments()):
-            doc_id = self.meta.getItem("docno", docno)
+        n_docs = self.doi.getNumberOfDocuments()
+        doc_lengths = np.empty(n_docs, dtype=np.int32)
+        doc_n_unique_terms = np.empty(n_docs, dtype=np.int32)
+        docids = []
+        for docno in range(n_docs):
+            docids.append(self.meta.getItem("docno", docno))
             doc = self.doi.getDocumentEntry(docno)
-            doc_len = doc.getDocumentLength()
-            sum_doc_length += doc_len
-            self.doc_lengths[doc_id] = doc_len
-            self.doc_n_unique_terms[doc_id] = doc.getNumberOfEntries()
-            self.docno_to_docid[docno] = doc_id
-            self.docno_to_docid[doc_id] = docno
+            doc_lengths[docno] = doc.getDocumentLength()
+            doc_n_unique_terms[docno] = doc.getNumberOfEntries()
 
+        docids = np.array(docids)
+        sorted_docnos = np.argsort(docids, kind="stable").astype(np.int32)
+        log.info("Gathering document statistics complete!")
+        return {
+            "doc_lengths": doc_lengths,
+            "doc_n_unique_terms": doc_n_unique_terms,
+            "docids": docids,
+            "sorted_docids": docids[sorted_docnos],
+            "sorted_docnos": sorted_docnos
+        }
+
+    def _set_doc_stats(self, stats):
+        self.doc_lengths = stats["doc_lengths"]
+        self.doc_n_unique_terms = stats["doc_n_unique_terms"]
+        # docno -> doc_id
+        self.docids = stats["docids"]
+        self.sorted_docids = stats["sorted_docids"]
+        self.sorted_docnos = stats["sorted_docnos"]
         self.n_docs = len(self.doc_lengths)
-        self.mean_doc_length = sum_doc_length / self.n_docs
-        self.total_frequency = self.i.getCollectionStatistics().numberOfTokens
+        self.mean_doc_length = self.doc_lengths.sum(dtype=np.int64) / self.n_docs
+
+    def _init_columnar(self, columnar_folder):
+        log.info(f"Loading columnar index from {columnar_folder}")
+        self.columnar = ColumnarIndex(columnar_folder)
+        docids = np.array(self.columnar.docids)
+        sorted_docnos = np.argsort(docids, kind="stable").astype(np.int32)
+        self._set_doc_stats({
+            "doc_lengths": self.columnar.doc_lengths,
+            "doc_n_unique_terms": self.columnar.doc_n_unique_terms,
+            "docids": docids,
+            "sorted_docids": docids[sorted_docnos],
+            "sorted_docnos": sorted_docnos
+        })
+        self.total_frequency = self.columnar.total_frequency
+
+    def get_docno(self, doc_id):
+        pos = np.searchsorted(self.sorted_docids, doc_id)
+        if pos == len(self.sorted_docids) or self.sorted_docids[pos] != doc_id:
+            raise KeyError(doc_id)
+        return int(self.sorted_docnos[pos])
+
+    def get_docnos(self, doc_ids):
+        """
+        Vectorized get_docno
+        """
+        doc_ids = np.asarray(doc_ids)
+        pos = np.searchsorted(self.sorted_docids, doc_ids)
+        found = pos < len(self.sorted_docids)
+        found[found] = self.sorted_docids[pos[found]] == doc_ids[found]
+        if not found.all():
+            raise KeyError(doc_ids[~found][0])
+        return self.sorted_docnos[pos]
+
+    def export_columnar(self, out_folder):
+        """
+        One-time export of the lexicon, postings and document lengths into memory-mappable
+        NumPy arrays (CSR layout), see tomt.benchmarks.columnar
+        """
+        assert self.columnar is None, "index is already columnar"
+        log.info(f"Exporting postings to {out_folder}")
+        writer = ColumnarIndexWriter(out_folder)
+        n_terms = self.i.getCollectionStatistics().getNumberOfUniqueTerms()
+        print_every = max(n_terms // 25, 5)
+        for i, kv in enumerate(self.lex, 1):
+            if i % print_every == 0:
+                log.info(f"\t{i} of {n_terms} terms done")
+            docnos, tfs = [], []
+            for posting in self.inv.getPostings(kv.getValue()):
+                docnos.append(posting.getId())
+                tfs.append(posting.getFrequency())
+            writer.add_term(kv.getKey(), docnos, tfs)
 
-        log.info("Gathering document statistics complete!")
+        writer.close(self.docids.tolist(), self.doc_lengths, self.doc_n_unique_terms)
+        log.info("Exporting postings complete!")
 
     def get_df(self, term):
+        if self.columnar is not None:
+            return self.columnar.get_df(term)
         return self.lex[term].getDocumentFrequency() if term in self.lex else 0
 
-    def get_docs_tf(self, term):
+    def get_postings(self, term):
+        """
+        Returns (docnos, tfs) as arrays. In columnar mode, these are zero-copy slices
+        """
+        if self.columnar is not None:
+            return self.columnar.get_postings(term)
         le = self.lex.getLexiconEntry(term)
+        docnos, tfs = [], []
         # OOV
-        if not le:
-            return []
-        doc_ids = []
-        for posting in self.inv.getPostings(le):
-            doc_id = self.docno_to_docid[posting.getId()]
-            doc_ids.append((doc_id, posting.getFrequency()))
-        return doc_ids
+        if le:
+            for posting in self.inv.getPostings(le):
+                docnos.append(posting.getId())
+                tfs.append(posting.getFrequency())
+        return np.array(docnos, dtype=np.int32), np.array(tfs, dtype=np.int32)
+
+    def get_docs_tf(self, term):
+        docnos, tfs = self.get_postings(term)
+        return list(zip(self.docids[docnos].tolist(), tfs.tolist()))
 
     def get_collection_tf(self, term):
+        if self.columnar is not None:
+            return self.columnar.get_collection_tf(term)
         le = self.lex.getLexiconEntry(term)
         if not le:
             return 0
         return le.getFrequency()
 
     def get_doc_stats(self, doc_id):
+        docno = self.get_docno(doc_id)
         return {
-            "n_unique_terms": self.doc_n_unique_terms[doc_id],
-            "doc_len": self.doc_lengths[doc_id]
+            "n_unique_terms": int(self.doc_n_unique_terms[docno]),
+            "doc_len": int(self.doc_lengths[docno])
         }
 
 
+class TermPipeline:
+    """
+    Terrier's term pipeline of an index (e.g. stopword removal + Porter stemming), maps our tokens to lexicon terms
+    """
+
+    def __init__(self, index_inst):
+        pipeline = index_inst.getProperties().getProperty("termpipelines", "Stopwords,PorterStemmer")
+        pipes = [p for p in pipeline.split(",") if p.strip()]
+        self.accessor = pt.autoclass("org.terrier.terms.BaseTermPipelineAccessor")(*pipes) if pipes else None
+        self._cache = {}
+
+    def __call__(self, token):
+        """
+        Lexicon term of token, None if it is removed (e.g. a stopword)
+        """
+        if self.accessor is None:
+            return token
+        if token not in self._cache:
+            self._cache[token] = self.accessor.pipelineTerm(token)
+        return self._cache[token]
+
+
+class TermStatistics:
+    """
+    Term statistics of an open index, shared by all copies of a retriever (see TerrierRetriever.with_config), which
+    may be used from several threads: the term pipeline is stateful, and the columnar export is written on first use
+    """
+
+    def __init__(self, indexer):
+        self.indexer = indexer
+        self._lock = threading.Lock()
+        self._process_term = None
+        self._columnar_index = None
+        # lexicon term -> document frequency
+        self._dfs = {}
+
+    def _term_pipeline(self):
+        if self._process_term is None:
+            self._process_term = TermPipeline(self.indexer.index_inst)
+        return self._process_term
+
+    def document_frequencies(self, tokens):
+        """
+        Document frequency of every token (after Terrier's term pipeline, 0 for stopwords), read from the lexicon
+        """
+        with self._lock:
+            process_term = self._term_pipeline()
+            lex = self.indexer.index_inst.getLexicon()
+            dfs = []
+            for term in (process_term(t) for t in tokens):
+                if term is None:
+                    dfs.append(0)
+                    continue
+                if term not in self._dfs:
+                    entry = lex.getLexiconEntry(term)
+                    self._dfs[term] = entry.getDocumentFrequency() if entry is not None else 0
+                dfs.append(self._dfs[term])
+            return dfs
+
+    def columnar(self):
+        """
+        (columnar index, term pipeline), the index is exported on first use
+        """
+        with self._lock:
+            if self._columnar_index is None:
+                self._columnar_index = self.indexer.get_index(columnar=True)
+            return self._columnar_index, self._term_pipeline()
+
+
 class TerrierIndexer:
-    def __init__(self, index_path, document_store, utils_inst, query_utils_inst, overwrite_index=False):
+    def __init__(self, index_path, document_store, utils_inst, query_utils_inst, overwrite_index=False,
+                 n_workers=1):
         self.index_path = index_path
         self.overwrite_index = overwrite_index
+        # > 1: documents are tokenized in a process pool while the index is being built
+        self.n_workers = n_workers
         self.utils = utils_inst
         self.query_utils = query_utils_inst
 
-        documents = document_store.get_all_documents()
         if self.overwrite_index and os.path.exists(self.index_path):
             log.warning("Overwriting index")
             shutil.rmtree(self.index_path)
 
+        # content hashes of the documents, to detect stale indexes and added documents
+        documents = document_store.get_all_documents()
+        manifest = IndexManifest.from_documents(documents, self.utils.settings())
         if not os.path.exists(self.index_path):
             log.info("Building index")
-            iter_indexer = pt.IterDictIndexer(self.index_path)
-            iter_indexer.index(self.terrier_iter_dict(documents),
-                               fields=("text",))
+            self.build(self.index_path, documents)
+            manifest.save(self.index_path)
             log.info("Building index complete!")
         else:
-            log.info("Using prebuilt index")
+            indexed = IndexManifest.load(self.index_path)
+            if indexed is None:
+                check_legacy_index(self.index_path, TerrierIndex(os.path.join(index_path, "data.properties")).docids,
+                                   manifest)
+                added = []
+            else:
+                added = indexed.check_appendable(manifest, self.index_path)
+            if added:
+                added = set(added)
+                self.add_documents([doc for doc in documents if doc.id in added], manifest)
+            else:
+                log.info("Using prebuilt index")
 
         self.index_ref = os.path.join(index_path, "data.properties")
         self.index_inst = pt.IndexFactory.of(self.index_ref)
 
         log.info(f"Index stats:\n{self.index_inst.getCollectionStatistics().toString()}")
 
-    def get_index(self):
-        return TerrierIndex(self.index_ref)
+    def build(self, index_path, documents):
+        iter_indexer = pt.IterDictIndexer(index_path)
+        iter_indexer.index(self.terrier_iter_dict(documents), fields=("text",))
+
+    def add_documents(self, documents, manifest):
+        """
+        Indexes documents into a delta index, which is then merged with the existing index (the existing index is
+        replaced once the merge is complete)
+        """
+        log.info(f"Adding {len(documents)} documents to {self.index_path}")
+        delta_path, merged_path, old_path = (self.index_path + suffix for suffix in (".delta", ".merged", ".old"))
+        for path in (delta_path, merged_path, old_path):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+        self.build(delta_path, documents)
+        merge_indexes(self.index_path, delta_path, merged_path)
+        os.rename(self.index_path, old_path)
+        os.rename(merged_path, self.index_path)
+        # written last: marks a complete index
+        manifest.save(self.index_path)
+        shutil.rmtree(old_path)
+        shutil.rmtree(delta_path)
+        log.info("Adding documents complete!")
+
+    def get_index(self, columnar=False):
+        if not columnar:
+            return TerrierIndex(self.index_ref)
+
+        # export once, memory-map afterwards
+        columnar_folder = os.path.join(self.index_path, "columnar")
+        if not columnar_exists(columnar_folder):
+            TerrierIndex(self.index_ref).export_columnar(columnar_folder)
+        return TerrierIndex(self.index_ref, columnar_folder=columnar_folder)
 
     def process(self, text):
         tokens = self.utils.tokenize(text)
@@ -113,21 +368,37 @@ class TerrierIndexer:
         tokens = self.query_utils.tokenize(text)
         return " ".join(tokens)
 
+    def process_queries(self, texts):
+        return [" ".join(tokens) for tokens in self.query_utils.tokenize_many(texts)]
+
     def terrier_iter_dict(self, documents):
-        N = len(documents)
-        log.info(f"Iterating over {N} documents")
-        print_every = max(N // 25, 5)
-        for i, doc in enumerate(documents, 1):
+        """
+        documents can be any iterable (e.g. a generator), the documents are consumed lazily
+        """
+        N = len(documents) if hasattr(documents, "__len__") else None
+        log.info(f"Iterating over {N if N is not None else 'a stream of'} documents ({self.n_workers} worker(s))")
+        print_every = max(N // 25, 5) if N is not None else 10000
+        start_time = time.time()
+        # documents are consumed once: ids travel with their texts (through the worker pool, if any)
+        processed = tokenize_keyed(self.utils, ((doc.id, doc.text) for doc in documents), self.n_workers)
+        i = 0
+        for i, (doc_id, tokens) in enumerate(processed, 1):
             if i % print_every == 0:
-                log.info(f"\t{i} of {N} done")
+                log.info(f"\t{i} of {N or '?'} done ({i / (time.time() - start_time):0.1f} docs/s)")
             yield {
-                "text": self.process(doc.text),
-                "docno": doc.id
+                "text": " ".join(tokens),
+                "docno": doc_id
             }
+        elapsed = time.time() - start_time
+        log.info(f"Processed {i} documents in {elapsed:0.2f}s ({i / max(elapsed, 1e-9):0.1f} docs/s)")
 
 
 class TerrierRetriever(BaseRetriever):
     OVERWRITE_INDEX = False
+    # number of processes used to tokenize documents when building the index
+    INDEX_WORKERS = 1
+    # BatchRetrieve on one (open) index isn't known to be thread-safe, sweep configs are run one at a time
+    CONCURRENT_CONFIGS = False
 
     def __init__(self, document_store, config_json, top_k):
         super().__init__()
@@ -136,6 +407,11 @@ class TerrierRetriever(BaseRetriever):
         self.documents = {}
         for doc in document_store.get_all_documents():
             self.documents[doc.id] = doc
+        # document index -> document, results refer to documents by their index
+        self.doc_list = list(self.documents.values())
+        self.doc_ids = list(self.documents.keys())
+        # docno -> document index lookups, the hash table is built once
+        self.doc_index = pd.Index(self.doc_ids)
         self.config = config_json
         # params passed on to PyTerrier
         self.controls = self.config["controls"]
@@ -144,27 +420,80 @@ class TerrierRetriever(BaseRetriever):
         self.index_path = self.config["index_path"]
         self.index_ref = None
         self.meta_keys = None
+        # query term pruning: only the max_query_terms terms with the highest IDF are kept (None: no pruning)
+        self.max_query_terms = self.config.get("max_query_terms")
 
         self.utils = get_std_utils()
         # Terrier expects cleaned data for queries only!
         self.query_utils = Utils(remove_square_braces=True, incl_only_alphanumeric=True)
         self.indexer = TerrierIndexer(self.index_path, document_store, self.utils, self.query_utils,
-                                      self.OVERWRITE_INDEX)
+                                      self.OVERWRITE_INDEX, self.config.get("index_workers", self.INDEX_WORKERS))
         self.batch_retriever = pt.BatchRetrieve(self.indexer.index_inst, wmodel=self.wmodel, num_results=self.top_k,
                                                 controls=self.controls)
+        # shared with the copies of with_config, loaded on first use
+        self.term_stats = TermStatistics(self.indexer)
+
+    def with_config(self, config_json):
+        """
+        Copy of this retriever with a different wmodel / controls, sharing the documents and the (open) index
+        """
+        other = copy.copy(self)
+        other.config = {**self.config, **config_json}
+        other.controls = other.config["controls"]
+        other.wmodel = other.config["wmodel"]
+        other.max_query_terms = other.config.get("max_query_terms")
+        other.batch_retriever = pt.BatchRetrieve(self.indexer.index_inst, wmodel=other.wmodel,
+                                                 num_results=self.top_k, controls=other.controls)
+        return other
+
+    def document_frequencies(self, tokens):
+        """
+        Document frequency of every token (after Terrier's term pipeline, 0 for stopwords)
+        """
+        return self.term_stats.document_frequencies(tokens)
+
+    def build_feature_cache(self, queries: List[Tuple[str, List[str]]], path=None, batch_size=1000):
+        """
+        Retrieves the top_k candidates of every (tokenized) query and gathers their lexical features (see
+        tomt.benchmarks.feature_cache), so that other weighting models can be applied without re-running retrieval.
+        The cache is saved to path, if provided
+        """
+        results = {}
+        for i in range(0, len(queries), batch_size):
+            results.update(self.batch_retrieve_tokenized(queries[i:i + batch_size]))
+        # postings are read from the (memory-mapped) columnar export
+        index, process_term = self.term_stats.columnar()
+        cache = FeatureCache.build(index, process_term, queries, results)
+        if path is not None:
+            cache.save(path)
+        return cache
+
+    def _to_ranked_lists(self, res):
+        # vectorized docno -> position in self.doc_list, no per-row python objects
+        doc_indices = self.doc_index.get_indexer(res["docno"]).astype(np.int32)
+        assert (doc_indices >= 0).all(), "retrieved documents missing from the document store"
+        return group_by_qid(res["qid"].to_numpy(), doc_indices, res["score"].to_numpy(), self.doc_list)
 
     def batch_retrieve(self, queries: List[Tuple[str, str]], filters: dict = None,
                        index: str = None):
+        """
+        Returns qid -> RankedList. Queries without results are absent
+        """
         if filters or index:
             raise NotImplementedError("filters/index not supported")
 
-        topics = pd.DataFrame(queries, columns=['qid', 'query'])
-        topics["query"] = topics["query"].apply(self.indexer.process_query)
-        results = defaultdict(list)
-        for _, row in self.batch_retriever.transform(topics).iterrows():
-            results[row["qid"]].append((self.documents[row["docno"]], row["score"]))
+        tokenized = zip((qid for (qid, _) in queries), self.query_utils.tokenize_many(q for (_, q) in queries))
+        return self.batch_retrieve_tokenized(list(tokenized))
 
-        return results
+    def batch_retrieve_tokenized(self, queries: List[Tuple[str, List[str]]]):
+        """
+        Same as batch_retrieve, for queries that are already tokenized (with self.query_utils)
+        """
+        if self.max_query_terms:
+            queries = prune_queries(queries, self.document_frequencies, self.max_query_terms)
+        topics = pd.DataFrame([(qid, " ".join(tokens)) for (qid, tokens) in queries], columns=['qid', 'query'])
+        # terrier returns results grouped by qid, in rank order
+        return self._to_ranked_lists(self.batch_retriever.transform(topics))
 
     def retrieve(self, query, filters: dict = None, top_k: Optional[int] = None, index: str = None):
         if filters or index:
@@ -173,8 +502,8 @@ class TerrierRetriever(BaseRetriever):
         if top_k:
             raise ValueError("Provide top_k arg only in constructor")
 
-        results = []
-        for _, row in self.batch_retriever.search(self.indexer.process_query(query.text)).iterrows():
-            results.append((self.documents[row["docno"]], row["score"]))
-
-        return results
+        ranked_lists = self.batch_retrieve_tokenized([("1", self.query_utils.tokenize(query.text))])
+        # no results
+        if len(ranked_lists) == 0:
+            return []
+        return next(iter(ranked_lists.values()))
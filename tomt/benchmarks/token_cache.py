@@ -0,0 +1,102 @@
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# max. number of parameters in a single sqlite query
+_SQLITE_BATCH_SIZE = 500
+
+
+def cache_key(text, *flags):
+    """
+    Key of a tokenized text: hash of the text and the tokenizer flags, so that edited texts
+    (or different tokenizer settings) never hit a stale entry
+    """
+    h = hashlib.sha1()
+    h.update("_".join(str(f) for f in flags).encode("utf-8"))
+    h.update(b"\0")
+    h.update(text.encode("utf-8"))
+    return h.hexdigest()
+
+
+class TokenCache:
+    """
+    Single-file (sqlite) store of tokenized texts, with an optional in-process LRU in front of it
+    """
+
+    def __init__(self, path, lru_size=0):
+        self.path = path
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # connections can't be shared with forked processes
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, tokens TEXT NOT NULL)")
+            self._pid = os.getpid()
+        return self._conn
+
+    def _lru_put(self, key, tokens):
+        if self.lru_size <= 0:
+            return
+        self.lru[key] = tokens
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def get_many(self, keys):
+        """
+        Returns key -> tokens, for keys that are in the cache
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                found[key] = self.lru[key]
+            else:
+                missing.append(key)
+
+        for i in range(0, len(missing), _SQLITE_BATCH_SIZE):
+            batch = missing[i:i + _SQLITE_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            for key, tokens in self.conn.execute(f"SELECT key, tokens FROM tokens WHERE key IN ({placeholders})",
+                                                 batch):
+                tokens = json.loads(tokens)
+                found[key] = tokens
+                self._lru_put(key, tokens)
+        return found
+
+    def put_many(self, items):
+        """
+        Stores (key, tokens) pairs
+        """
+        items = list(items)
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO tokens (key, tokens) VALUES (?, ?)",
+                                  [(key, json.dumps(tokens)) for key, tokens in items])
+        for key, tokens in items:
+            self._lru_put(key, tokens)
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put(self, key, tokens):
+        self.put_many([(key, tokens)])
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,258 @@
+import os
+import json
+import logging
+from array import array
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from tomt.data.utils import iter_jsonl, read_json, write_json
+
+log = logging.getLogger(__name__)
+
+CORPUS_FOLDER = "corpus"
+HEADER_FILE = "corpus.json"
+IDS_FILE = "ids.json"
+TYPES_FILE = "types.npy"
+OFFSETS_FILE = "offsets.npy"
+BLOB_FILE = "blob.bin"
+NULLS_FILE = "nulls.npy"
+# corpora of another version are rebuilt
+CORPUS_VERSION = 3
+
+# source file -> document type
+SOURCE_FILES = {
+    "documents.json": "pos",
+    "negative_documents.json": "neg",
+    "hard_negative_documents.json": "hard_neg"
+}
+DOC_TYPES = ("pos", "neg", "hard_neg")
+# every document has 3 fields in the blob: title, text, meta (as JSON)
+FIELDS = ("title", "text", "meta")
+# bit masks per document: field i is None (bit i) or absent (bit len(FIELDS) + i)
+MISSING_SHIFT = len(FIELDS)
+
+
+def _source_stats(folder_path):
+    stats = {}
+    for fname in SOURCE_FILES:
+        fpath = os.path.join(folder_path, fname)
+        if os.path.exists(fpath):
+            st = os.stat(fpath)
+            stats[fname] = {"size": st.st_size, "mtime": st.st_mtime}
+    return stats
+
+
+def convert_corpus(folder_path, out_folder=None):
+    """
+    Converts documents.json / negative_documents.json / hard_negative_documents.json (JSONL) in folder_path into
+    a columnar binary corpus: an id table, a type column and offsets of (title, text, meta) into one UTF-8 blob.
+    Fields that are None or absent are stored as empty strings, and flagged in a bit mask per document, so that
+    documents read back are equal to the JSONL ones. Keys other than id and FIELDS are not kept
+    """
+    out_folder = out_folder or os.path.join(folder_path, CORPUS_FOLDER)
+    os.makedirs(out_folder, exist_ok=True)
+
+    ids = []
+    types = array("b")
+    nulls = array("b")
+    offsets = array("q", [0])
+    with open(os.path.join(out_folder, BLOB_FILE), "wb") as blob:
+        pos = 0
+        for fname, doc_type in SOURCE_FILES.items():
+            fpath = os.path.join(folder_path, fname)
+            if not os.path.exists(fpath):
+                log.warning(f"{fpath} does not exist, skipping")
+                continue
+            for doc in iter_jsonl(fpath, fast=True):
+                ids.append(doc["id"])
+                types.append(DOC_TYPES.index(doc_type))
+                null_mask = 0
+                for field_index, field in enumerate(FIELDS):
+                    value = doc.get(field)
+                    if field not in doc:
+                        null_mask |= 1 << (MISSING_SHIFT + field_index)
+                    elif field == "meta":
+                        value = json.dumps(value)
+                    elif value is None:
+                        null_mask |= 1 << field_index
+                    encoded = (value or "").encode("utf-8")
+                    blob.write(encoded)
+                    pos += len(encoded)
+                    offsets.append(pos)
+                nulls.append(null_mask)
+
+    np.save(os.path.join(out_folder, TYPES_FILE), np.frombuffer(types, dtype=np.int8))
+    np.save(os.path.join(out_folder, OFFSETS_FILE), np.frombuffer(offsets, dtype=np.int64))
+    np.save(os.path.join(out_folder, NULLS_FILE), np.frombuffer(nulls, dtype=np.int8))
+    write_json(ids, os.path.join(out_folder, IDS_FILE))
+    # written last: marks a complete corpus, sources are used to detect stale corpora
+    write_json({
+        "version": CORPUS_VERSION,
+        "n_docs": len(ids),
+        "sources": _source_stats(folder_path)
+    }, os.path.join(out_folder, HEADER_FILE), indent=2)
+
+    log.info(f"Wrote {len(ids)} documents to {out_folder}")
+    return out_folder
+
+
+def corpus_up_to_date(folder_path):
+    header_path = os.path.join(folder_path, CORPUS_FOLDER, HEADER_FILE)
+    if not os.path.exists(header_path):
+        return False
+    header = read_json(header_path)
+    return header.get("version") == CORPUS_VERSION and header["sources"] == _source_stats(folder_path)
+
+
+class DocumentView(Mapping):
+    """
+    Lightweight, read-only view of a single document in a Corpus. Behaves like the document dict
+    ("id", "title", "text", "meta", unless absent from the source), fields are decoded on access
+    """
+    __slots__ = ("corpus", "index")
+
+    def __init__(self, corpus, index):
+        self.corpus = corpus
+        self.index = index
+
+    def __getitem__(self, key):
+        if key == "id":
+            return self.corpus.ids[self.index]
+        if key not in FIELDS or self.corpus.is_missing(self.index, FIELDS.index(key)):
+            raise KeyError(key)
+        field_index = FIELDS.index(key)
+        if self.corpus.is_null(self.index, field_index):
+            return None
+        value = self.corpus.field(self.index, field_index)
+        return json.loads(value) if key == "meta" else value
+
+    def __iter__(self):
+        yield "id"
+        for field_index, field in enumerate(FIELDS):
+            if not self.corpus.is_missing(self.index, field_index):
+                yield field
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"DocumentView({self.corpus.ids[self.index]})"
+
+
+class Corpus:
+    """
+    Memory-mapped reader for a corpus written by convert_corpus
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.ids = read_json(os.path.join(folder, IDS_FILE))
+        self.types = np.load(os.path.join(folder, TYPES_FILE), mmap_mode="r")
+        self.offsets = np.load(os.path.join(folder, OFFSETS_FILE), mmap_mode="r")
+        self.nulls = np.load(os.path.join(folder, NULLS_FILE), mmap_mode="r")
+        if self.offsets[-1] > 0:
+            self.blob = np.memmap(os.path.join(folder, BLOB_FILE), dtype=np.uint8, mode="r")
+        else:
+            # empty files can't be memory-mapped
+            self.blob = np.zeros(0, dtype=np.uint8)
+        self._id_to_index = None
+        assert len(self.ids) == len(self.types) == len(self.nulls) == (len(self.offsets) - 1) // len(FIELDS)
+
+    @property
+    def id_to_index(self):
+        # built on first use
+        if self._id_to_index is None:
+            self._id_to_index = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        return self._id_to_index
+
+    def __len__(self):
+        return len(self.ids)
+
+    def field(self, index, field_index):
+        pos = index * len(FIELDS) + field_index
+        return self.blob[self.offsets[pos]:self.offsets[pos + 1]].tobytes().decode("utf-8")
+
+    def is_null(self, index, field_index):
+        return bool(self.nulls[index] & (1 << field_index))
+
+    def is_missing(self, index, field_index):
+        return bool(self.nulls[index] & (1 << (MISSING_SHIFT + field_index)))
+
+    def __getitem__(self, index):
+        return DocumentView(self, index)
+
+    def get(self, doc_id):
+        return DocumentView(self, self.id_to_index[doc_id])
+
+    def type_of(self, index):
+        return DOC_TYPES[self.types[index]]
+
+    def select(self, doc_types):
+        """
+        View of all documents of the given types, in corpus order
+        """
+        codes = [DOC_TYPES.index(t) for t in doc_types]
+        return CorpusView(self, np.flatnonzero(np.isin(self.types, codes)))
+
+
+class CorpusView(Sequence):
+    """
+    A subset of the documents of a Corpus, with O(1) random access by position or id
+    """
+
+    def __init__(self, corpus, indices):
+        self.corpus = corpus
+        self.indices = indices
+        self._selected = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return CorpusView(self.corpus, self.indices[i])
+        return self.corpus[int(self.indices[i])]
+
+    def __contains__(self, doc_id):
+        return self.index_of(doc_id) is not None
+
+    def index_of(self, doc_id):
+        index = self.corpus.id_to_index.get(doc_id)
+        if index is None:
+            return None
+        if self._selected is None:
+            self._selected = np.zeros(len(self.corpus), dtype=bool)
+            self._selected[self.indices] = True
+        return index if self._selected[index] else None
+
+    def get(self, doc_id):
+        index = self.index_of(doc_id)
+        if index is None:
+            raise KeyError(doc_id)
+        return self.corpus[index]
+
+    def type_dict(self):
+        return TypeView(self)
+
+
+class TypeView(Mapping):
+    """
+    doc_id -> type ("pos", "neg" or "hard_neg") of the documents in a CorpusView
+    """
+
+    def __init__(self, view):
+        self.view = view
+
+    def __getitem__(self, doc_id):
+        index = self.view.index_of(doc_id)
+        if index is None:
+            raise KeyError(doc_id)
+        return self.view.corpus.type_of(index)
+
+    def __iter__(self):
+        for i in self.view.indices.tolist():
+            yield self.view.corpus.ids[i]
+
+    def __len__(self):
+        return len(self.view)
@@ -0,0 +1,148 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: on average `rate` acquisitions per second, with bursts of up to `capacity`
+    """
+
+    def __init__(self, rate, capacity=None):
+        assert rate > 0
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        """
+        Blocks until n tokens are available. Returns the time spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return waited
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class ProgressReporter:
+    """
+    Thread-safe progress counter, logs throughput (over the last interval and overall) and the ETA every
+    `every` seconds
+    """
+
+    def __init__(self, total, every=30.0, name="downloads"):
+        self.total = total
+        self.every = every
+        self.name = name
+        self.counts = {"done": 0, "failed": 0}
+        self.start_time = time.monotonic()
+        self._last_report = (self.start_time, 0)
+        self._lock = threading.Lock()
+
+    def update(self, status="done"):
+        with self._lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            now = time.monotonic()
+            if now - self._last_report[0] >= self.every:
+                self._log(now)
+
+    def _log(self, now):
+        finished = sum(self.counts.values())
+        last_time, last_finished = self._last_report
+        current_rate = (finished - last_finished) / max(now - last_time, 1e-9)
+        overall_rate = finished / max(now - self.start_time, 1e-9)
+        remaining = self.total - finished
+        eta = remaining / overall_rate if overall_rate > 0 else float("inf")
+        log.info(f"{self.name}: {finished}/{self.total} ({self.counts}), {current_rate:0.2f}/s "
+                 f"(overall {overall_rate:0.2f}/s), ETA {eta / 60:0.1f} min")
+        self._last_report = (now, finished)
+
+    def summary(self):
+        with self._lock:
+            self._log(time.monotonic())
+            return dict(self.counts)
+
+
+def with_retries(fn, retries=3, backoff=1.0, max_backoff=60.0, retry_on=(Exception,), give_up_on=(),
+                 description=""):
+    """
+    Calls fn(), retrying up to `retries` times on the retry_on exceptions (unless they are give_up_on exceptions)
+    with exponential backoff (with jitter)
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except give_up_on:
+            raise
+        except retry_on as e:
+            if attempt == retries:
+                raise
+            delay = min(max_backoff, backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+            log.debug(f"{description} failed ({e.__class__.__name__}: {e}), retry {attempt + 1}/{retries} "
+                      f"in {delay:0.1f}s")
+            time.sleep(delay)
+
+
+class ConcurrentDownloader:
+    """
+    Runs fetch(item) for every item in a pool of worker threads. fetch is expected to rate limit its own requests
+    (e.g. with a shared TokenBucket) and to enforce its own deadline (no signals: they only work in the main thread).
+    Failed items are retried with backoff; on_result(item, result) and on_skip(item, exception) (for the skip_on
+    exceptions) are called from the worker threads
+    """
+
+    def __init__(self, fetch, n_workers=8, retries=3, backoff=1.0, retry_on=(Exception,), skip_on=(),
+                 report_every=30.0):
+        self.fetch = fetch
+        self.n_workers = n_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_on = retry_on
+        # exceptions that mark an item as permanently unavailable (e.g. not found), no retries
+        self.skip_on = skip_on
+        self.report_every = report_every
+
+    def _run_one(self, item, on_result, on_skip, progress, failures):
+        try:
+            result = with_retries(lambda: self.fetch(item), self.retries, self.backoff,
+                                  retry_on=self.retry_on, give_up_on=self.skip_on, description=str(item))
+        except self.skip_on as e:
+            if on_skip is not None:
+                on_skip(item, e)
+            failures.setdefault(e.__class__.__name__, []).append(item)
+            progress.update(e.__class__.__name__)
+            return
+        except self.retry_on as e:
+            log.warning(f"{item} failed after {self.retries} retries: {e.__class__.__name__}: {e}")
+            failures.setdefault(e.__class__.__name__, []).append(item)
+            progress.update("failed")
+            return
+        on_result(item, result)
+        progress.update("done")
+
+    def run(self, items, on_result, on_skip=None):
+        """
+        Returns exception name -> items that failed
+        """
+        progress = ProgressReporter(len(items), self.report_every)
+        failures = {}
+        with ThreadPoolExecutor(self.n_workers) as executor:
+            # consume the results, so that unexpected exceptions are raised
+            for f in [executor.submit(self._run_one, item, on_result, on_skip, progress, failures) for item in items]:
+                f.result()
+        log.info(f"Finished: {progress.summary()}")
+        return failures
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from datetime import datetime
+
+import requests
+
+from tomt.data import utils
+from tomt.data.utils import datetime_from_utc, utc_timestamp
+
+log = logging.getLogger(__name__)
+
+PUSHSHIFT_URL = "https://api.pushshift.io/reddit/search/submission/"
+PAGE_SIZE = 1000
+FIELDS = ("created_utc", "id")
+
+
+class AsyncRateLimiter:
+    """
+    Spaces out acquisitions by 1 / rate seconds, over all the coroutines of an event loop
+    """
+
+    def __init__(self, rate):
+        assert rate > 0
+        self.interval = 1.0 / rate
+        self.next_time = 0.0
+
+    async def acquire(self):
+        # no await between reading and reserving the slot, so no lock is needed
+        now = time.monotonic()
+        slot = max(now, self.next_time)
+        self.next_time = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def split_windows(start_utc, end_utc, window_seconds):
+    """
+    [(window_start, window_end)] covering [start_utc, end_utc), latest window first
+    """
+    windows = []
+    end = end_utc
+    while end > start_utc:
+        windows.append((max(start_utc, end - window_seconds), end))
+        end -= window_seconds
+    return windows
+
+
+def _parse_time(t):
+    if isinstance(t, datetime):
+        return t
+    elif isinstance(t, str):
+        return datetime.strptime(t, "%d-%m-%Y")
+    raise ValueError("start/end times have to be strings or datetime objects")
+
+
+def _drop_partial_line(path, block_size=4096):
+    """
+    Truncates path after its last complete line, if the last line is unparsable (a crawl killed while writing).
+    Returns the number of bytes dropped
+    """
+    with open(path, "rb+") as file:
+        size = file.seek(0, os.SEEK_END)
+        # start of the last line: after the last newline before the end of the file
+        end = size
+        while end > 0:
+            start = max(end - block_size, 0)
+            file.seek(start)
+            newline = file.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        file.seek(end)
+        last_line = file.read()
+        if not last_line.strip():
+            return 0
+        try:
+            json.loads(last_line)
+        except ValueError:
+            file.truncate(end)
+            return size - end
+        # complete, but without the newline: lines appended later must not be glued to it
+        file.write(b"\n")
+        return 0
+
+
+class PushshiftCrawler:
+    """
+    Crawls the submissions of a subreddit in [start, end] by splitting the range into time windows that are paged
+    (backwards, like get_all_submissions) concurrently, under a global rate limit. Submissions are deduplicated and
+    appended to a JSONL file as pages arrive. The cursor of every window is checkpointed in {output}.checkpoint.json
+    after every page, so an interrupted crawl resumes where it stopped
+    """
+
+    def __init__(self, output, subreddit="tipofmytongue", requests_per_second=1.0, max_concurrent=4,
+                 retry_count=10, backoff=1.0, timeout=30, url=PUSHSHIFT_URL):
+        self.output = output
+        self.checkpoint_path = output + ".checkpoint.json"
+        self.subreddit = subreddit
+        self.requests_per_second = requests_per_second
+        self.max_concurrent = max_concurrent
+        self.retry_count = retry_count
+        self.backoff = backoff
+        self.timeout = timeout
+        self.url = url
+
+    def _request(self, after, before):
+        response = requests.get(self.url, params={"subreddit": self.subreddit, "after": after, "before": before,
+                                                  "limit": PAGE_SIZE, "fields": ",".join(FIELDS)},
+                                timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["data"]
+
+    async def _get_page(self, after, before):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retry_count + 1):
+            await self.rate_limiter.acquire()
+            try:
+                # requests is blocking, it runs in the default executor
+                return await loop.run_in_executor(None, self._request, after, before)
+            except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                if attempt == self.retry_count:
+                    raise ValueError(f"Failed to get valid response from Pushshift (after={after}, before={before})") \
+                        from e
+                delay = self.backoff * 2 ** min(attempt, 6) * random.uniform(0.5, 1.5)
+                log.info(f"Request failed ({e.__class__.__name__}): Retry {attempt + 1}/{self.retry_count} "
+                         f"in {delay:0.1f}s")
+                await asyncio.sleep(delay)
+
+    def _save_checkpoint(self):
+        with open(self.checkpoint_path + ".tmp", "w") as writer:
+            json.dump(self.checkpoint, writer)
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def _write(self, data):
+        n_new = 0
+        for d in data:
+            # windows are disjoint ([start, end)), duplicates come from pages that are fetched again after a resume.
+            # The global bounds are exclusive (as in get_all_submissions)
+            if d["id"] in self.seen or not self.start_utc < d["created_utc"] < self.end_utc:
+                continue
+            self.seen.add(d["id"])
+            self.writer.write(json.dumps({k: d[k] for k in FIELDS}) + "\n")
+            n_new += 1
+        # flushed before the checkpoint is saved: a crash in between only causes duplicates, which are skipped
+        self.writer.flush()
+        return n_new
+
+    async def _crawl_window(self, window_start, window_end):
+        key = f"{window_start}-{window_end}"
+        state = self.checkpoint.setdefault(key, {"before": window_end, "done": False})
+        async with self.semaphore:
+            while not state["done"]:
+                # pushshift's after / before are exclusive
+                data = await self._get_page(window_start - 1, state["before"])
+                self.n_written += self._write(data)
+                if len(data) == 0:
+                    state["done"] = True
+                else:
+                    oldest = min(d["created_utc"] for d in data)
+                    # more than a page of submissions with the same timestamp would never end
+                    state["before"] = oldest if oldest < state["before"] else state["before"] - 1
+                    state["done"] = state["before"] <= window_start
+                self._save_checkpoint()
+            log.info(f"Window {datetime_from_utc(window_start)} - {datetime_from_utc(window_end)} done, "
+                     f"{self.n_written} submissions written")
+
+    async def _crawl(self, windows):
+        self.rate_limiter = AsyncRateLimiter(self.requests_per_second)
+        self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        await asyncio.gather(*[self._crawl_window(start, end) for start, end in windows])
+
+    def crawl(self, start_time, end_time, window_days=30):
+        """
+        start_time / end_time: datetime objects or DD-MM-YYYY strings. Returns the number of submissions written
+        """
+        true_start_time, true_end_time = _parse_time(start_time), _parse_time(end_time)
+        log.info(f"Start Time: {true_start_time}; End Time: {true_end_time}")
+        assert true_end_time > true_start_time
+        self.start_utc = utc_timestamp(true_start_time)
+        self.end_utc = utc_timestamp(true_end_time)
+        windows = split_windows(self.start_utc, self.end_utc, int(window_days * 24 * 3600))
+
+        self.checkpoint = utils.read_json(self.checkpoint_path) if os.path.exists(self.checkpoint_path) else {}
+        self.seen = set()
+        if os.path.exists(self.output):
+            # the checkpoint is saved after a page is written, so the page of a truncated line is fetched again
+            n_dropped = _drop_partial_line(self.output)
+            if n_dropped:
+                log.warning(f"Dropped a truncated last line ({n_dropped} bytes) of {self.output}")
+            self.seen = {d["id"] for d in utils.iter_jsonl(self.output, fields=["id"])}
+        n_done = sum(self.checkpoint.get(f"{s}-{e}", {}).get("done", False) for s, e in windows)
+        log.info(f"{len(windows)} windows ({n_done} already done), {len(self.seen)} submissions already written")
+
+        self.n_written = 0
+        start = time.time()
+        with open(self.output, "a") as self.writer:
+            asyncio.run(self._crawl(windows))
+        log.info(f"A total of {len(self.seen)} submissions downloaded ({self.n_written} new) "
+                 f"in {time.time() - start:0.2f}s")
+        return len(self.seen)
@@ -6,49 +6,102 @@ import argparse
 import pickle as pkl
 from datetime import datetime, timezone
 import random
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
-import pytz
 import praw
 import requests
 from tqdm.autonotebook import tqdm
 from prawcore import exceptions
+from prawcore import Requestor
+
+from tomt.data import utils
+from tomt.data.utils import datetime_from_utc, utc_timestamp
+from tomt.data.downloader import ConcurrentDownloader, TokenBucket
+from tomt.data.store import SubmissionStore, comment_records, submission_record
 
 log = logging.getLogger(__name__)
 
-import signal
-from contextlib import contextmanager
+USER_AGENT = "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:15.0) Gecko/20100101 Firefox/15.0.1"
+# Reddit allows 60 requests per minute per OAuth client (averaged over 10 minutes)
+REQUESTS_PER_SECOND = 1.0
+# number of "load more comments" expanded between two deadline checks
+REPLACE_MORE_STEP = 16
+# transient HTTP errors, retried with backoff (TooManyRequests / 429 is a ResponseException)
+RETRY_ON = (exceptions.RequestException, exceptions.ResponseException)
 
 
 class TimeoutException(Exception): pass
 
 
-@contextmanager
-def time_limit(seconds):
-    def signal_handler(signum, frame):
-        raise TimeoutException("Timed out!")
-
-    signal.signal(signal.SIGALRM, signal_handler)
-    signal.alarm(seconds)
-    try:
-        yield
-    finally:
-        signal.alarm(0)
+# the submission is gone (deleted, removed, private subreddit) or timed out, no retries
+SKIP_ON = (exceptions.NotFound, exceptions.Forbidden, TimeoutException)
 
 
-def utc_timestamp(dt):
+class RateLimitedRequestor(Requestor):
     """
-        Converts a datetime object into a timestamp
+    prawcore Requestor that takes a token from a (shared) TokenBucket before every HTTP request, including the ones
+    of replace_more, so that all workers together stay under the rate limit
     """
-    timezone = pytz.timezone("utc")
-    dt = timezone.localize(dt)
-    return int(dt.timestamp())
 
+    def __init__(self, *args, rate_limiter=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+
+    def request(self, *args, **kwargs):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        return super().request(*args, **kwargs)
 
-def datetime_from_utc(utc):
+    def __reduce__(self):
+        # PRAW objects (e.g. the pickled submissions) reference their requestor: it is pickled as a plain Requestor,
+        # without the rate limiter, so that the pickles can be loaded without this module
+        state = {k: v for k, v in self.__dict__.items() if k != "rate_limiter"}
+        return object.__new__, (Requestor,), state
+
+
+class SubmissionFetcher:
     """
-        Converts a UTC timestamp into a datetime object in the UTC timezone
+    Downloads a submission with all its comments. Every worker thread gets its own (read only) praw.Reddit instance,
+    PRAW isn't thread safe. The timeout is a deadline for the whole submission, checked between requests
+    (replace_more is expanded REPLACE_MORE_STEP "load more comments" at a time) and bounding every HTTP request,
+    so that it works outside of the main thread (unlike SIGALRM).
+    The config may contain "oauth_url" and "reddit_url", e.g. to point PRAW to a local stub server
     """
-    return datetime.fromtimestamp(utc, tz=pytz.utc)
+
+    def __init__(self, config, rate_limiter=None, timeout=None):
+        self.config = config
+        self.rate_limiter = rate_limiter
+        self.timeout = timeout if timeout is not None and timeout > 0 else None
+        self._local = threading.local()
+
+    def _reddit(self):
+        if not hasattr(self._local, "reddit"):
+            kwargs = {k: self.config[k] for k in ("oauth_url", "reddit_url") if k in self.config}
+            if self.timeout is not None:
+                # per HTTP request (PRAW default: 16s)
+                kwargs["timeout"] = self.timeout
+            # we want only read only, so no need to provide username / password
+            reddit = praw.Reddit(client_id=self.config["client_id"],
+                                 client_secret=self.config["client_secret"],
+                                 user_agent=USER_AGENT,
+                                 requestor_class=RateLimitedRequestor,
+                                 requestor_kwargs={"rate_limiter": self.rate_limiter},
+                                 **kwargs)
+            assert reddit.read_only
+            self._local.reddit = reddit
+        return self._local.reddit
+
+    def __call__(self, submission_id):
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        submission = self._reddit().submission(submission_id)
+        # extract all comments
+        while True:
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutException(f"{submission_id} timed out after {self.timeout}s")
+            if len(submission.comments.replace_more(limit=REPLACE_MORE_STEP)) == 0:
+                return submission
 
 
 def pushshift_api(query, after, before, sub):
@@ -208,73 +261,74 @@ def get_submission(submission_id: str, config: dict, get_comments: bool):
         return None
 
 
-def download_submissions(config_file, input_submissions, output_folder, timeout=None):
-    with open(config_file) as reader:
-        config = json.load(reader)
+def report_skipped(submission_id, e):
+    if isinstance(e, TimeoutException):
+        log.warning(f"{submission_id} timed out, skipping")
+    elif isinstance(e, exceptions.NotFound):
+        log.warning(f"{submission_id} not found, skipping")
+    else:
+        log.warning(f"{submission_id} {e.__class__.__name__}, skipping")
 
-    # create reddit instance
-    # we want only read only, so no need to provide username / password
-    reddit = praw.Reddit(client_id=config["client_id"],
-                         client_secret=config["client_secret"],
-                         user_agent="Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:15.0) Gecko/20100101 Firefox/15.0.1")
 
-    assert reddit.read_only
+def download_submissions(config_file, input_submissions, output_folder, timeout=None, n_workers=8,
+                         requests_per_second=REQUESTS_PER_SECOND, retries=3, store_path=None):
+    """
+    Downloads the submissions (and their comments) that aren't in output_folder yet, one pickle per submission.
+    If store_path is provided, they are written to that SubmissionStore instead (output_folder is ignored).
+    n_workers threads share a rate limit of requests_per_second; failed submissions are retried with backoff
+    """
+    with open(config_file) as reader:
+        config = json.load(reader)
 
-    # create directory
-    os.makedirs(output_folder, exist_ok=True)
+    if store_path is not None:
+        submission_store = SubmissionStore(store_path)
+        downloaded = submission_store.ids()
 
-    with open(input_submissions) as reader:
-        submissions = json.load(reader)
+        def save(submission_id, submission):
+            submission_store.add(submission)
+    else:
+        # create directory
+        os.makedirs(output_folder, exist_ok=True)
+        # leftovers of an interrupted run
+        for f in os.listdir(output_folder):
+            if f.endswith(".part"):
+                os.remove(os.path.join(output_folder, f))
+        downloaded = {f.split(".")[0] for f in os.listdir(output_folder)}
+
+        def save(submission_id, submission):
+            pkl_path = os.path.join(output_folder, f"{submission_id}.pkl")
+            # dump the object, the rename makes sure that only complete pickles end up in the folder
+            with open(pkl_path + ".part", "wb") as writer:
+                pkl.dump(submission, writer)
+            os.replace(pkl_path + ".part", pkl_path)
+
+    if input_submissions.endswith(".jsonl"):
+        # streamed by pushshift.PushshiftCrawler
+        submissions = utils.read_jsonl(input_submissions, fields=["id"])
+    else:
+        with open(input_submissions) as reader:
+            submissions = json.load(reader)
 
     n_submissions = len(submissions)
-    subs_to_dl = []
-    for s in submissions:
-        submission_id = s["id"]
-        pkl_path = os.path.join(output_folder, f"{submission_id}.pkl")
-
-        # if path exists, skip
-        if os.path.exists(pkl_path):
-            continue
-
-        subs_to_dl.append(submission_id)
+    # if it was downloaded, skip
+    subs_to_dl = [s["id"] for s in submissions if s["id"] not in downloaded]
 
-    print(f"{n_submissions - len(subs_to_dl)} already downloaded")
+    log.info(f"{n_submissions - len(subs_to_dl)} already downloaded, {len(subs_to_dl)} to download with "
+             f"{n_workers} workers at {requests_per_second} requests/s")
 
     random.shuffle(subs_to_dl)
-    not_found = []
-    timedout = []
-    for submission_id in tqdm(subs_to_dl):
-
-        if timeout is not None and timeout > 0:
-            try:
-                with time_limit(timeout):
-                    submission = reddit.submission(submission_id)
-                    # extract all comments
-                    submission.comments.replace_more(limit=None)
-            except (TimeoutException, exceptions.RequestException):
-                log.warning(f"{submission_id} timed out, skipping")
-                timedout.append(submission_id)
-                continue
-            except exceptions.NotFound:
-                log.warning(f"{submission_id} not found, skipping")
-                not_found.append(submission_id)
-                continue
-        else:
-            try:
-                submission = reddit.submission(submission_id)
-                # extract all comments
-                submission.comments.replace_more(limit=None)
-            except exceptions.NotFound:
-                not_found.append(submission_id)
-                continue
 
-        pkl_path = os.path.join(output_folder, f"{submission_id}.pkl")
-        # dump the object
-        with open(pkl_path, "wb") as writer:
-            pkl.dump(submission, writer)
+    # a burst of one request per worker
+    rate_limiter = TokenBucket(requests_per_second, capacity=max(n_workers, 1))
+    downloader = ConcurrentDownloader(SubmissionFetcher(config, rate_limiter, timeout), n_workers=n_workers,
+                                      retries=retries, retry_on=RETRY_ON, skip_on=SKIP_ON)
+    failures = downloader.run(subs_to_dl, save, on_skip=report_skipped)
 
-    log.info(f"{len(timedout)}  documents timed out")
-    log.info(f"{len(not_found)}  documents not found")
+    for name, ids in failures.items():
+        log.info(f"{len(ids)} documents skipped ({name})")
+    if store_path is not None:
+        submission_store.close()
+    return failures
 
 
 def pprint_tree(node, _prefix="", _last=True):
@@ -287,12 +341,14 @@ def pprint_tree(node, _prefix="", _last=True):
         pprint_tree(child, _prefix, _last)
 
 
-def iterate_raw_submissions(folder_paths, include_ids=None, exclude_ids=None):
+def iterate_raw_submissions(folder_paths, include_ids=None, exclude_ids=None, skip_nsfw=True):
     assert isinstance(folder_paths, list)
     if include_ids:
         assert exclude_ids is None
     if exclude_ids:
         assert include_ids is None
+    include_ids = set(include_ids) if include_ids else None
+    exclude_ids = set(exclude_ids) if exclude_ids else None
     for folder in tqdm(folder_paths, desc="Folders", leave=False):
         for f in tqdm(os.listdir(folder), desc="Submissions", leave=False):
             submission_id = f.split(".")[0]
@@ -304,6 +360,109 @@ def iterate_raw_submissions(folder_paths, include_ids=None, exclude_ids=None):
                 submission = pkl.load(reader)
 
                 # skip nsfw posts
-                if submission.over_18:
+                if skip_nsfw and submission.over_18:
                     continue
                 yield submission
+
+
+# metadata of the submission index, enough to skip submissions without unpickling them
+INDEX_FIELDS = ("over_18", "created_utc", "link_flair_text")
+
+
+def project_submission(submission, fields):
+    """
+    dict of the given fields of a submission: store.submission_record fields, "comments" (store.comment_records) or
+    any other attribute
+    """
+    record = submission_record(submission)
+    return {f: comment_records(submission) if f == "comments" else record[f] if f in record else
+            getattr(submission, f) for f in fields}
+
+
+def _load_projections(paths, fields, skip_nsfw):
+    projections = []
+    for path in paths:
+        with open(path, "rb") as reader:
+            submission = pkl.load(reader)
+        if skip_nsfw and submission.over_18:
+            continue
+        projections.append(project_submission(submission, fields))
+    return projections
+
+
+def _chunks(items, chunk_size):
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def iterate_raw_submissions_parallel(folder_paths, fields=("id",), include_ids=None, exclude_ids=None,
+                                     skip_nsfw=True, index=None, n_workers=4, ordered=True, chunk_size=64,
+                                     max_pending=None):
+    """
+    Parallel iterate_raw_submissions: pickles are loaded by a pool of worker processes (in chunks of chunk_size, at
+    most max_pending chunks ahead of the consumer), which only send back dicts of the requested fields
+    (project_submission). With ordered=False, chunks are yielded as soon as they are done.
+    index (build_submission_index, or the path of its JSON file) maps submission ids to metadata: NSFW submissions
+    are then skipped without opening their file
+    """
+    assert isinstance(folder_paths, list)
+    assert not (include_ids and exclude_ids)
+    include_ids = set(include_ids) if include_ids else None
+    exclude_ids = set(exclude_ids) if exclude_ids else None
+    if isinstance(index, str):
+        index = utils.read_json(index)
+
+    paths = []
+    n_skipped = 0
+    for folder in folder_paths:
+        for f in os.listdir(folder):
+            submission_id = f.split(".")[0]
+            if include_ids is not None and submission_id not in include_ids:
+                continue
+            if exclude_ids is not None and submission_id in exclude_ids:
+                continue
+            if skip_nsfw and index is not None and index.get(submission_id, {}).get("over_18"):
+                n_skipped += 1
+                continue
+            paths.append(os.path.join(folder, f))
+    log.info(f"Loading {len(paths)} submissions with {n_workers} workers ({n_skipped} NSFW skipped using the index)")
+
+    chunks = _chunks(paths, chunk_size)
+    if n_workers <= 0:
+        for chunk in chunks:
+            yield from _load_projections(chunk, fields, skip_nsfw)
+        return
+
+    def next_done(pending):
+        if ordered:
+            return [pending.popleft()]
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+        return done
+
+    max_pending = max_pending or 2 * n_workers
+    with ProcessPoolExecutor(n_workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_load_projections, chunk, fields, skip_nsfw))
+            while len(pending) >= max_pending:
+                for future in next_done(pending):
+                    yield from future.result()
+        while pending:
+            for future in next_done(pending):
+                yield from future.result()
+
+
+def build_submission_index(folder_paths, out_path=None, n_workers=4):
+    """
+    submission id -> INDEX_FIELDS of every submission (including NSFW ones), saved to out_path (JSON) if provided.
+    Unpickles every submission once, so that iterate_raw_submissions_parallel(index=...) doesn't have to
+    """
+    index = {}
+    for p in iterate_raw_submissions_parallel(folder_paths, fields=("id",) + INDEX_FIELDS, skip_nsfw=False,
+                                              n_workers=n_workers, ordered=False):
+        index[p.pop("id")] = p
+    if out_path is not None:
+        utils.write_json(index, out_path)
+    return index
@@ -0,0 +1,195 @@
+import logging
+import sqlite3
+import threading
+
+log = logging.getLogger(__name__)
+
+SUBMISSION_FIELDS = ("id", "created_utc", "author", "title", "selftext", "link_flair_text", "over_18", "edited")
+COMMENT_FIELDS = ("id", "submission_id", "parent_id", "position", "created_utc", "author", "body")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    id TEXT PRIMARY KEY,
+    created_utc REAL,
+    author TEXT,
+    title TEXT,
+    selftext TEXT,
+    link_flair_text TEXT,
+    over_18 INTEGER,
+    -- NULL if the submission wasn't edited, otherwise the time of the edit
+    edited REAL
+);
+CREATE INDEX IF NOT EXISTS submissions_created_utc ON submissions (created_utc);
+CREATE INDEX IF NOT EXISTS submissions_flair ON submissions (link_flair_text);
+-- the comment forests, flattened: parent_id is NULL for top level comments, position is the (pre-)order of the
+-- comment in its submission
+CREATE TABLE IF NOT EXISTS comments (
+    id TEXT PRIMARY KEY,
+    submission_id TEXT NOT NULL,
+    parent_id TEXT,
+    position INTEGER NOT NULL,
+    created_utc REAL,
+    author TEXT,
+    body TEXT
+);
+CREATE INDEX IF NOT EXISTS comments_submission ON comments (submission_id, position);
+"""
+
+
+def _author(thing):
+    return thing.author.name if thing.author is not None else None
+
+
+def submission_record(submission):
+    """
+    The fields of a (PRAW) submission that are used downstream, as a dict
+    """
+    return {
+        "id": submission.id,
+        "created_utc": submission.created_utc,
+        "author": _author(submission),
+        "title": submission.title,
+        "selftext": submission.selftext,
+        "link_flair_text": submission.link_flair_text,
+        "over_18": bool(submission.over_18),
+        "edited": None if submission.edited is False else float(submission.edited)
+    }
+
+
+def comment_records(submission):
+    """
+    Flattens the comment forest of a (PRAW) submission, whose "load more comments" were replaced
+    """
+    records = []
+    stack = [(None, c) for c in reversed(list(submission.comments))]
+    while stack:
+        parent_id, comment = stack.pop()
+        records.append({"id": comment.id, "submission_id": submission.id, "parent_id": parent_id,
+                        "position": len(records), "created_utc": comment.created_utc, "author": _author(comment),
+                        "body": comment.body})
+        stack.extend((comment.id, reply) for reply in reversed(list(comment.replies)))
+    return records
+
+
+def comment_forest(comments):
+    """
+    Rebuilds the comment forest from flat comment records (sorted by position): a list of top level comments,
+    every comment has a "replies" list
+    """
+    by_id = {}
+    forest = []
+    for c in comments:
+        node = dict(c, replies=[])
+        by_id[c["id"]] = node
+        if c["parent_id"] is None:
+            forest.append(node)
+        else:
+            by_id[c["parent_id"]]["replies"].append(node)
+    return forest
+
+
+class SubmissionStore:
+    """
+    SQLite store of submissions and their (flattened) comments, a compact replacement for the folders of pickled PRAW
+    submissions. Reading it doesn't need PRAW, and only the requested fields are loaded
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # writes happen from the download threads
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+
+    def __contains__(self, submission_id):
+        return self.conn.execute("SELECT 1 FROM submissions WHERE id = ?", (submission_id,)).fetchone() is not None
+
+    def ids(self):
+        return {row[0] for row in self.conn.execute("SELECT id FROM submissions")}
+
+    def add(self, submission, commit=True):
+        """
+        Adds (or replaces) a PRAW submission and all its comments
+        """
+        self.add_records(submission_record(submission), comment_records(submission), commit=commit)
+
+    def add_records(self, submission, comments, commit=True):
+        with self._lock:
+            self.conn.execute("DELETE FROM comments WHERE submission_id = ?", (submission["id"],))
+            self.conn.execute(f"INSERT OR REPLACE INTO submissions ({', '.join(SUBMISSION_FIELDS)}) "
+                              f"VALUES ({', '.join('?' * len(SUBMISSION_FIELDS))})",
+                              [submission[f] for f in SUBMISSION_FIELDS])
+            self.conn.executemany(f"INSERT OR REPLACE INTO comments ({', '.join(COMMENT_FIELDS)}) "
+                                  f"VALUES ({', '.join('?' * len(COMMENT_FIELDS))})",
+                                  [[c[f] for f in COMMENT_FIELDS] for c in comments])
+            if commit:
+                self.conn.commit()
+
+    def commit(self):
+        with self._lock:
+            self.conn.commit()
+
+    def get(self, submission_id, fields=SUBMISSION_FIELDS):
+        row = self.conn.execute(f"SELECT {', '.join(fields)} FROM submissions WHERE id = ?",
+                                (submission_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def edited(self, submission_id):
+        """
+        Same as `submission.edited is not False`
+        """
+        row = self.get(submission_id, fields=("edited",))
+        if row is None:
+            raise ValueError(f"submission {submission_id} not found in {self.path}")
+        return row["edited"] is not None
+
+    def comments(self, submission_id, fields=COMMENT_FIELDS):
+        return [dict(row) for row in self.conn.execute(
+            f"SELECT {', '.join(fields)} FROM comments WHERE submission_id = ? ORDER BY position", (submission_id,))]
+
+    def iter_submissions(self, fields=SUBMISSION_FIELDS, include_ids=None, exclude_ids=None, flair=None,
+                         created_after=None, created_before=None, skip_nsfw=True, with_comments=False):
+        """
+        Yields submissions as dicts of the given fields (in id order). Like reddit.iterate_raw_submissions, NSFW
+        submissions are skipped. With with_comments, the flat comment records are added under "comments"
+        """
+        conditions, params = [], []
+        if skip_nsfw:
+            conditions.append("over_18 = 0")
+        if flair is not None:
+            conditions.append("link_flair_text = ?")
+            params.append(flair)
+        if created_after is not None:
+            conditions.append("created_utc > ?")
+            params.append(created_after)
+        if created_before is not None:
+            conditions.append("created_utc < ?")
+            params.append(created_before)
+        query = f"SELECT {', '.join(dict.fromkeys(('id',) + tuple(fields)))} FROM submissions"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        include_ids = set(include_ids) if include_ids else None
+        exclude_ids = set(exclude_ids) if exclude_ids else None
+        # a separate cursor, so that comments can be queried while iterating
+        for row in self.conn.cursor().execute(query + " ORDER BY id", params):
+            if include_ids is not None and row["id"] not in include_ids:
+                continue
+            if exclude_ids is not None and row["id"] in exclude_ids:
+                continue
+            record = {f: row[f] for f in fields}
+            if with_comments:
+                record["comments"] = self.comments(row["id"])
+            yield record
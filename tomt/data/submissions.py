@@ -1,43 +1,52 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 
 
 def find_solved_node(submission):
     """
     Finds the node in a submission with "solved" in the reply
     """
-    reply_stack = submission["replies"][::]
+    reply_queue = deque(submission["replies"])
     author_id = submission["author"]
     solved_nodes = set()
-    while len(reply_stack) > 0:
-        reply = reply_stack.pop(0)
+    while len(reply_queue) > 0:
+        reply = reply_queue.popleft()
         if "solved" in reply["body"].lower() and reply.get("author_name") == author_id:
             solved_nodes.add(reply["id"])
 
         if reply["replies"] is not None:
-            reply_stack.extend(reply["replies"])
+            reply_queue.extend(reply["replies"])
 
     return solved_nodes
 
 
 def _gather_desc(reply):
     """
-    Helper function: Gathers descendants (list of IDs of all descendants)
+    Helper function: Gathers descendants (list of IDs of all descendants, in pre-order) of reply and of all the
+    replies below it. Iterative: the descendants of a node are the slice of the pre-order that is visited between
+    entering and leaving it
     """
-    if reply["replies"] is None:
-        reply["descendants"] = list()
-        return list()
-    desc = list()
-    for r in reply["replies"]:
-        assert r["id"] not in desc
-        desc.append(r["id"])
-        desc.extend(_gather_desc(r))
-    reply["descendants"] = desc
-    return desc
+    preorder = []
+    # (node, None) when entering a node, (node, its position in preorder) when leaving it
+    stack = [(reply, None)]
+    while stack:
+        node, start = stack.pop()
+        if start is not None:
+            node["descendants"] = preorder[start + 1:]
+            continue
+        stack.append((node, len(preorder)))
+        preorder.append(node["id"])
+        if node["replies"] is not None:
+            stack.extend((r, None) for r in reversed(node["replies"]))
+
+    assert len(set(preorder)) == len(preorder), f"duplicate reply ids below {reply['id']}"
+    return reply["descendants"]
 
 
 def gather_descendants(submission):
     """
-    Gathers descendants (list of IDs of all descendants)
+    Gathers descendants (list of IDs of all descendants). Every reply gets a list of all the replies below it, so
+    time and memory are proportional to the total size of these lists: O(n * depth), i.e. O(n^2) for a single chain
+    of n replies. Path extraction (find_path_to_node) doesn't need them
     """
     # create a new property in 'descendants', containing all descendant ids
     for reply in submission["replies"]:
@@ -45,6 +54,22 @@ def gather_descendants(submission):
         reply["descendants"] = list(desc)
 
 
+def build_parent_index(submission, stop_at=None):
+    """
+    reply id -> parent reply (None for top level replies).
+    If stop_at is provided, the traversal stops once the parent of that reply is known
+    """
+    parents = {reply["id"]: None for reply in submission["replies"]}
+    stack = list(reversed(submission["replies"]))
+    while stack and stop_at not in parents:
+        reply = stack.pop()
+        if reply["replies"]:
+            for r in reply["replies"]:
+                parents[r["id"]] = reply
+            stack.extend(reversed(reply["replies"]))
+    return parents
+
+
 def get_formatted_conv_reply(reply, op_id):
     """
     Reply -> dictionary only with certain information
@@ -60,46 +85,35 @@ def get_formatted_conv_reply(reply, op_id):
     return ut
 
 
-def find_path_to_node(submission, match_id):
+def find_path_to_node(submission, match_id, parent_index=None):
     """
     Given a submission and a matching id, this function
     first navigates to the matching ID, and then navigates back to the
     top, effectively extracting a single path from the root to the matching node.
+    Returns (None, None) if match_id isn't found, or is a top level reply
     """
-    match_reply = None
-    for reply in submission["replies"]:
-        if match_id in reply["descendants"]:
-            match_reply = reply
-
-    if match_reply is None:
+    if parent_index is None:
+        parent_index = build_parent_index(submission, stop_at=match_id)
+    if parent_index.get(match_id) is None:
         return None, None
 
+    # from the matching reply up to its top level reply, using the parent pointers
+    path_replies = [next(r for r in parent_index[match_id]["replies"] if r["id"] == match_id)]
+    while parent_index[path_replies[-1]["id"]] is not None:
+        path_replies.append(parent_index[path_replies[-1]["id"]])
+    path_replies.reverse()
+
     # original poster's id
     op_id = submission["author"]
-    path = [match_reply["id"]]
-    convo = [get_formatted_conv_reply(match_reply, op_id)]
-    reply_stack = match_reply["replies"][::]
-
-    while len(reply_stack) > 0:
-        reply = reply_stack.pop(0)
-
-        if reply["id"] == match_id:
-            path.append(reply["id"])
-            convo.append(get_formatted_conv_reply(reply, op_id))
-
-        if match_id in reply["descendants"]:
-            path.append(reply["id"])
-            convo.append(get_formatted_conv_reply(reply, op_id))
-
-        if reply["replies"] is not None:
-            reply_stack.extend(reply["replies"])
-
+    path = [reply["id"] for reply in path_replies]
+    convo = [get_formatted_conv_reply(reply, op_id) for reply in path_replies]
     return path, convo
 
 
 def create_conv_dicts(submissions):
     """
-    Finds all solved paths. 
+    Finds all solved paths. Path extraction is linear in the number of replies, but the descendants lists are still
+    added to the submissions (gather_descendants is O(n * depth)), since they are part of the output
 
     Returns (conv_dictionary, solved_node_counts, len_convos)
 
@@ -1,13 +1,46 @@
 import json
 import gzip
 import pickle as pkl
+from datetime import datetime, timezone
 
+# a faster JSON parser for (large) JSONL files, if one is installed (opt-in, see iter_jsonl)
+try:
+    import orjson
 
-def read_jsonl(file):
+    _fast_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        _fast_loads = ujson.loads
+    except ImportError:
+        _fast_loads = json.loads
+
+
+def iter_jsonl(file, fields=None, fast=False):
+    """
+    Streams the records of a JSONL file, blank lines are skipped. If fields is provided, only those keys are kept.
+    With fast, lines are parsed with orjson / ujson if installed (these differ from json in edge cases, e.g. NaN or
+    big integers)
+    """
+    loads = _fast_loads if fast else json.loads
+    with open(file, "rb") as reader:
+        for line in reader:
+            if not line.strip():
+                continue
+            j = loads(line)
+            if fields is not None:
+                j = {k: j[k] for k in fields if k in j}
+            yield j
+
+
+def read_jsonl(file, fields=None):
     with open(file) as reader:
         jj = []
         for line in reader:
             j = json.loads(line)
+            if fields is not None:
+                j = {k: j[k] for k in fields if k in j}
             jj.append(j)
 
         return jj
@@ -62,3 +95,17 @@ def load_pickle(path):
 def write_pickle(obj, path):
     with open(path, "wb") as writer:
         pkl.dump(obj, writer)
+
+
+def utc_timestamp(dt):
+    """
+        Converts a (naive, UTC) datetime object into a timestamp
+    """
+    return int(dt.replace(tzinfo=timezone.utc).timestamp())
+
+
+def datetime_from_utc(utc):
+    """
+        Converts a UTC timestamp into a datetime object in the UTC timezone
+    """
+    return datetime.fromtimestamp(utc, tz=timezone.utc)